@@ -1,12 +1,18 @@
 import argparse
-import csv
-import itertools as it
+import asyncio
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
-from time import sleep
+import random
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
-import requests
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from address_renderer import GeocodeResult, read_addresses, read_results, render_addresses
+from geocode_cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL_DAYS, GeocodeCache, normalize_address
+from http_client import BACKOFF_FACTOR, CONNECT_TIMEOUT, READ_TIMEOUT, SERVER_ERROR_STATUSES, HttpClient
+from rate_limiter import RateLimiter, parse_retry_after
+from run_metrics import RunMetrics, add_metrics_arguments
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,10 +20,14 @@ logger = logging.getLogger(__name__)
 
 # Constants
 REQUESTS_PER_SECOND = 5
+BURST = 1
+MAX_WORKERS = 10
+CONCURRENCY = 50
+MAX_RETRIES = 3
 GEOAPIFY_API_URL = "https://api.geoapify.com/v1/geocode/search"
 
 
-def geocode_address(address, api_key, country_code):
+def geocode_address(address, api_key, country_code, rate_limiter=None, cache=None, client=None):
     params = {
             'format': 'json',
             'text': address,
@@ -27,57 +37,181 @@ def geocode_address(address, api_key, country_code):
     if country_code:
         params['filter'] = 'countrycode:' + country_code
 
-    try:
-        response = requests.get(GEOAPIFY_API_URL, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if len(data['results']) > 0:
-                return data['results'][0]
-            else:
-                return { "error":  "Not found"}
-        else:
+    if cache:
+        result = cache.get(address, country_code, params['limit'])
+        if result is not None:
+            return result
+
+    # Server errors and connection failures are retried by the client, rate limiting by the loop below
+    client = client or HttpClient(retry_statuses=SERVER_ERROR_STATUSES)
+    for attempt in range(1, MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            started = monotonic()
+            response = client.get(GEOAPIFY_API_URL, params=params)
+            if response.status_code == 200:
+                if rate_limiter:
+                    rate_limiter.record_success(monotonic() - started)
+                data = response.json()
+                if len(data['results']) > 0:
+                    result = data['results'][0]
+                else:
+                    result = { "error":  "Not found"}
+                # Failed requests are not cached, so they are retried on the next run
+                if cache:
+                    cache.put(address, country_code, result, params['limit'])
+                return result
+            if response.status_code == 429 and rate_limiter:
+                # Slow down and retry when the rate limit is exceeded
+                rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"Rate limit exceeded for address '{address}', retrying ({attempt}/{MAX_RETRIES})")
+                    continue
             logger.warning(f"Failed to geocode address '{address}': {response.text}")
             return {}
-    except Exception as e:
-        logger.error(f"Error while geocoding address '{address}': {e}")
-        return {}
+        except Exception as e:
+            logger.error(f"Error while geocoding address '{address}': {e}")
+            return {}
+
+
+async def geocode_address_async(session, address, api_key, country_code, rate_limiter, cache=None):
+    params = {
+            'format': 'json',
+            'text': address,
+            'limit': 1,
+            'apiKey': api_key
+        }
+    if country_code:
+        params['filter'] = 'countrycode:' + country_code
 
+    if cache:
+        result = cache.get(address, country_code, params['limit'])
+        if result is not None:
+            return result
 
-def geocode_addresses(api_key, addresses, country_code):
-    # Split addresses into batches
-    addresses = list(it.batched(addresses, REQUESTS_PER_SECOND))
+    for attempt in range(1, MAX_RETRIES + 1):
+        await rate_limiter.acquire_async()
+        try:
+            started = monotonic()
+            async with session.get(GEOAPIFY_API_URL, params=params) as response:
+                if response.status == 200:
+                    rate_limiter.record_success(monotonic() - started)
+                    data = await response.json()
+                    if len(data['results']) > 0:
+                        result = data['results'][0]
+                    else:
+                        result = { "error":  "Not found"}
+                    if cache:
+                        cache.put(address, country_code, result, params['limit'])
+                    return result
+                error = f"{response.status} {await response.text()}"
+                if response.status == 429:
+                    # Slow down and retry when the rate limit is exceeded
+                    rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                elif response.status not in SERVER_ERROR_STATUSES:
+                    break
+        except (asyncio.TimeoutError, ClientError) as e:
+            error = e
+        except Exception as e:
+            logger.error(f"Error while geocoding address '{address}': {e}")
+            return {}
+        if attempt < MAX_RETRIES:
+            logger.warning(f"Request for address '{address}' failed: {error}, retrying ({attempt}/{MAX_RETRIES})")
+            await asyncio.sleep(random.uniform(0, BACKOFF_FACTOR * 2 ** attempt))
 
-    # Request results asynchronously for each address batch
-    tasks = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for batch in addresses:
-            logger.info(batch)
-            tasks.extend([executor.submit(geocode_address, address, api_key, country_code) for address in batch])
-            sleep(1)
-    # Wait for results
-    wait(tasks, return_when=ALL_COMPLETED)
+    logger.warning(f"Failed to geocode address '{address}': {error}")
+    return {}
 
-    return [task.result() for task in tasks]
 
+def geocode_addresses(api_key, addresses, country_code,
+                      requests_per_second=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS, cache=None,
+                      metrics=None):
+    # Every worker takes a token before each request, so requests are paced evenly
+    # and the rate adapts to throttling and latency reported by the API
+    rate_limiter = RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('address_standardization')
+    metrics.watch_rate(rate_limiter)
+    # One pooled connection per worker, kept alive for the whole run
+    client = HttpClient(pool_size=max_workers, retry_statuses=SERVER_ERROR_STATUSES, metrics=metrics)
 
-def generate_standard_addresses(output, addresses, address_format, geocode_results):
-    # Write csv with standardized addresses
-    with open(output, 'w', newline='') as f:
-        csv_writer = csv.writer(f)
-        csv_writer.writerow(["Original Address", "Standardized Address"])
-        for address, result in zip(addresses, geocode_results):
-            # For empty geocoding result set empty string
-            if not result or result.get('error'):
-                standardized_address = ''
-            else:
-                # Fill template with values, fallback missing data to empty string
-                standardized_address = address_format.format_map(GeocodeResult(**result))
-            csv_writer.writerow([address, standardized_address])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tasks = [executor.submit(geocode_address, address, api_key, country_code, rate_limiter, cache, client)
+                 for address in addresses]
+        # Collect results in input order
+        results = []
+        for task in tasks:
+            results.append(task.result())
+            metrics.record_items()
 
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+    logger.info(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    return results
 
-class GeocodeResult(dict):
-    def __missing__(self, key):
-        return ''
+
+async def geocode_addresses_async(api_key, addresses, country_code,
+                                  requests_per_second=REQUESTS_PER_SECOND, burst=BURST, concurrency=CONCURRENCY,
+                                  cache=None, metrics=None):
+    # Same as geocode_addresses, but requests are coroutines sharing one ClientSession:
+    # up to `concurrency` requests are in flight without a thread per request
+    rate_limiter = RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('address_standardization')
+    metrics.watch_rate(rate_limiter)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def geocode(address):
+        async with semaphore:
+            result = await geocode_address_async(session, address, api_key, country_code, rate_limiter, cache)
+        metrics.record_items()
+        return result
+
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    async with ClientSession(timeout=timeout, connector=TCPConnector(limit=concurrency),
+                             trace_configs=[metrics.trace_config()]) as session:
+        # Collect results in input order
+        results = await asyncio.gather(*(geocode(address) for address in addresses))
+
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+    return results
+
+
+def geocode_unique_addresses(addresses, geocode):
+    # Geocode the first spelling of every normalized address and share its result with all duplicates
+    keys = [normalize_address(address) for address in addresses]
+    unique_addresses = {}
+    for key, address in zip(keys, addresses):
+        unique_addresses.setdefault(key, address)
+    logger.info(f"Deduplication saved {len(addresses) - len(unique_addresses)} requests")
+
+    unique_results = geocode(list(unique_addresses.values()))
+    results_by_key = dict(zip(unique_addresses.keys(), unique_results))
+    return [results_by_key[key] for key in keys]
+
+
+def record_failures(metrics, results):
+    # Failed addresses get an empty result; count them, so a run with failures doesn't look like a clean one
+    failed = sum(1 for result in results if not result)
+    metrics.add_gauge('failed_addresses', 'Addresses without a result after all retries', lambda: failed)
+    if failed:
+        logger.warning(f"{failed} of {len(results)} addresses failed after all retries, their results are empty")
+
+
+def run_geocoding(args, addresses, cache, metrics=None):
+    # Geocode with the execution engine selected on the command line
+    if args.engine == 'asyncio':
+        return asyncio.run(geocode_addresses_async(args.api_key, addresses, args.country_code,
+                                                   args.requests_per_second, args.burst, args.concurrency, cache,
+                                                   metrics))
+    return geocode_addresses(args.api_key, addresses, args.country_code,
+                             args.requests_per_second, args.burst, args.max_workers, cache, metrics)
+
+
+def generate_standard_addresses(output, addresses, address_format, geocode_results):
+    # Write csv with standardized addresses; kept, like the GeocodeResult import, for code importing them from here
+    render_addresses(addresses, geocode_results, [(output, address_format)])
 
 
 def main():
@@ -87,20 +221,65 @@ def main():
     parser.add_argument('--input', type=str, help='Input file containing addresses')
     parser.add_argument('--output', type=str, help='Output file for NDJSON results')
     parser.add_argument('--country_code', type=str, help='Optional country code to improve accuracy')
-    parser.add_argument('--format', required=True, help='Address format string using placeholders')
-    parser.add_argument('--standardized_output', required=True, help='Output CSV file for standardized addresses')
+    parser.add_argument('--format', required=True, action='append',
+                        help='Address format string using placeholders, repeat for several formats')
+    parser.add_argument('--standardized_output', required=True, action='append',
+                        help='Output CSV file for standardized addresses, one per --format')
+    parser.add_argument('--results', type=str,
+                        help='Render the geocoding results of a previous run (NDJSON) instead of geocoding again')
+    parser.add_argument('--requests_per_second', type=float, default=REQUESTS_PER_SECOND,
+                        help=f'Maximum requests per second allowed by your plan (default: {REQUESTS_PER_SECOND})')
+    parser.add_argument('--burst', type=int, default=BURST,
+                        help=f'Maximum number of requests sent at once (default: {BURST})')
+    parser.add_argument('--max_workers', type=int, default=MAX_WORKERS,
+                        help=f'Number of worker threads sending requests (default: {MAX_WORKERS})')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Send requests from a thread pool or from asyncio coroutines (default: threads)')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help=f'Maximum number of concurrent requests with the asyncio engine (default: {CONCURRENCY})')
+    parser.add_argument('--cache', type=str, help='Optional SQLite file for caching geocoding results between runs')
+    parser.add_argument('--cache_ttl_days', type=float, default=DEFAULT_TTL_DAYS,
+                        help=f'Days before a cached result expires (default: {DEFAULT_TTL_DAYS})')
+    parser.add_argument('--cache_max_entries', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help=f'Maximum number of cached results, least recently used are evicted '
+                             f'(default: {DEFAULT_MAX_ENTRIES})')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='Send one request for addresses that differ only in case, whitespace or punctuation')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    if len(args.standardized_output) != len(args.format):
+        parser.error('every --standardized_output needs its own --format')
+    outputs = list(zip(args.standardized_output, args.format))
+
+    if args.results:
+        # Stream the addresses and the stored results side by side, without API requests
+        render_addresses(read_addresses(args.input), read_results(args.results), outputs)
+        return
 
-    with open(args.input, 'r') as f:
-        addresses = f.read().strip().splitlines()
-    results = geocode_addresses(args.api_key, addresses, args.country_code)
+    # Blank lines are skipped, like when the results are rendered with --results
+    addresses = list(read_addresses(args.input))
+    # Reuse results of previous runs when a cache file is given
+    cache = GeocodeCache(args.cache, args.cache_ttl_days, args.cache_max_entries) if args.cache else None
+    metrics = RunMetrics('address_standardization', args.metrics_output, args.metrics_interval)
+    metrics.start_snapshots()
+    if args.deduplicate:
+        results = geocode_unique_addresses(addresses, lambda unique: run_geocoding(args, unique, cache, metrics))
+    else:
+        results = run_geocoding(args, addresses, cache, metrics)
+    if cache:
+        logger.info(f"Cache hits: {cache.hits}, misses: {cache.misses}")
+        cache.close()
+    record_failures(metrics, results)
+    metrics.close()
+    if args.metrics_output:
+        logger.info(f"Metrics written to {args.metrics_output}.prom and {args.metrics_output}.json")
     # Write results to NDJSON file
     with open(args.output, 'w') as f:
         for result in results:
             f.write(json.dumps(result) + '\n')
     # Write csv with standardized addresses
-    generate_standard_addresses(args.standardized_output, addresses, args.format, results)
+    render_addresses(addresses, results, outputs)
 
 
 if __name__ == "__main__":
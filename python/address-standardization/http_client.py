@@ -0,0 +1,115 @@
+import email.utils
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 30
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+RETRY_STATUSES = (429,) + SERVER_ERROR_STATUSES
+
+
+class HttpClient:
+    """Pooled HTTP client shared by all requests of a run.
+
+    Keeps connections alive in a pool of `pool_size` connections per host, applies connect and read
+    timeouts to every request, and retries connection errors and `retry_statuses` responses
+    with jittered exponential backoff (honouring `Retry-After`). With `metrics` (a RunMetrics),
+    every request sent, retries included, is reported with its latency and status.
+    """
+
+    def __init__(self, pool_size=10, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, retry_statuses=RETRY_STATUSES,
+                 metrics=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = set(retry_statuses)
+        self.retries = 0
+        self.metrics = metrics
+
+        # Block instead of opening throwaway connections when all pooled connections are busy
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+            else:
+                if response.status_code not in self.retry_statuses or attempt == self.max_retries:
+                    return response
+                delay = max(self.backoff(attempt), retry_after(response))
+                response.close()
+            self.retries += 1
+            time.sleep(delay)
+
+    def send(self, method, url, **kwargs):
+        if not self.metrics:
+            return self.session.request(method, url, **kwargs)
+        request = self.metrics.request_started(method, url, kwargs.get('params'))
+        status = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.metrics.request_finished(request, status)
+
+    def backoff(self, attempt):
+        # Full jitter spreads retries of concurrent requests over time
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff_factor * 2 ** attempt))
+
+    def connection_stats(self):
+        # urllib3 pools count every request sent and every new connection they opened
+        requests_count = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+        return {'requests': requests_count,
+                'connections': connections,
+                'reused': requests_count - connections,
+                'retries': self.retries}
+
+    def close(self):
+        self.session.close()
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date, same as in rate_limiter.py
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def retry_after(response):
+    return min(parse_retry_after(response.headers.get('Retry-After')) or 0, MAX_BACKOFF)
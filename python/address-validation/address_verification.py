@@ -1,12 +1,21 @@
 import argparse
+import asyncio
 import csv
-import itertools as it
+import itertools
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
-from time import sleep
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
-import requests
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from geocode_cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL_DAYS, GeocodeCache
+from http_client import BACKOFF_FACTOR, CONNECT_TIMEOUT, READ_TIMEOUT, SERVER_ERROR_STATUSES, HttpClient
+from rate_limiter import RateLimiter, parse_retry_after
+from run_metrics import RunMetrics, add_metrics_arguments
+from validation_sweep import confidence_arrays, load_confidence_arrays, sweep_thresholds
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -14,10 +23,14 @@ logger = logging.getLogger(__name__)
 
 # Constants
 REQUESTS_PER_SECOND = 5
+BURST = 1
+MAX_WORKERS = 10
+CONCURRENCY = 50
+MAX_RETRIES = 3
 GEOAPIFY_API_URL = "https://api.geoapify.com/v1/geocode/search"
 
 
-def geocode_address(address, api_key, country_code):
+def geocode_address(address, api_key, country_code, rate_limiter=None, cache=None, client=None):
     params = {
             'format': 'json',
             'text': address,
@@ -27,36 +40,173 @@ def geocode_address(address, api_key, country_code):
     if country_code:
         params['filter'] = 'countrycode:' + country_code
 
-    try:
-        response = requests.get(GEOAPIFY_API_URL, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if len(data['results']) > 0:
-                return data['results'][0]
-            else:
-                return { "error":  "Not found"}
-        else:
+    if cache:
+        result = cache.get(address, country_code, params['limit'])
+        if result is not None:
+            return result
+
+    # Server errors and connection failures are retried by the client, rate limiting by the loop below
+    client = client or HttpClient(retry_statuses=SERVER_ERROR_STATUSES)
+    for attempt in range(1, MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            started = monotonic()
+            response = client.get(GEOAPIFY_API_URL, params=params)
+            if response.status_code == 200:
+                if rate_limiter:
+                    rate_limiter.record_success(monotonic() - started)
+                data = response.json()
+                if len(data['results']) > 0:
+                    result = data['results'][0]
+                else:
+                    result = { "error":  "Not found"}
+                # Failed requests are not cached, so they are retried on the next run
+                if cache:
+                    cache.put(address, country_code, result, params['limit'])
+                return result
+            if response.status_code == 429 and rate_limiter:
+                # Slow down and retry when the rate limit is exceeded
+                rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"Rate limit exceeded for address '{address}', retrying ({attempt}/{MAX_RETRIES})")
+                    continue
             logger.warning(f"Failed to geocode address '{address}': {response.text}")
             return {}
-    except Exception as e:
-        logger.error(f"Error while geocoding address '{address}': {e}")
-        return {}
+        except Exception as e:
+            logger.error(f"Error while geocoding address '{address}': {e}")
+            return {}
+
+
+async def geocode_address_async(session, address, api_key, country_code, rate_limiter, cache=None):
+    params = {
+            'format': 'json',
+            'text': address,
+            'limit': 1,
+            'apiKey': api_key
+        }
+    if country_code:
+        params['filter'] = 'countrycode:' + country_code
+
+    if cache:
+        result = cache.get(address, country_code, params['limit'])
+        if result is not None:
+            return result
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        await rate_limiter.acquire_async()
+        try:
+            started = monotonic()
+            async with session.get(GEOAPIFY_API_URL, params=params) as response:
+                if response.status == 200:
+                    rate_limiter.record_success(monotonic() - started)
+                    data = await response.json()
+                    if len(data['results']) > 0:
+                        result = data['results'][0]
+                    else:
+                        result = { "error":  "Not found"}
+                    if cache:
+                        cache.put(address, country_code, result, params['limit'])
+                    return result
+                error = f"{response.status} {await response.text()}"
+                if response.status == 429:
+                    # Slow down and retry when the rate limit is exceeded
+                    rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                elif response.status not in SERVER_ERROR_STATUSES:
+                    break
+        except (asyncio.TimeoutError, ClientError) as e:
+            error = e
+        except Exception as e:
+            logger.error(f"Error while geocoding address '{address}': {e}")
+            return {}
+        if attempt < MAX_RETRIES:
+            logger.warning(f"Request for address '{address}' failed: {error}, retrying ({attempt}/{MAX_RETRIES})")
+            await asyncio.sleep(random.uniform(0, BACKOFF_FACTOR * 2 ** attempt))
+
+    logger.warning(f"Failed to geocode address '{address}': {error}")
+    return {}
+
+
+def geocode_addresses(api_key, addresses, output_file, country_code,
+                      requests_per_second=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS, cache=None,
+                      metrics=None):
+    # Every worker takes a token before each request, so requests are paced evenly
+    # and the rate adapts to throttling and latency reported by the API
+    rate_limiter = RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('address_verification')
+    metrics.watch_rate(rate_limiter)
+    # One pooled connection per worker, kept alive for the whole run
+    client = HttpClient(pool_size=max_workers, retry_statuses=SERVER_ERROR_STATUSES, metrics=metrics)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tasks = [executor.submit(geocode_address, address, api_key, country_code, rate_limiter, cache, client)
+                 for address in addresses]
+        # Collect results in input order
+        results = []
+        for task in tasks:
+            results.append(task.result())
+            metrics.record_items()
+
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+    logger.info(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    return results
+
+
+async def geocode_addresses_async(api_key, addresses, country_code,
+                                  requests_per_second=REQUESTS_PER_SECOND, burst=BURST, concurrency=CONCURRENCY,
+                                  cache=None, metrics=None):
+    # Same as geocode_addresses, but requests are coroutines sharing one ClientSession:
+    # up to `concurrency` requests are in flight without a thread per request
+    rate_limiter = RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('address_verification')
+    metrics.watch_rate(rate_limiter)
+    semaphore = asyncio.Semaphore(concurrency)
 
+    async def geocode(address):
+        async with semaphore:
+            result = await geocode_address_async(session, address, api_key, country_code, rate_limiter, cache)
+        metrics.record_items()
+        return result
 
-def geocode_addresses(api_key, addresses, output_file, country_code):
-    # Split addresses into batches
-    addresses = list(it.batched(addresses, REQUESTS_PER_SECOND))
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    async with ClientSession(timeout=timeout, connector=TCPConnector(limit=concurrency),
+                             trace_configs=[metrics.trace_config()]) as session:
+        # Collect results in input order
+        results = await asyncio.gather(*(geocode(address) for address in addresses))
 
-    # Request results asynchronously for each address batch
-    tasks = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for batch in addresses:
-            logger.info(batch)
-            tasks.extend([executor.submit(geocode_address, address, api_key, country_code) for address in batch])
-            sleep(1)
-    # Wait for results
-    wait(tasks, return_when=ALL_COMPLETED)
-    return [task.result() for task in tasks]
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+    return results
+
+
+def record_failures(metrics, results):
+    # Failed addresses get an empty result; count them, so a run with failures doesn't look like a clean one
+    failed = sum(1 for result in results if not result)
+    metrics.add_gauge('failed_addresses', 'Addresses without a result after all retries', lambda: failed)
+    if failed:
+        logger.warning(f"{failed} of {len(results)} addresses failed after all retries, their results are empty")
+
+
+def run_geocoding(args, addresses, cache, metrics=None):
+    # Geocode with the execution engine selected on the command line
+    if args.engine == 'asyncio':
+        return asyncio.run(geocode_addresses_async(args.api_key, addresses, args.country_code,
+                                                   args.requests_per_second, args.burst, args.concurrency, cache,
+                                                   metrics))
+    return geocode_addresses(args.api_key, addresses, args.output, args.country_code,
+                             args.requests_per_second, args.burst, args.max_workers, cache, metrics)
+
+
+def read_addresses(input_file):
+    # Same rule as read_addresses of the geocoding sample: one address per non-blank line, stripped, so the
+    # NDJSON results it writes line up with the addresses
+    with open(input_file, 'r') as f:
+        for line in f:
+            address = line.strip()
+            if address:
+                yield address
 
 
 def generate_validation_report(addresses, geocode_results, min_confirmed, max_not_confirmed, output):
@@ -115,20 +265,74 @@ def main():
     parser.add_argument('--output', type=str, help='Output file for NDJSON results')
     parser.add_argument('--country_code', type=str, help='Optional country code to improve accuracy')
     parser.add_argument('--validation_output', required=True, help='Output CSV file for validation results')
-    parser.add_argument('--min_confirmed', type=float, default=0.9, help='Minimum confidence for CONFIRMED')
-    parser.add_argument('--max_not_confirmed', type=float, default=0.5, help='Maximum confidence for NOT_CONFIRMED')
+    parser.add_argument('--min_confirmed', type=float, nargs='+', default=[0.9],
+                        help='Minimum confidence for CONFIRMED, several values to compare thresholds')
+    parser.add_argument('--max_not_confirmed', type=float, nargs='+', default=[0.5],
+                        help='Maximum confidence for NOT_CONFIRMED, several values to compare thresholds')
+    parser.add_argument('--results', type=str,
+                        help='Validate the geocoding results of a previous run (NDJSON) instead of geocoding again')
+    parser.add_argument('--summary_output', type=str,
+                        help='Output CSV file for validation counts per threshold pair '
+                             '(default: validation output name with _summary)')
+    parser.add_argument('--summary_only', action='store_true',
+                        help='Only write the validation counts per threshold pair, without a report per pair')
+    parser.add_argument('--requests_per_second', type=float, default=REQUESTS_PER_SECOND,
+                        help=f'Maximum requests per second allowed by your plan (default: {REQUESTS_PER_SECOND})')
+    parser.add_argument('--burst', type=int, default=BURST,
+                        help=f'Maximum number of requests sent at once (default: {BURST})')
+    parser.add_argument('--max_workers', type=int, default=MAX_WORKERS,
+                        help=f'Number of worker threads sending requests (default: {MAX_WORKERS})')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Send requests from a thread pool or from asyncio coroutines (default: threads)')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help=f'Maximum number of concurrent requests with the asyncio engine (default: {CONCURRENCY})')
+    parser.add_argument('--cache', type=str, help='Optional SQLite file for caching geocoding results between runs')
+    parser.add_argument('--cache_ttl_days', type=float, default=DEFAULT_TTL_DAYS,
+                        help=f'Days before a cached result expires (default: {DEFAULT_TTL_DAYS})')
+    parser.add_argument('--cache_max_entries', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help=f'Maximum number of cached results, least recently used are evicted '
+                             f'(default: {DEFAULT_MAX_ENTRIES})')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
-    with open(args.input, 'r') as f:
-        addresses = f.read().strip().splitlines()
+    addresses = list(read_addresses(args.input))
+    threshold_pairs = list(itertools.product(args.min_confirmed, args.max_not_confirmed))
+
+    if args.results:
+        # Tune thresholds on existing results without API requests
+        arrays = load_confidence_arrays(args.results)
+    else:
+        # Reuse results of previous runs when a cache file is given
+        cache = GeocodeCache(args.cache, args.cache_ttl_days, args.cache_max_entries) if args.cache else None
+        metrics = RunMetrics('address_verification', args.metrics_output, args.metrics_interval)
+        metrics.start_snapshots()
+
+        results = run_geocoding(args, addresses, cache, metrics)
+        if cache:
+            logger.info(f"Cache hits: {cache.hits}, misses: {cache.misses}")
+            cache.close()
+        record_failures(metrics, results)
+        metrics.close()
+        if args.metrics_output:
+            logger.info(f"Metrics written to {args.metrics_output}.prom and {args.metrics_output}.json")
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
 
-    results = geocode_addresses(args.api_key, addresses, args.output, args.country_code)
-    with open(args.output, 'w') as f:
-        for result in results:
-            f.write(json.dumps(result) + '\n')
+        if len(threshold_pairs) == 1:
+            generate_validation_report(addresses, results, *threshold_pairs[0], args.validation_output)
+            return
+        arrays = confidence_arrays(results)
 
-    generate_validation_report(addresses, results, args.min_confirmed, args.max_not_confirmed, args.validation_output)
+    if len(arrays['has_result']) != len(addresses):
+        raise ValueError(f"{len(arrays['has_result'])} geocoding results for {len(addresses)} addresses")
+    summary_output = args.summary_output or os.path.splitext(args.validation_output)[0] + '_summary.csv'
+    for row in sweep_thresholds(addresses, arrays, threshold_pairs, args.validation_output, summary_output,
+                                not args.summary_only):
+        logger.info(f"min_confirmed={row['min_confirmed']}, max_not_confirmed={row['max_not_confirmed']}: "
+                    f"{row['CONFIRMED']} confirmed, {row['PARTIALLY_CONFIRMED']} partially confirmed, "
+                    f"{row['NOT_CONFIRMED']} not confirmed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import csv
+import json
+import os
+
+import numpy as np
+
+STATUSES = ['CONFIRMED', 'PARTIALLY_CONFIRMED', 'NOT_CONFIRMED']
+CONFIRMED, PARTIALLY_CONFIRMED, NOT_CONFIRMED = range(len(STATUSES))
+LEVELS = ['CITY', 'STREET', 'BUILDING']
+# Reason codes: '' first, then the three reasons of every level in the order they are checked
+REASONS = ['', 'No geocoding result', 'Unknown']
+for _level in LEVELS:
+    REASONS += [f'{_level}_NOT_CONFIRMED', f'LOW_{_level}_LEVEL_CONFIDENCE', f'{_level}_LEVEL_DOUBTS']
+NO_REASON, NO_RESULT, UNKNOWN = range(3)
+CONFIDENCE_FIELDS = ['confidence', 'confidence_city_level', 'confidence_street_level', 'confidence_building_level']
+
+
+def confidence_arrays(geocode_results):
+    # Columns of the rank.confidence* fields, missing values are 0 as in validate_address_geocoding()
+    has_result, columns = [], [[] for _ in CONFIDENCE_FIELDS]
+    for result in geocode_results:
+        has_result.append(bool(result) and result.get('error') != 'Not found')
+        rank = result.get('rank', {}) if result else {}
+        for column, field in zip(columns, CONFIDENCE_FIELDS):
+            column.append(rank.get(field) or 0)
+    arrays = {field: np.array(column, dtype=np.float64) for field, column in zip(CONFIDENCE_FIELDS, columns)}
+    arrays['has_result'] = np.array(has_result, dtype=bool)
+    return arrays
+
+
+def load_confidence_arrays(results_file):
+    # Parsing the NDJSON is the slow part, so the columns are kept in a .npz file next to it
+    # and reused as long as the NDJSON is not modified
+    arrays_file = results_file + '.confidence.npz'
+    if os.path.exists(arrays_file) and os.path.getmtime(arrays_file) >= os.path.getmtime(results_file):
+        with np.load(arrays_file) as data:
+            return {name: data[name] for name in data.files}
+
+    def read_results():
+        with open(results_file) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    arrays = confidence_arrays(read_results())
+    np.savez(arrays_file, **arrays)
+    return arrays
+
+
+def classify(arrays, min_confirmed, max_not_confirmed):
+    # Vectorized validate_address_geocoding(): status and reason codes for all rows at once
+    confidence = arrays['confidence']
+    has_result = arrays['has_result']
+    confirmed = has_result & (confidence >= min_confirmed)
+    not_confirmed = ~has_result | (~confirmed & (confidence <= max_not_confirmed))
+
+    status = np.full(len(confidence), PARTIALLY_CONFIRMED, dtype=np.int8)
+    status[confirmed] = CONFIRMED
+    status[not_confirmed] = NOT_CONFIRMED
+
+    # The reason of a partially confirmed row comes from the first level that is not confirmed
+    reason = np.full(len(confidence), UNKNOWN, dtype=np.int8)
+    undecided = np.ones(len(confidence), dtype=bool)
+    for i, field in enumerate(CONFIDENCE_FIELDS[1:]):
+        level_confidence = arrays[field]
+        first_code = 3 + 3 * i
+        level_reason = np.select([level_confidence == 0,
+                                  level_confidence <= max_not_confirmed,
+                                  level_confidence <= min_confirmed],
+                                 [first_code, first_code + 1, first_code + 2], -1)
+        matched = undecided & (level_reason >= 0)
+        reason[matched] = level_reason[matched]
+        undecided &= ~matched
+    reason[status != PARTIALLY_CONFIRMED] = NO_REASON
+    reason[~has_result] = NO_RESULT
+    return status, reason
+
+
+def count_statuses(status):
+    counts = np.bincount(status, minlength=len(STATUSES))
+    return dict(zip(STATUSES, counts.tolist()))
+
+
+def write_report(addresses, status, reason, output):
+    # Same CSV as generate_validation_report()
+    status_names = np.array(STATUSES, dtype=object)[status]
+    reason_names = np.array(REASONS, dtype=object)[reason]
+    with open(output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Original Address', 'Validation Result', 'Reason'])
+        writer.writerows(zip(addresses, status_names, reason_names))
+
+
+def report_file_name(output, min_confirmed, max_not_confirmed):
+    root, ext = os.path.splitext(output)
+    return f'{root}_min{min_confirmed:g}_max{max_not_confirmed:g}{ext or ".csv"}'
+
+
+def sweep_thresholds(addresses, arrays, threshold_pairs, output, summary_output, write_reports=True):
+    # Classify all rows for every (min_confirmed, max_not_confirmed) pair and write a report per pair
+    # and the status counts of all pairs. With a single pair, the report is written to output itself
+    summary = []
+    for min_confirmed, max_not_confirmed in threshold_pairs:
+        status, reason = classify(arrays, min_confirmed, max_not_confirmed)
+        report = ''
+        if write_reports:
+            report = output if len(threshold_pairs) == 1 else report_file_name(output, min_confirmed, max_not_confirmed)
+            write_report(addresses, status, reason, report)
+        summary.append({'min_confirmed': min_confirmed, 'max_not_confirmed': max_not_confirmed,
+                        **count_statuses(status), 'report': report})
+
+    with open(summary_output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['min_confirmed', 'max_not_confirmed', *STATUSES, 'report'])
+        writer.writeheader()
+        writer.writerows(summary)
+    return summary
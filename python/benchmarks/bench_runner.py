@@ -0,0 +1,51 @@
+import os
+import runpy
+import sys
+import webbrowser
+
+# Hosts of the Geoapify APIs that are sent to the mock server instead
+GEOAPIFY_HOSTS = ('https://api.geoapify.com', 'https://maps.geoapify.com')
+
+
+def redirect_requests(mock_url):
+    # Rewrite Geoapify URLs of requests and aiohttp sessions, so the scripts run unchanged against the mock
+    def rewrite(url):
+        url = str(url)
+        for host in GEOAPIFY_HOSTS:
+            if url.startswith(host):
+                return mock_url + url[len(host):]
+        return url
+
+    import requests
+    session_request = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        return session_request(self, method, rewrite(url), *args, **kwargs)
+
+    requests.Session.request = request
+
+    try:
+        import aiohttp
+    except ImportError:
+        return
+    client_request = aiohttp.ClientSession._request
+
+    async def _request(self, method, str_or_url, *args, **kwargs):
+        return await client_request(self, method, rewrite(str_or_url), *args, **kwargs)
+
+    aiohttp.ClientSession._request = _request
+
+
+def main():
+    # bench_runner.py MOCK_URL SCRIPT [ARGS...]: run a sample script with its API calls sent to MOCK_URL
+    mock_url, script, *args = sys.argv[1:]
+    redirect_requests(mock_url.rstrip('/'))
+    # Scripts that open their result in a browser must not do so during a benchmark
+    webbrowser.open = lambda *args, **kwargs: False
+    sys.argv = [script, *args]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
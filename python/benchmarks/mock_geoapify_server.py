@@ -0,0 +1,373 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+
+from aiohttp import web
+
+# Defaults of every endpoint, overridden per endpoint path with --endpoint_config
+DEFAULT_CONFIG = {
+    'latency_ms': 50,      # median latency
+    'latency_sigma': 0.5,  # spread of the log-normal latency distribution, 0 for a fixed latency
+    'rate_429': 0.0,       # share of requests answered with 429 and Retry-After
+    'rate_5xx': 0.0,       # share of requests answered with a random 500/502/503/504
+    'rate_drop': 0.0,      # share of requests whose connection is closed without a response
+    'retry_after': 1,      # Retry-After seconds of injected 429 responses
+    'rps_limit': 0,        # answer 429 above this many requests per second, 0 = no limit
+    'not_found_rate': 0.0  # share of geocoding requests without results
+}
+ENDPOINTS = ['/v1/geocode/search', '/v1/geocode/reverse', '/v1/batch/geocode/search', '/v2/places',
+             '/v1/staticmap', '/v1/tile/{style}/{z}/{x}/{y}', '/v1/isoline', '/v1/routing', '/v1/routeplanner']
+SERVER_ERRORS = (500, 502, 503, 504)
+# Raster tiles alternate between two colours like a checkerboard, so stitched tiles can be told apart
+TILE_COLORS = (b'\xe8\xe4\xd8', b'\xd0\xdc\xe8')
+PLACES_PER_CELL = 20
+BATCH_PENDING_POLLS = 1
+# Long waypoint lists of routing requests do not fit into the default request line limit
+MAX_LINE_SIZE = 2 ** 24
+
+
+class EndpointLimiter:
+    """Token bucket of one endpoint; requests without a token are answered with 429."""
+
+    def __init__(self, rps_limit):
+        self.rate = rps_limit
+        self.tokens = rps_limit
+        self.updated = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class MockGeoapifyServer:
+    """Local stand-in for the Geoapify APIs used by the Python samples.
+
+    Answers with synthetic but well-formed responses after a log-normal latency and injects 429, 5xx
+    and dropped connections at the configured rates. Responses for the same query are always the same.
+    Counts requests by endpoint and status, so a benchmark can read how many requests a run sent.
+    """
+
+    def __init__(self, config=None, endpoint_config=None, seed=1):
+        self.config = {**DEFAULT_CONFIG, **(config or {})}
+        self.endpoint_config = {endpoint: {**self.config, **(endpoint_config or {}).get(endpoint, {})}
+                                for endpoint in ENDPOINTS}
+        self.limiters = {endpoint: EndpointLimiter(config['rps_limit'])
+                         for endpoint, config in self.endpoint_config.items() if config['rps_limit']}
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.batch_jobs = {}
+        self.batch_ids = itertools.count(1)
+        self.runner = None
+        self.url = None
+
+    def stats(self):
+        # {(endpoint, status): count}, status 'drop' for closed connections
+        return dict(self.requests)
+
+    def make_app(self):
+        app = web.Application(middlewares=[self.inject_faults], client_max_size=2 ** 30)
+        app.router.add_get('/v1/geocode/search', self.geocode)
+        app.router.add_get('/v1/geocode/reverse', self.reverse_geocode)
+        app.router.add_post('/v1/batch/geocode/search', self.batch_submit)
+        app.router.add_get('/v1/batch/geocode/search', self.batch_result)
+        app.router.add_get('/v2/places', self.places)
+        app.router.add_get('/v1/staticmap', self.static_map)
+        app.router.add_get('/v1/tile/{style}/{z}/{x}/{y}', self.tile)
+        app.router.add_get('/v1/isoline', self.isoline)
+        app.router.add_get('/v1/routing', self.routing)
+        app.router.add_post('/v1/routeplanner', self.route_planner)
+        return app
+
+    @web.middleware
+    async def inject_faults(self, request, handler):
+        endpoint = endpoint_of(request)
+        config = self.endpoint_config.get(endpoint, self.config)
+        await asyncio.sleep(self.latency(config))
+        roll = self.random.random()
+        limiter = self.limiters.get(endpoint)
+        if roll < config['rate_drop']:
+            self.requests[endpoint, 'drop'] += 1
+            # The response is never sent, the client sees the connection closed
+            request.transport.close()
+            return web.Response(status=499)
+        roll -= config['rate_drop']
+        if roll < config['rate_429'] or (limiter and not limiter.allow()):
+            response = web.json_response({'statusCode': 429, 'error': 'Too Many Requests'}, status=429,
+                                         headers={'Retry-After': str(config['retry_after'])})
+        elif roll - config['rate_429'] < config['rate_5xx']:
+            status = self.random.choice(SERVER_ERRORS)
+            response = web.json_response({'statusCode': status, 'error': 'Injected server error'}, status=status)
+        else:
+            response = await handler(request)
+        self.requests[endpoint, response.status] += 1
+        return response
+
+    def latency(self, config):
+        median = config['latency_ms'] / 1000
+        if not config['latency_sigma']:
+            return median
+        return self.random.lognormvariate(math.log(median), config['latency_sigma']) if median else 0
+
+    def not_found(self, config):
+        return self.random.random() < config['not_found_rate']
+
+    async def geocode(self, request):
+        text = request.query.get('text', '')
+        if self.not_found(self.endpoint_config[request.path]):
+            return web.json_response({'results': []})
+        result = fake_address(text)
+        return web.json_response({'results': [result]} if request.query.get('format') == 'json'
+                                 else {'type': 'FeatureCollection', 'features': [as_feature(result)]})
+
+    async def reverse_geocode(self, request):
+        lat, lon = float(request.query['lat']), float(request.query['lon'])
+        result = fake_address(f'{lat:.5f},{lon:.5f}', lat, lon)
+        return web.json_response({'results': [result]} if request.query.get('format') == 'json'
+                                 else {'type': 'FeatureCollection', 'features': [as_feature(result)]})
+
+    async def batch_submit(self, request):
+        addresses = await request.json()
+        job_id = str(next(self.batch_ids))
+        self.batch_jobs[job_id] = [addresses, BATCH_PENDING_POLLS]
+        return web.json_response({'id': job_id, 'status': 'pending'}, status=202)
+
+    async def batch_result(self, request):
+        job = self.batch_jobs.get(request.query.get('id'))
+        if job is None:
+            return web.json_response({'statusCode': 404, 'error': 'Unknown job'}, status=404)
+        if job[1] > 0:
+            job[1] -= 1
+            return web.json_response({'id': request.query['id'], 'status': 'pending'}, status=202)
+        del self.batch_jobs[request.query['id']]
+        return web.json_response([{'query': {'text': address}, **fake_address(address)} for address in job[0]])
+
+    async def places(self, request):
+        min_lon, min_lat, max_lon, max_lat = map(float, request.query['filter'].removeprefix('rect:').split(','))
+        limit = int(request.query.get('limit', 20))
+        offset = int(request.query.get('offset', 0))
+        count = max(0, min(limit, PLACES_PER_CELL - offset))
+        seed = f'{min_lon},{min_lat}'
+        features = []
+        for i in range(offset, offset + count):
+            lon = min_lon + (max_lon - min_lon) * fraction(f'{seed}:{i}:lon')
+            lat = min_lat + (max_lat - min_lat) * fraction(f'{seed}:{i}:lat')
+            place = fake_address(f'{seed}:{i}', lat, lon)
+            place['categories'] = request.query.get('categories', '').split(',')
+            place['name'] = f'Place {i}'
+            features.append(as_feature(place))
+        return web.json_response({'type': 'FeatureCollection', 'features': features})
+
+    async def static_map(self, request):
+        # The same map has the same ETag whatever the API key, so conditional requests can be answered with 304
+        query = '&'.join(f'{name}={value}' for name, value in sorted(request.query.items()) if name != 'apiKey')
+        etag = f'"{zlib.crc32(query.encode()):08x}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=solid_png(int(request.query.get('width', 512)),
+                                           int(request.query.get('height', 512))),
+                            content_type='image/png', headers={'ETag': etag})
+
+    async def tile(self, request):
+        # 256 pixel raster tiles, 512 pixels for {y}@2x.png
+        z, x = int(request.match_info['z']), int(request.match_info['x'])
+        y, _, suffix = request.match_info['y'].partition('.')[0].partition('@')
+        if not 0 <= x < 2 ** z or not 0 <= int(y) < 2 ** z:
+            return web.json_response({'statusCode': 400, 'error': 'Tile out of range'}, status=400)
+        size = 512 if suffix == '2x' else 256
+        return web.Response(body=solid_png(size, size, TILE_COLORS[(x + int(y)) % 2]), content_type='image/png',
+                            headers={'Cache-Control': 'max-age=86400'})
+
+    async def isoline(self, request):
+        lat, lon = float(request.query['lat']), float(request.query['lon'])
+        radius = 0.01 * max(int(request.query.get('range', 900)), 1) / 900
+        ring = [[lon + radius * math.cos(a / 16 * 2 * math.pi), lat + radius * math.sin(a / 16 * 2 * math.pi)]
+                for a in range(17)]
+        return web.json_response({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature',
+            'properties': {'id': 'mock', 'mode': request.query.get('mode'), 'type': request.query.get('type'),
+                           'range': int(request.query.get('range', 900))},
+            'geometry': {'type': 'MultiPolygon', 'coordinates': [[ring]]}}]})
+
+    async def routing(self, request):
+        waypoints = [[float(value) for value in waypoint.removeprefix('lonlat:').split(',')]
+                     for waypoint in request.query['waypoints'].split('|')]
+        return web.json_response({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature',
+            'properties': {'mode': request.query.get('mode', 'drive'), 'waypoints': len(waypoints)},
+            'geometry': {'type': 'MultiLineString', 'coordinates': [waypoints]}}]})
+
+    async def route_planner(self, request):
+        body = await request.json()
+        agents = body.get('agents', [])
+        jobs = body.get('jobs', [])
+        # Jobs are dealt to the agents in input order
+        features = []
+        for agent_index, agent in enumerate(agents):
+            agent_jobs = list(range(agent_index, len(jobs), len(agents)))
+            waypoints = [{'location': jobs[job]['location'], 'actions': [{'type': 'job', 'job_index': job}]}
+                         for job in agent_jobs]
+            start = agent.get('start_location')
+            if start:
+                waypoints.insert(0, {'location': start, 'actions': [{'type': 'start'}, {'type': 'end'}]
+                                     if start == agent.get('end_location') else [{'type': 'start'}]})
+            features.append({'type': 'Feature',
+                             'properties': {'agent_index': agent_index, 'waypoints': waypoints,
+                                            'actions': [action for waypoint in waypoints
+                                                        for action in waypoint['actions']]},
+                             'geometry': {'type': 'MultiLineString',
+                                          'coordinates': [[waypoint['location'] for waypoint in waypoints]]}})
+        return web.json_response({'type': 'FeatureCollection', 'features': features,
+                                  'properties': {'mode': body.get('mode', 'drive'), 'issues': {}}})
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.make_app(), access_log=None, max_line_size=MAX_LINE_SIZE,
+                                    max_field_size=MAX_LINE_SIZE)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.url = f'http://{host}:{self.runner.addresses[0][1]}'
+        return self.url
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def start_in_thread(self, host='127.0.0.1', port=0):
+        # Serve from an own event loop in a daemon thread and return the base URL
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(self.start(host, port))
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=serve, daemon=True).start()
+        started.wait()
+        return self.url
+
+
+def fraction(key):
+    # Stable pseudo-random number in [0, 1) for a key
+    return zlib.crc32(key.encode()) / 2 ** 32
+
+
+def fake_address(query, lat=None, lon=None):
+    # Geocoding result with the fields and nesting of a real one
+    number = zlib.crc32(query.encode())
+    lat = lat if lat is not None else -60 + 130 * fraction(query + ':lat')
+    lon = lon if lon is not None else -180 + 360 * fraction(query + ':lon')
+    confidence = round(0.3 + 0.7 * fraction(query + ':confidence'), 3)
+    street, city = f'Mock Street {number % 997}', f'Mock City {number % 101}'
+    housenumber, postcode = str(number % 300 + 1), f'{number % 90000 + 10000}'
+    return {
+        'datasource': {'sourcename': 'openstreetmap', 'attribution': '© OpenStreetMap contributors',
+                       'license': 'Open Database License', 'url': 'https://www.openstreetmap.org/copyright'},
+        'country': 'Mockland', 'country_code': 'mk', 'state': 'Mock State', 'city': city,
+        'postcode': postcode, 'street': street, 'housenumber': housenumber,
+        'lon': lon, 'lat': lat, 'result_type': 'building',
+        'formatted': f'{street} {housenumber}, {postcode} {city}, Mockland',
+        'address_line1': f'{street} {housenumber}', 'address_line2': f'{postcode} {city}, Mockland',
+        'timezone': {'name': 'Europe/Berlin', 'offset_STD': '+01:00', 'offset_STD_seconds': 3600,
+                     'offset_DST': '+02:00', 'offset_DST_seconds': 7200,
+                     'abbreviation_STD': 'CET', 'abbreviation_DST': 'CEST'},
+        'rank': {'importance': 0.5, 'popularity': 5.0, 'confidence': confidence,
+                 'confidence_city_level': 1, 'confidence_street_level': min(1, confidence + 0.1),
+                 'confidence_building_level': confidence, 'match_type': 'full_match'},
+        'place_id': f'{number:08x}{zlib.crc32(query[::-1].encode()):08x}',
+        'bbox': {'lon1': lon - 0.0005, 'lat1': lat - 0.0005, 'lon2': lon + 0.0005, 'lat2': lat + 0.0005},
+    }
+
+
+def as_feature(result):
+    return {'type': 'Feature', 'properties': result,
+            'geometry': {'type': 'Point', 'coordinates': [result['lon'], result['lat']]}}
+
+
+def endpoint_of(request):
+    # Tiles are counted and configured by their route, not one path per tile
+    resource = request.match_info.route.resource
+    return resource.canonical if resource else request.path
+
+
+_png_cache = {}
+
+
+def solid_png(width, height, color=TILE_COLORS[0]):
+    # Valid single-colour RGB PNG of the requested size, built once per size and colour
+    if (width, height, color) not in _png_cache:
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+        row = b'\x00' + color * width
+        _png_cache[width, height, color] = (b'\x89PNG\r\n\x1a\n'
+                                            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+                                            + chunk(b'IDAT', zlib.compress(row * height))
+                                            + chunk(b'IEND', b''))
+    return _png_cache[width, height, color]
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--latency_ms', type=float, default=DEFAULT_CONFIG['latency_ms'],
+                        help=f"Median response latency in milliseconds (default: {DEFAULT_CONFIG['latency_ms']})")
+    parser.add_argument('--latency_sigma', type=float, default=DEFAULT_CONFIG['latency_sigma'],
+                        help='Spread of the log-normal latency distribution, 0 for a fixed latency '
+                             f"(default: {DEFAULT_CONFIG['latency_sigma']})")
+    parser.add_argument('--rate_429', type=float, default=0, help='Share of requests answered with 429')
+    parser.add_argument('--rate_5xx', type=float, default=0, help='Share of requests answered with a 5xx error')
+    parser.add_argument('--rate_drop', type=float, default=0,
+                        help='Share of requests whose connection is closed without a response')
+    parser.add_argument('--retry_after', type=float, default=DEFAULT_CONFIG['retry_after'],
+                        help='Retry-After seconds of injected 429 responses')
+    parser.add_argument('--rps_limit', type=float, default=0,
+                        help='Answer 429 above this many requests per second per endpoint (default: no limit)')
+    parser.add_argument('--not_found_rate', type=float, default=0,
+                        help='Share of geocoding requests answered without results')
+    parser.add_argument('--endpoint_config', type=str,
+                        help='JSON file with settings per endpoint path, e.g. {"/v1/staticmap": {"latency_ms": 300}}')
+
+
+def server_config(args):
+    config = {name: getattr(args, name) for name in DEFAULT_CONFIG}
+    endpoint_config = None
+    if args.endpoint_config:
+        with open(args.endpoint_config, 'r') as f:
+            endpoint_config = json.load(f)
+    return config, endpoint_config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Geoapify APIs used by the Python samples.')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    config, endpoint_config = server_config(args)
+    server = MockGeoapifyServer(config, endpoint_config)
+
+    async def serve():
+        print(f'Mock Geoapify server listening on {await server.start(args.host, args.port)}', flush=True)
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
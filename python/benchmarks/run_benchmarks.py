@@ -0,0 +1,227 @@
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+from mock_geoapify_server import MockGeoapifyServer, add_server_arguments, server_config
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLES_DIR = os.path.dirname(BENCHMARKS_DIR)
+RUNNER = os.path.join(BENCHMARKS_DIR, 'bench_runner.py')
+API_KEY = 'BENCHMARK_KEY'
+DEFAULT_SIZES = [1000]
+RESULT_FIELDS = ['started_at', 'label', 'commit', 'scenario', 'size', 'exit_code', 'wall_seconds',
+                 'cpu_user_seconds', 'cpu_system_seconds', 'peak_rss_mb', 'requests', 'requests_per_second',
+                 'rows_per_second', 'statuses', 'latency_ms', 'latency_sigma', 'rate_429', 'rate_5xx', 'rate_drop']
+
+# Scenario: script, kind of synthetic input (None for scripts without an input file) and arguments.
+# {input} and {output} are paths in the work directory, the other placeholders come from the command line
+SCENARIOS = {
+    'geocode_threads': ('geocode_addresses/geocode_addresses.py', 'addresses',
+                        '--input {input} --output {output}.ndjson --engine threads --max_workers {workers} '
+                        '--requests_per_second {rps} --burst {burst}'),
+    'geocode_asyncio': ('geocode_addresses/geocode_addresses.py', 'addresses',
+                        '--input {input} --output {output}.ndjson --engine asyncio --concurrency {concurrency} '
+                        '--requests_per_second {rps} --burst {burst}'),
+    'geocode_batch': ('geocode_addresses/geocode_addresses.py', 'addresses',
+                      '--input {input} --output {output}.ndjson --batch_api --requests_per_second {rps}'),
+    'reverse_threads': ('reverse-geocoding/reverse_geocode.py', 'coordinates',
+                        '--input {input} --output {output}.ndjson --engine threads --max_workers {workers} '
+                        '--requests_per_second {rps} --burst {burst}'),
+    'reverse_asyncio': ('reverse-geocoding/reverse_geocode.py', 'coordinates',
+                        '--input {input} --output {output}.ndjson --engine asyncio --concurrency {concurrency} '
+                        '--requests_per_second {rps} --burst {burst}'),
+    'places': ('query-points-of-interest-with-places-api/fetch_places.py', 'grid',
+               '--bbox {input} --categories catering.cafe --grid_size 1 --output {output}.ndjson'),
+    'static_maps': ('create-map-preview-with-static-maps/generate_map_previews.py', 'coordinates',
+                    '--input {input} --output {output}_previews --size 256x256 --concurrency {concurrency} '
+                    '--requests_per_second {rps} --burst {burst}'),
+    'map_tiles': ('create-map-preview-with-static-maps/generate_map_previews.py', 'coordinates',
+                  '--input {input} --output {output}_tiles --size 256x256 --renderer tiles '
+                  '--tile_cache_dir {output}_tile_cache --concurrency {concurrency} '
+                  '--requests_per_second {rps} --burst {burst}'),
+    'isoline': ('calculate-and-visualize-isoline/show_isoline.py', None,
+                '--lat 28.293067 --lon -81.550409 --type time --mode drive --range 900 --output {output}.html'),
+    'routing': ('optimize-route-with-route-planner-api/optimal_route.py', 'coordinates',
+                '--input {input} --output {output}.txt --map {output}.html --start_location 50.0,10.0'),
+    'route_planner': ('route-planner/route_planner.py', 'route_request',
+                      '--input {input} --output {output}_plans'),
+}
+ROUTE_PLANNER_AGENTS = 10
+
+
+def write_addresses(path, size):
+    rng = random.Random(size)
+    with open(path, 'w') as f:
+        for i in range(size):
+            f.write(f'{rng.randint(1, 300)} Benchmark Street {i}, {rng.randint(10000, 99999)} Town {i % 1000}\n')
+
+
+def write_coordinates(path, size):
+    rng = random.Random(size)
+    with open(path, 'w') as f:
+        for _ in range(size):
+            f.write(f'{rng.uniform(48, 54):.6f},{rng.uniform(6, 14):.6f}\n')
+
+
+def write_route_request(path, size):
+    rng = random.Random(size)
+    request = {'mode': 'drive',
+               'agents': [{'start_location': [rng.uniform(6, 14), rng.uniform(48, 54)]}
+                          for _ in range(ROUTE_PLANNER_AGENTS)],
+               'jobs': [{'location': [rng.uniform(6, 14), rng.uniform(48, 54)]} for _ in range(size)]}
+    with open(path, 'w') as f:
+        json.dump(request, f)
+
+
+def grid_bbox(size):
+    # Bounding box at the equator that fetch_places.py splits into about `size` cells of 1 km
+    cells_per_side = math.ceil(math.sqrt(size))
+    degrees = cells_per_side / 111
+    return f'0 0 {degrees:.6f} {degrees:.6f}'
+
+
+INPUT_WRITERS = {
+    'addresses': ('addresses_{size}.txt', write_addresses),
+    'coordinates': ('coordinates_{size}.txt', write_coordinates),
+    'route_request': ('route_request_{size}.json', write_route_request),
+}
+
+
+def prepare_input(kind, size, work_dir):
+    # Synthetic inputs are generated once per size and reused by later runs
+    if kind is None:
+        return ''
+    if kind == 'grid':
+        return grid_bbox(size)
+    file_name, write = INPUT_WRITERS[kind]
+    path = os.path.join(work_dir, file_name.format(size=size))
+    if not os.path.exists(path):
+        write(path, size)
+    return path
+
+
+def run_script(python, mock_url, script, args, log_file):
+    # Run the script in a child process and collect its wall time, CPU time and peak RSS
+    command = [python, RUNNER, mock_url, os.path.join(SAMPLES_DIR, script), *args]
+    started = time.monotonic()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(log_file))
+        _, status, usage = os.wait4(process.pid, 0)
+    wall = time.monotonic() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return process.returncode, wall, usage.ru_utime, usage.ru_stime, peak_rss
+
+
+def request_counts(before, after):
+    statuses = Counter()
+    for (_, status), count in after.items():
+        statuses[status] += count
+    for (_, status), count in before.items():
+        statuses[status] -= count
+    return +statuses
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SAMPLES_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def append_results(results_file, rows):
+    new_file = not os.path.exists(results_file)
+    with open(results_file, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_benchmarks(scenarios, sizes, work_dir, results_file, server, options, python=sys.executable, label=''):
+    os.makedirs(work_dir, exist_ok=True)
+    mock_url = server.start_in_thread()
+    commit = git_commit()
+    rows = []
+    for name in scenarios:
+        script, input_kind, arguments = SCENARIOS[name]
+        # Scripts without an input file run once, whatever the sizes
+        for size in sizes if input_kind else [1]:
+            input_value = prepare_input(input_kind, size, work_dir)
+            output = os.path.join(work_dir, f'{name}_{size}')
+            args = shlex.split(arguments.format(output=shlex.quote(output), **options,
+                                                input=input_value if input_kind == 'grid' else shlex.quote(input_value)))
+            args += ['--api_key', API_KEY]
+
+            print(f'Running {name} with {size} rows', flush=True)
+            before = server.stats()
+            started_at = datetime.now(timezone.utc).isoformat(timespec='seconds')
+            exit_code, wall, cpu_user, cpu_system, peak_rss = run_script(python, mock_url, script, args,
+                                                                         output + '.log')
+            statuses = request_counts(before, server.stats())
+            requests = sum(statuses.values())
+            row = {'started_at': started_at, 'label': label, 'commit': commit, 'scenario': name, 'size': size,
+                   'exit_code': exit_code, 'wall_seconds': round(wall, 3),
+                   'cpu_user_seconds': round(cpu_user, 3), 'cpu_system_seconds': round(cpu_system, 3),
+                   'peak_rss_mb': round(peak_rss, 1), 'requests': requests,
+                   'requests_per_second': round(requests / wall, 1), 'rows_per_second': round(size / wall, 1),
+                   'statuses': ' '.join(f'{status}:{count}' for status, count in sorted(statuses.items(), key=str)),
+                   **{setting: server.config[setting] for setting in RESULT_FIELDS[-5:]}}
+            if exit_code:
+                print(f'{name} exited with {exit_code}, see {output}.log', flush=True)
+            rows.append(row)
+            append_results(results_file, [row])
+    return rows
+
+
+def print_table(rows):
+    columns = ['scenario', 'size', 'exit_code', 'wall_seconds', 'rows_per_second', 'requests_per_second',
+               'cpu_user_seconds', 'peak_rss_mb', 'statuses']
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Python samples against a local mock Geoapify server.')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='Scenarios to run (default: all)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Input rows per run, e.g. 1000 100000 1000000 (default: 1000)')
+    parser.add_argument('--work_dir', default='benchmark_work', help='Directory for inputs, outputs and logs')
+    parser.add_argument('--results', default='benchmark_results.csv',
+                        help='CSV file the results are appended to (default: benchmark_results.csv)')
+    parser.add_argument('--label', default='', help='Label stored with the results, e.g. the change under test')
+    parser.add_argument('--python', default=sys.executable, help='Python interpreter running the scripts')
+    parser.add_argument('--rps', type=float, default=1000,
+                        help='--requests_per_second passed to the scripts (default: 1000)')
+    parser.add_argument('--burst', type=int, default=50, help='--burst passed to the scripts (default: 50)')
+    parser.add_argument('--workers', type=int, default=50, help='--max_workers passed to the scripts (default: 50)')
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='--concurrency passed to the scripts (default: 100)')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    config, endpoint_config = server_config(args)
+    server = MockGeoapifyServer(config, endpoint_config)
+    options = {'rps': args.rps, 'burst': args.burst, 'workers': args.workers, 'concurrency': args.concurrency}
+    rows = run_benchmarks(args.scenarios, args.sizes, os.path.abspath(args.work_dir), args.results, server, options,
+                          args.python, args.label)
+    print_table(rows)
+    print(f'Results appended to {args.results}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# A request sent again after one of these statuses (or a connection error) counts as a retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+METRIC_PREFIX = 'geoapify'
+# Failed requests remembered to recognize their retries; requests that are never sent again are forgotten
+# once this many newer ones have failed, so memory use stays bounded on long runs
+MAX_FAILED_REQUESTS = 10_000
+
+
+class EndpointStats:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.requests = 0
+        self.statuses = Counter()
+        self.retries = 0
+        self.backoff_seconds = 0.0
+
+    def latency_quantile(self, quantile):
+        # Upper bound of the bucket that holds the quantile, None if it is above the last bucket
+        rank = quantile * self.requests
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+
+class RunMetrics:
+    """Request and throughput metrics of one run, written as a Prometheus textfile and a JSON summary.
+
+    HttpClient (`metrics=`) and aiohttp sessions (`trace_configs=[metrics.trace_config()]`) report every
+    request: its latency per endpoint (until the full response for requests, until the response headers
+    for aiohttp), its status code ('error' for connection errors and timeouts) and the requests in flight.
+    A request sent again with the same method, URL and parameters after a failure counts as a retry of its
+    endpoint, and the time since the failure as backoff. Scripts report finished items with `record_items()`.
+    """
+
+    def __init__(self, job, output=None, interval=0):
+        self.job = job
+        self.output = output
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.failed_requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.items = 0
+        self.gauges = {}
+        self.started = time.monotonic()
+        self.started_cpu = time.process_time()
+        self.stopped = threading.Event()
+        self.snapshot_thread = None
+
+    def request_started(self, method, url, params=None):
+        endpoint = urlsplit(str(url)).path or '/'
+        request_id = (method, str(url), request_params(params))
+        started = time.monotonic()
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failed_at = self.failed_requests.pop(request_id, None)
+            if failed_at is not None:
+                stats = self.endpoint(endpoint)
+                stats.retries += 1
+                stats.backoff_seconds += started - failed_at
+        return endpoint, request_id, started
+
+    def request_finished(self, request, status=None):
+        endpoint, request_id, started = request
+        finished = time.monotonic()
+        latency = finished - started
+        with self.lock:
+            self.in_flight -= 1
+            stats = self.endpoint(endpoint)
+            stats.requests += 1
+            stats.latency_sum += latency
+            stats.bucket_counts[bucket_index(latency)] += 1
+            stats.statuses[status or 'error'] += 1
+            if status is None or status in RETRY_STATUSES:
+                # Dicts keep insertion order, the first entry is the oldest failure
+                self.failed_requests.pop(request_id, None)
+                self.failed_requests[request_id] = finished
+                if len(self.failed_requests) > MAX_FAILED_REQUESTS:
+                    del self.failed_requests[next(iter(self.failed_requests))]
+
+    def endpoint(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        return stats
+
+    def record_items(self, count=1):
+        with self.lock:
+            self.items += count
+
+    def add_gauge(self, name, help_text, value):
+        # `value` is called every time the metrics are written
+        self.gauges[name] = (help_text, value)
+
+    def watch_rate(self, rate_limiter):
+        # Works for a RateLimiter and a KeyPool
+        if rate_limiter:
+            self.add_gauge('rate_limit_requests_per_second', 'Current rate of the adaptive rate limiter',
+                           lambda: rate_limiter.rate)
+            self.add_gauge('throttled_requests', 'Requests answered with HTTP 429',
+                           lambda: rate_limiter.throttled_count)
+
+    def trace_config(self):
+        # Imported here, so scripts using only requests do not need aiohttp
+        from aiohttp import TraceConfig
+
+        async def on_request_start(session, context, params):
+            context.request = self.request_started(params.method, params.url.with_query(None), params.url.query)
+
+        async def on_request_end(session, context, params):
+            self.request_finished(context.request, params.response.status)
+
+        async def on_request_exception(session, context, params):
+            self.request_finished(context.request)
+
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def summary(self):
+        duration = time.monotonic() - self.started
+        with self.lock:
+            endpoints = {
+                endpoint: {
+                    'requests': stats.requests,
+                    'statuses': {str(status): count for status, count in sorted(stats.statuses.items(), key=str)},
+                    'retries': stats.retries,
+                    'backoff_seconds': round(stats.backoff_seconds, 3),
+                    'latency_mean_seconds': round(stats.latency_sum / stats.requests, 4) if stats.requests else None,
+                    'latency_p50_seconds_le': stats.latency_quantile(0.5),
+                    'latency_p90_seconds_le': stats.latency_quantile(0.9),
+                    'latency_p99_seconds_le': stats.latency_quantile(0.99),
+                }
+                for endpoint, stats in sorted(self.endpoints.items())
+            }
+            summary = {
+                'job': self.job,
+                'duration_seconds': round(duration, 3),
+                'cpu_seconds': round(time.process_time() - self.started_cpu, 3),
+                'items': self.items,
+                'items_per_second': round(self.items / duration, 3) if duration else 0,
+                'requests_in_flight': self.in_flight,
+                'max_requests_in_flight': self.max_in_flight,
+                'endpoints': endpoints,
+            }
+        summary.update({name: value() for name, (_, value) in self.gauges.items()})
+        return summary
+
+    def prometheus_text(self):
+        labels = f'job="{escape_label(self.job)}"'
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            name = f'{METRIC_PREFIX}_{name}'
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for suffix, sample_labels, value in samples:
+                lines.append(f'{name}{suffix}{{{",".join([labels, *sample_labels])}}} {value}')
+
+        duration = time.monotonic() - self.started
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            requests, latency, retries, backoff = [], [], [], []
+            for endpoint, stats in endpoints:
+                endpoint_label = f'endpoint="{escape_label(endpoint)}"'
+                for status, count in sorted(stats.statuses.items(), key=str):
+                    requests.append(('', [endpoint_label, f'status="{status}"'], count))
+                cumulative = 0
+                for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), stats.bucket_counts):
+                    cumulative += count
+                    latency.append(('_bucket', [endpoint_label, f'le="{bound}"'], cumulative))
+                latency.append(('_sum', [endpoint_label], stats.latency_sum))
+                latency.append(('_count', [endpoint_label], stats.requests))
+                retries.append(('', [endpoint_label], stats.retries))
+                backoff.append(('', [endpoint_label], stats.backoff_seconds))
+
+            metric('requests_total', 'counter', 'HTTP requests by endpoint and status code', requests)
+            metric('request_duration_seconds', 'histogram', 'HTTP request latency by endpoint', latency)
+            metric('retries_total', 'counter', 'Requests sent again after a failure', retries)
+            metric('retry_backoff_seconds_total', 'counter', 'Time between failed requests and their retries',
+                   backoff)
+            metric('requests_in_flight', 'gauge', 'HTTP requests waiting for a response', [('', [], self.in_flight)])
+            metric('requests_in_flight_max', 'gauge', 'Most HTTP requests in flight at once',
+                   [('', [], self.max_in_flight)])
+            metric('items_total', 'counter', 'Items written to the output', [('', [], self.items)])
+            metric('items_per_second', 'gauge', 'Items written per second since the start of the run',
+                   [('', [], self.items / duration if duration else 0)])
+        metric('run_duration_seconds', 'gauge', 'Wall time since the start of the run', [('', [], duration)])
+        metric('cpu_seconds_total', 'counter', 'CPU time used by the process since the start of the run',
+               [('', [], time.process_time() - self.started_cpu)])
+        for name, (help_text, value) in self.gauges.items():
+            metric(name, 'gauge', help_text, [('', [], value())])
+        metric('last_update_timestamp_seconds', 'gauge', 'Unix time the metrics were written',
+               [('', [], time.time())])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output=None):
+        # <output>.prom for the Prometheus textfile collector and <output>.json;
+        # both are replaced atomically, so a reader never sees a partial file
+        output = output or self.output
+        write_atomic(output + '.prom', self.prometheus_text())
+        write_atomic(output + '.json', json.dumps(self.summary(), indent=2) + '\n')
+
+    def start_snapshots(self):
+        # Rewrite the files every `interval` seconds while the run goes on
+        if not self.output or not self.interval:
+            return
+
+        def write_snapshots():
+            while not self.stopped.wait(self.interval):
+                self.write()
+
+        self.snapshot_thread = threading.Thread(target=write_snapshots, daemon=True)
+        self.snapshot_thread.start()
+
+    def close(self):
+        # Stop the snapshots and write the final metrics
+        self.stopped.set()
+        if self.snapshot_thread:
+            self.snapshot_thread.join()
+        if self.output:
+            self.write()
+
+
+def bucket_index(latency):
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if latency <= bound:
+            return index
+    return len(LATENCY_BUCKETS)
+
+
+def request_params(params):
+    # Query parameters without the API key, so a retry with another key of a key pool is still a retry
+    if not params:
+        return ()
+    items = params.items() if hasattr(params, 'items') else params
+    if isinstance(items, (str, bytes)):
+        return items
+    return tuple(sorted((str(name), str(value)) for name, value in items if name != 'apiKey'))
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(path, text):
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as f:
+        f.write(text)
+    os.replace(temp_file, path)
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics_output', type=str,
+                        help='Write run metrics to METRICS_OUTPUT.prom (Prometheus textfile format) '
+                             'and METRICS_OUTPUT.json at the end of the run')
+    parser.add_argument('--metrics_interval', type=float, default=0,
+                        help='Also write the metrics every N seconds during the run (0 = only at the end)')
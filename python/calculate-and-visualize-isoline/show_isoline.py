@@ -2,7 +2,9 @@ import argparse
 import webbrowser
 
 import folium
-import requests
+
+from http_client import HttpClient
+from run_metrics import RunMetrics, add_metrics_arguments
 
 # Define base URL for Geoapify
 BASE_MAP_TILE_URL = "https://maps.geoapify.com/v1/tile/{map_style}/{{z}}/{{x}}/{{y}}@2x.png?apiKey={api_key}"
@@ -11,7 +13,7 @@ def fetch_isoline(lat, lon,
                   type_, mode, range_,
                   avoid=None, traffic="free_flow", route_type="balanced", max_speed=None,
                   units="metric",
-                  api_key=None):
+                  api_key=None, client=None):
     """Fetch isoline data from Geoapify API."""
     url = "https://api.geoapify.com/v1/isoline"
 
@@ -34,7 +36,8 @@ def fetch_isoline(lat, lon,
     if max_speed:
         params["max_speed"] = max_speed
 
-    response = requests.get(url, params=params)
+    client = client or HttpClient(pool_size=1)
+    response = client.get(url, params=params)
 
     if response.status_code == 200:
         # Return isoline for on success
@@ -99,9 +102,15 @@ def main():
                         help="Distance measurement system.")
     parser.add_argument("--output", type=str, default="map.html", help="Path to save the generated HTML file.")
     parser.add_argument('--api_key', required=True, type=str, help='Geoapify API KEY')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
+    # Request latency, status codes and retries of the run
+    metrics = RunMetrics('show_isoline', args.metrics_output, args.metrics_interval)
+    metrics.start_snapshots()
+    client = HttpClient(pool_size=1, metrics=metrics)
+
     try:
         # Fetch isoline data
         isoline_data = fetch_isoline(
@@ -115,14 +124,19 @@ def main():
             route_type=args.route_type,
             max_speed=args.max_speed,
             units=args.units,
-            api_key=args.api_key
+            api_key=args.api_key,
+            client=client
         )
+        metrics.record_items()
 
         # Render the map
         render_map(args.lat, args.lon, isoline_data, args.output, args.api_key)
 
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        client.close()
+        metrics.close()
 
 
 if __name__ == "__main__":
@@ -4,6 +4,7 @@ This script generates an interactive map using the Geoapify Maps API and display
 Dependencies:
 - folium
 - requests
+- http_client.py (pooled HTTP client with timeouts and retries, in this folder)
 
 To install the required libraries, run:
 pip install folium requests
@@ -24,7 +25,8 @@ import sys
 import webbrowser
 
 import folium
-import requests
+
+from http_client import HttpClient
 
 # Define base URL for Geoapify
 BASE_URL = "https://maps.geoapify.com/v1/tile/{map_style}/{{z}}/{{x}}/{{y}}@2x.png?apiKey={api_key}"
@@ -76,8 +78,10 @@ def main():
     args = parser.parse_args()
 
     # Validate the map style by making a request to the Geoapify API
-    response = requests.get(BASE_URL.format(map_style=args.style,
-                                            api_key=args.api_key).replace('{z}/{x}/{y}', '0/0/0'))
+    client = HttpClient(pool_size=1)
+    response = client.get(BASE_URL.format(map_style=args.style,
+                                          api_key=args.api_key).replace('{z}/{x}/{y}', '0/0/0'))
+    client.close()
     if response.status_code == 400:
         print(f"Error: Possible issue with incorrect map style. Falling back to default 'osm-carto'.")
         args.style = 'osm-carto'
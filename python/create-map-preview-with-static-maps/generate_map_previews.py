@@ -1,48 +1,167 @@
 import argparse
 import asyncio
-import itertools
+import csv
 import logging
 import os
+from time import monotonic
 
 import aiofiles
-from aiohttp import ClientSession
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
 from aiohttp.client_exceptions import ClientError
 
+from image_archive import DEFAULT_SHARD_SIZE_MB, ImageArchive
+from image_cache import DEFAULT_TTL_DAYS, ImageCache
+from map_groups import DEFAULT_MAX_MARKERS, MARKER_MARGIN, group_points
+from postprocess import DEFAULT_IMAGE_FORMAT, DEFAULT_QUALITY, IMAGE_FORMATS, PostProcessor, check_image_format
+from rate_limiter import RateLimiter, parse_retry_after
+from run_metrics import RunMetrics, add_metrics_arguments
+from tile_renderer import TileCache, TileFetchError, TileRenderer
+
 # Constants
 GEOAPIFY_STATIC_MAP_API_URL = "https://maps.geoapify.com/v1/staticmap"
 REQUESTS_PER_SECOND = 5
+BURST = 1
+CONCURRENCY = 10
 RETRY_ATTEMPTS = 3
+MANIFEST_FILE = "manifest.csv"
+RENDERERS = ["static_maps", "tiles"]
+TILE_CACHE_DIR = "tile_cache"
+# Seconds to connect and between two reads of a response, so a stalled request doesn't hold its slot forever
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
 
 logging.basicConfig(level='INFO')
 logger = logging.getLogger(__name__)
 
-async def fetch_map(session, api_key, lat, lon, index, output_dir, zoom, size, style):
+def marker(lat, lon):
+    return f"lonlat:{lon},{lat};type:awesome;color:#ff4040;size:large"
+
+
+def map_params(api_key, lat, lon, zoom, size, style):
     # Construct the request URL
     width, height = size.split('x')
-    params = {
+    return {
         "style": style,
         "width": width,
         "height": height,
         "zoom": zoom,
-        "marker": f"lonlat:{lon},{lat};type:awesome;color:#ff4040;size:large",
+        "marker": marker(lat, lon),
         "apiKey": api_key
     }
 
-    filename = f"{index}_{lat}_{lon}.png"
-    filepath = os.path.join(output_dir, filename)
+
+def group_params(api_key, group, zoom, size, style):
+    # One map centred on the group, with a marker for each of its points
+    params = map_params(api_key, group.lat, group.lon, zoom, size, style)
+    params["center"] = f"lonlat:{group.lon},{group.lat}"
+    params["marker"] = "|".join(marker(lat, lon) for _, lat, lon, _, _ in group.markers)
+    return params
+
+
+def single_maps(api_key, input_file, order, zoom, size, style):
+    # One map per input point: its name, request parameters, centre and marked points
+    for index, lat, lon in read_coordinates(input_file, order):
+        yield f"{index}_{lat}_{lon}.png", map_params(api_key, lat, lon, zoom, size, style), lat, lon, [(lat, lon)]
+
+
+def grouped_maps(api_key, input_file, order, zoom, size, style, max_markers, manifest_file):
+    # One map per group of points that fit into one image; the manifest tells where each point ended up
+    width, height = map(int, size.split('x'))
+    groups = group_points(read_coordinates(input_file, order), zoom, width, height, max_markers)
+    write_manifest(manifest_file, groups)
+    logger.info(f"Grouped {sum(len(group.markers) for group in groups)} points into {len(groups)} maps, "
+                f"see {manifest_file}")
+    for group in groups:
+        yield (group.name, group_params(api_key, group, zoom, size, style), group.lat, group.lon,
+               [(lat, lon) for _, lat, lon, _, _ in group.markers])
+
+
+def write_manifest(manifest_file, groups):
+    rows = sorted((index, lat, lon, group.name, x, y) for group in groups for index, lat, lon, x, y in group.markers)
+    with open(manifest_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['index', 'lat', 'lon', 'image', 'x', 'y'])
+        writer.writerows(rows)
+
+
+def read_coordinates(input_file, order):
+    # Lines are read one at a time, so memory use doesn't grow with the input
+    with open(input_file, 'r') as f:
+        for index, line in enumerate(f, start=1):
+            try:
+                if order == 'latlon':
+                    lat, lon = map(float, line.split(','))
+                elif order == 'lonlat':
+                    lon, lat = map(float, line.split(','))
+            except ValueError:
+                print(f"Invalid line in input file: {line.strip()}")
+                continue
+            yield index, lat, lon
+
+
+async def save_map(name, output_dir, content=None, cache=None, key=None, archive=None, postprocessor=None):
+    # Store the image as its own file or in the archive and return where it went; without content, the
+    # cached image is used
+    if postprocessor:
+        # Thumbnails are rendered in another process, the file or archive write below doesn't wait for it
+        thumbnails = asyncio.ensure_future(postprocessor.process(name, cache.path(key) if content is None
+                                                                 else content))
+    if archive:
+        if content is None:
+            await archive.add_file(name, cache.path(key))
+        else:
+            await archive.add(name, content)
+        location = f"{name} in {output_dir}"
+    else:
+        location = os.path.join(output_dir, name)
+        if cache:
+            await cache.link(key, location)
+        else:
+            # write png to file
+            async with aiofiles.open(location, 'wb') as f:
+                await f.write(content)
+    if postprocessor:
+        await thumbnails
+    return location
+
+
+async def fetch_map(session, params, lat, lon, name, output_dir, rate_limiter, metrics, cache=None, archive=None,
+                    postprocessor=None):
+    # A stale cached image is revalidated: the server answers 304 without the image when it is unchanged
+    key = cache.make_key(params) if cache else None
+    cached = await cache.lookup(key) if cache else None
+    headers = {'If-None-Match': cached[1]} if cached and cached[1] else None
 
     for attempt in range(RETRY_ATTEMPTS):  # Retry up to 3 times
+        # Every attempt, retries included, waits for a token of the shared rate limiter
+        await rate_limiter.acquire_async()
+        started = monotonic()
         try:
-            async with session.get(GEOAPIFY_STATIC_MAP_API_URL, params=params) as response:
+            async with session.get(GEOAPIFY_STATIC_MAP_API_URL, params=params, headers=headers) as response:
+                if response.status in (200, 304):
+                    rate_limiter.record_success(monotonic() - started)
+                if response.status == 304 and cached:
+                    await cache.refresh(key, response.headers.get('ETag'))
+                    location = await save_map(name, output_dir, cache=cache, key=key, archive=archive,
+                                              postprocessor=postprocessor)
+                    logger.info(f"Map for {lat}, {lon} is unchanged, saved cached map to {location}")
+                    metrics.record_items()
+                    return
                 if response.status == 200:
-                    # write png to file
-                    async with aiofiles.open(filepath, 'wb') as f:
-                        await f.write(await response.read())
-                    logger.info(f"Saved map to {filepath}")
+                    content = await response.read()
+                    if cache:
+                        await cache.put(key, content, response.headers.get('ETag'))
+                    location = await save_map(name, output_dir, content, cache, key, archive, postprocessor)
+                    logger.info(f"Saved map to {location}")
+                    metrics.record_items()
                     return
-                else:
-                    logger.error(f"Failed to fetch map for {lat}, {lon} (status: {response.status})")
-        except ClientError as e:
+                if response.status == 429:
+                    # Slow down and pause all requests for Retry-After seconds, the limiter delays the retry
+                    rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                    logger.warning(f"Rate limit exceeded for {lat}, {lon}, retrying ({attempt + 1}/{RETRY_ATTEMPTS})")
+                    continue
+                logger.error(f"Failed to fetch map for {lat}, {lon} (status: {response.status})")
+        except (ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Request error for {lat}, {lon}: {e}")
 
         await asyncio.sleep(1)  # Wait before retrying
@@ -50,34 +169,116 @@ async def fetch_map(session, api_key, lat, lon, index, output_dir, zoom, size, s
     logger.error(f"Skipping {lat}, {lon} after {RETRY_ATTEMPTS} failed attempts")
 
 
-async def main(api_key, input_file, output_dir, zoom, size, style, order):
+async def render_map(renderer, lat, lon, points, name, output_dir, metrics, archive=None, postprocessor=None):
+    # Stitch the preview from cached raster tiles, downloading the missing ones
+    try:
+        content = await renderer.render(lat, lon, points)
+    except TileFetchError as e:
+        logger.error(f"Skipping {lat}, {lon}: {e}")
+        return
+    location = await save_map(name, output_dir, content, archive=archive, postprocessor=postprocessor)
+    logger.info(f"Rendered map to {location}")
+    metrics.record_items()
+
+
+async def main(api_key, input_file, output_dir, zoom, size, style, order, metrics_output=None, metrics_interval=0,
+               cache_dir=None, cache_ttl_days=DEFAULT_TTL_DAYS, requests_per_second=REQUESTS_PER_SECOND, burst=BURST,
+               concurrency=CONCURRENCY, archive=False, shard_size_mb=DEFAULT_SHARD_SIZE_MB, thumbnail_sizes=(),
+               image_format=DEFAULT_IMAGE_FORMAT, quality=DEFAULT_QUALITY, collage_columns=0, collage_rows=0,
+               postprocess_workers=None, group_markers=False, max_markers=DEFAULT_MAX_MARKERS, renderer='static_maps',
+               tile_cache_dir=TILE_CACHE_DIR):
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    # Read coordinates from the input file
-    with open(input_file, 'r') as f:
-        lines = f.readlines()
+    # Request latency, status codes, retries and throughput of the run
+    metrics = RunMetrics('generate_map_previews', metrics_output, metrics_interval)
+    metrics.start_snapshots()
 
-    coros = []
-    async with ClientSession() as session:
-        # Extract coordinates with index
-        for index, line in enumerate(lines, start=1):
-            try:
-                if order == 'latlon':
-                    lat, lon = map(float, line.split(','))
-                elif order == 'lonlat':
-                    lon, lat = map(float, line.split(','))
-                coros.append(fetch_map(session, api_key, lat, lon, index, output_dir, zoom, size, style))
-            except ValueError:
-                print(f"Invalid line in input file: {line.strip()}")
+    # Images of previous runs are reused whatever their input line, only missing or stale ones are requested
+    cache = ImageCache(cache_dir, cache_ttl_days) if cache_dir else None
+    # Images appended to a few large shard files instead of one file each
+    archive = ImageArchive(output_dir, shard_size_mb) if archive else None
 
-        # Start 5 tasks per second
-        coros = itertools.batched(coros, REQUESTS_PER_SECOND)
+    async def save_thumbnail(name, content):
+        await save_map(name, output_dir, content, archive=archive)
+
+    # Resizing and encoding run on all cores while the event loop goes on fetching
+    postprocessor = None
+    if thumbnail_sizes:
+        postprocessor = PostProcessor(save_thumbnail, thumbnail_sizes, image_format, quality, collage_columns,
+                                      collage_rows, postprocess_workers)
+
+    # Request starts, retries included, are paced by one token bucket that backs off on HTTP 429
+    rate_limiter = RateLimiter(requests_per_second, burst)
+    metrics.watch_rate(rate_limiter)
+    # At most `concurrency` maps are requested at once, waits before retries included
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(params, lat, lon, name):
+        try:
+            await fetch_map(session, params, lat, lon, name, output_dir, rate_limiter, metrics, cache, archive,
+                            postprocessor)
+        finally:
+            semaphore.release()
+
+    async def render(lat, lon, points, name):
+        try:
+            await render_map(tile_renderer, lat, lon, points, name, output_dir, metrics, archive, postprocessor)
+        finally:
+            semaphore.release()
+
+    async def save_cached(name, key):
+        try:
+            await save_map(name, output_dir, cache=cache, key=key, archive=archive, postprocessor=postprocessor)
+            metrics.record_items()
+        finally:
+            semaphore.release()
+
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    connector = TCPConnector(limit=concurrency)
+    async with ClientSession(timeout=timeout, connector=connector,
+                             trace_configs=[metrics.trace_config()]) as session:
+        # Previews cut from raster tiles that are downloaded once and shared by all nearby previews
+        tile_cache = TileCache(tile_cache_dir) if renderer == 'tiles' else None
+        if tile_cache:
+            width, height = map(int, size.split('x'))
+            tile_renderer = TileRenderer(session, api_key, style, zoom, width, height, tile_cache, rate_limiter)
+        if group_markers:
+            # Grouping needs all points, so the whole input is read before the first request
+            maps = grouped_maps(api_key, input_file, order, zoom, size, style, max_markers,
+                                os.path.join(output_dir, MANIFEST_FILE))
+        else:
+            maps = single_maps(api_key, input_file, order, zoom, size, style)
         async with asyncio.TaskGroup() as tg:
-            for batch in coros:
-                for coro in batch:
-                    tg.create_task(coro)
-                await asyncio.sleep(1)
+            for name, params, lat, lon, points in maps:
+                key = cache.make_key(params) if cache else None
+                # Read the next line only when a slot is free, so finished tasks are the only ones kept
+                await semaphore.acquire()
+                if tile_cache:
+                    tg.create_task(render(lat, lon, points, name))
+                elif cache and await cache.fresh(key):
+                    # Fresh cached images don't wait for a rate limiter token
+                    tg.create_task(save_cached(name, key))
+                else:
+                    tg.create_task(fetch(params, lat, lon, name))
+
+    if postprocessor:
+        await postprocessor.close()
+        logger.info(f"Wrote {postprocessor.thumbnails} thumbnails and {postprocessor.collages} collage sheets")
+    if archive:
+        await archive.close()
+        logger.info(f"Archived {archive.added} images in {archive.shard + 1} shards in {output_dir}")
+    metrics.close()
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+    if tile_cache:
+        logger.info(f"Tiles downloaded: {tile_cache.downloads}, reused: {tile_cache.hits}, see {tile_cache_dir}")
+        tile_cache.close()
+    if cache:
+        logger.info(f"Cache hits: {cache.hits}, revalidated: {cache.revalidated}, downloaded: {cache.downloads}")
+        await cache.close()
+    if metrics_output:
+        logger.info(f"Metrics written to {metrics_output}.prom and {metrics_output}.json")
 
 
 if __name__ == "__main__":
@@ -90,7 +291,64 @@ if __name__ == "__main__":
     parser.add_argument('--style', default="osm-bright", help="Map style (e.g., osm-bright, dark-matter).")
     parser.add_argument('--order', default="latlon", choices=["latlon", "lonlat"],
                         help="Coordinate order (latlon or lonlat).")
+    parser.add_argument('--requests_per_second', type=float, default=REQUESTS_PER_SECOND,
+                        help=f"Maximum requests per second allowed by your plan (default: {REQUESTS_PER_SECOND}).")
+    parser.add_argument('--burst', type=int, default=BURST,
+                        help=f"Maximum number of requests sent at once (default: {BURST}).")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help=f"Maximum number of maps requested at once (default: {CONCURRENCY}).")
+    parser.add_argument('--renderer', choices=RENDERERS, default='static_maps',
+                        help="Request a static map per image, or render images locally from raster tiles that "
+                             "are downloaded once and shared by nearby images (default: static_maps).")
+    parser.add_argument('--tile_cache_dir', default=TILE_CACHE_DIR,
+                        help=f"Directory of the raster tiles kept between runs (default: {TILE_CACHE_DIR}).")
+    parser.add_argument('--group_markers', action='store_true',
+                        help=f"Request one map with several markers for points that fit into one image, "
+                             f"and write {MANIFEST_FILE} with the image and pixel position of every point.")
+    parser.add_argument('--max_markers', type=int, default=DEFAULT_MAX_MARKERS,
+                        help=f"Maximum number of markers on a grouped map (default: {DEFAULT_MAX_MARKERS}).")
+    parser.add_argument('--archive', action='store_true',
+                        help="Append the images to shard files with an index in the output directory, "
+                             "instead of writing one file per image.")
+    parser.add_argument('--shard_size_mb', type=float, default=DEFAULT_SHARD_SIZE_MB,
+                        help=f"Maximum size of an archive shard in MB (default: {DEFAULT_SHARD_SIZE_MB}).")
+    parser.add_argument('--thumbnail_sizes', type=int, nargs='+', default=[],
+                        help="Also write every map resized to these longest edges in pixels, e.g. 256 128.")
+    parser.add_argument('--image_format', choices=IMAGE_FORMATS, default=DEFAULT_IMAGE_FORMAT,
+                        help=f"Format of the thumbnails and collage sheets (default: {DEFAULT_IMAGE_FORMAT}).")
+    parser.add_argument('--quality', type=int, default=DEFAULT_QUALITY,
+                        help=f"Encoder quality of thumbnails and collage sheets, 1-100 (default: {DEFAULT_QUALITY}).")
+    parser.add_argument('--collage_columns', type=int, default=0,
+                        help="Place the smallest thumbnails on collage sheets with this many columns.")
+    parser.add_argument('--collage_rows', type=int, default=0,
+                        help="Rows of a collage sheet.")
+    parser.add_argument('--postprocess_workers', type=int,
+                        help="Processes resizing and encoding thumbnails (default: one per CPU core).")
+    parser.add_argument('--cache_dir', help="Optional directory for caching map images between runs.")
+    parser.add_argument('--cache_ttl_days', type=float, default=DEFAULT_TTL_DAYS,
+                        help=f"Days before a cached image is revalidated with the API (default: {DEFAULT_TTL_DAYS}).")
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    if (args.collage_columns or args.collage_rows) and not (args.collage_columns and args.collage_rows
+                                                           and args.thumbnail_sizes):
+        parser.error("--collage_columns and --collage_rows are both needed, together with --thumbnail_sizes")
+    if args.group_markers and min(map(int, args.size.split('x'))) <= 2 * MARKER_MARGIN:
+        parser.error(f"--group_markers needs images larger than {2 * MARKER_MARGIN} pixels on each side")
+    if args.renderer == 'tiles':
+        if args.cache_dir:
+            parser.error("--cache_dir caches static maps, tiles are cached in --tile_cache_dir")
+        # Pillow always writes PNG, so this only fails without Pillow
+        if check_image_format('png'):
+            parser.error("--renderer tiles requires Pillow: pip install pillow")
+    if args.thumbnail_sizes:
+        error = check_image_format(args.image_format)
+        if error:
+            parser.error(error)
 
-    asyncio.run(main(args.api_key, args.input, args.output, args.zoom, args.size, args.style, args.order))
+    asyncio.run(main(args.api_key, args.input, args.output, args.zoom, args.size, args.style, args.order,
+                     args.metrics_output, args.metrics_interval, args.cache_dir, args.cache_ttl_days,
+                     args.requests_per_second, args.burst, args.concurrency, args.archive, args.shard_size_mb,
+                     args.thumbnail_sizes, args.image_format, args.quality, args.collage_columns, args.collage_rows,
+                     args.postprocess_workers, args.group_markers, args.max_markers, args.renderer,
+                     args.tile_cache_dir))
@@ -0,0 +1,140 @@
+import asyncio
+import mmap
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_FILE = 'index.sqlite'
+SHARD_NAME = 'shard-{:05d}.bin'
+DEFAULT_SHARD_SIZE_MB = 1024
+# Images written between two commits of the index, a crash loses at most these from the index
+COMMIT_EVERY = 1000
+
+
+class ImageArchive:
+    """Appends images to large shard files instead of writing one file per image.
+
+    Images are stored back to back in `shard-00000.bin`, `shard-00001.bin`, ... in `directory`; a new shard
+    is started when the current one would grow beyond `shard_size_mb`. `index.sqlite` maps every image name
+    to its shard, offset and length, so `ArchiveReader` can read any image without scanning a shard. All file
+    and index writes run on one background thread, so adding an image never blocks the event loop.
+    Adding a name again stores the new image and points the index to it.
+    """
+
+    def __init__(self, directory, shard_size_mb=DEFAULT_SHARD_SIZE_MB):
+        self.directory = directory
+        self.shard_size = int(shard_size_mb * 1024 * 1024)
+        self.added = 0
+        os.makedirs(directory, exist_ok=True)
+        # Only the writer thread uses the connection once the archive is open
+        self.connection = sqlite3.connect(os.path.join(directory, INDEX_FILE), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS images (
+                                       name TEXT PRIMARY KEY,
+                                       shard INTEGER NOT NULL,
+                                       offset INTEGER NOT NULL,
+                                       length INTEGER NOT NULL)''')
+        self.connection.commit()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='archive')
+        self._open_last_shard()
+
+    def _open_last_shard(self):
+        # Continue the last shard of a previous run after its last indexed image, dropping a tail that was
+        # written but never committed to the index
+        row = self.connection.execute('SELECT shard, MAX(offset + length) FROM images '
+                                      'GROUP BY shard ORDER BY shard DESC LIMIT 1').fetchone()
+        self.shard, end = row if row else (0, 0)
+        path = self.shard_path(self.shard)
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'wb')
+        self.file.truncate(end)
+        self.file.seek(end)
+        self.offset = end
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, SHARD_NAME.format(shard))
+
+    def _append(self, name, content):
+        if self.offset and self.offset + len(content) > self.shard_size:
+            self.file.close()
+            self.shard += 1
+            self.file = open(self.shard_path(self.shard), 'wb')
+            self.offset = 0
+        self.file.write(content)
+        self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                                (name, self.shard, self.offset, len(content)))
+        self.offset += len(content)
+        self.added += 1
+        if self.added % COMMIT_EVERY == 0:
+            self._commit()
+
+    def _append_file(self, name, path):
+        with open(path, 'rb') as f:
+            self._append(name, f.read())
+
+    def _commit(self):
+        # Images reach the shard file before the index points to them
+        self.file.flush()
+        self.connection.commit()
+
+    def _close(self):
+        self._commit()
+        self.file.close()
+        self.connection.close()
+
+    async def add(self, name, content):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._append, name, content)
+
+    async def add_file(self, name, path):
+        # Copy an image file into the archive, e.g. from the image cache
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._append_file, name, path)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._close)
+        self.executor.shutdown()
+
+
+class ArchiveReader:
+    """Reads images of an ImageArchive by name through memory-mapped shards.
+
+    Shards are mapped on first use and shared by all reads, so reading an image costs one index lookup
+    and a copy of its bytes, whatever the size of the archive.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.connection = sqlite3.connect(f"file:{os.path.join(directory, INDEX_FILE)}?mode=ro", uri=True)
+        self.shards = {}
+
+    def get(self, name):
+        row = self.connection.execute('SELECT shard, offset, length FROM images WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        shard, offset, length = row
+        return self._map(shard)[offset:offset + length]
+
+    def _map(self, shard):
+        if shard not in self.shards:
+            with open(os.path.join(self.directory, SHARD_NAME.format(shard)), 'rb') as f:
+                self.shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shards[shard]
+
+    def names(self):
+        return (name for name, in self.connection.execute('SELECT name FROM images ORDER BY shard, offset'))
+
+    def __contains__(self, name):
+        return self.connection.execute('SELECT 1 FROM images WHERE name = ?', (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TTL_DAYS = 30
+INDEX_FILE = 'index.sqlite'
+# Request parameters that don't change the image
+IGNORED_PARAMS = ('apiKey',)
+
+
+class ImageCache:
+    """Content-addressed cache of static map images with ETag revalidation.
+
+    An image is stored once under the SHA-256 of its request parameters (style, size, zoom, marker,
+    coordinates, ...), in `directory/ab/abcdef....png`, whatever output name it was requested for.
+    A SQLite index keeps the ETag and the fetch time of every image. Within `ttl_days` an image is used
+    without a request; after that it is revalidated with `If-None-Match`. Output files are hard links
+    to the cached image, or copies when the output directory is on another file system. All index and file
+    operations run on one background thread, so they never block the event loop.
+    """
+
+    def __init__(self, directory, ttl_days=DEFAULT_TTL_DAYS):
+        self.directory = directory
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        os.makedirs(directory, exist_ok=True)
+        # Only the cache thread uses the connection once the cache is open
+        self.connection = sqlite3.connect(os.path.join(directory, INDEX_FILE), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS images (
+                                       key TEXT PRIMARY KEY,
+                                       etag TEXT,
+                                       fetched_at REAL NOT NULL)''')
+        self.connection.commit()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-cache')
+
+    @staticmethod
+    def make_key(params):
+        # The same map requested with the parameters in another order or with another API key has the same key
+        request = {name: str(value) for name, value in params.items() if name not in IGNORED_PARAMS}
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    def _lookup(self, key):
+        # Return (fresh, etag) of a cached image, None when it is not cached
+        row = self.connection.execute('SELECT etag, fetched_at FROM images WHERE key = ?', (key,)).fetchone()
+        if row is None or not os.path.exists(self.path(key)):
+            return None
+        etag, fetched_at = row
+        return time.time() - fetched_at <= self.ttl, etag
+
+    def _fresh(self, key):
+        # A cached image that doesn't need revalidation yet is used without a request
+        cached = self._lookup(key)
+        if not cached or not cached[0]:
+            return False
+        self.hits += 1
+        return True
+
+    def _put(self, key, content, etag=None):
+        # Write to a temporary file first, so an interrupted run never leaves a truncated image behind
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(content)
+        os.replace(temporary, path)
+        self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)', (key, etag, time.time()))
+        self.connection.commit()
+        self.downloads += 1
+
+    def _refresh(self, key, etag=None):
+        # The server answered 304 Not Modified: the cached image is fresh again
+        self.connection.execute('UPDATE images SET fetched_at = ?, etag = COALESCE(?, etag) WHERE key = ?',
+                                (time.time(), etag, key))
+        self.connection.commit()
+        self.revalidated += 1
+
+    def _link(self, key, output_path):
+        # Replace the output file atomically, it may be a link to another image from a previous run
+        path = self.path(key)
+        if os.path.exists(output_path) and os.path.samefile(path, output_path):
+            return
+        temporary = f"{output_path}.{os.getpid()}.tmp"
+        try:
+            os.link(path, temporary)
+        except OSError:
+            shutil.copyfile(path, temporary)
+        os.replace(temporary, output_path)
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def lookup(self, key):
+        return await self._run(self._lookup, key)
+
+    async def fresh(self, key):
+        return await self._run(self._fresh, key)
+
+    async def put(self, key, content, etag=None):
+        await self._run(self._put, key, content, etag)
+
+    async def refresh(self, key, etag=None):
+        await self._run(self._refresh, key, etag)
+
+    async def link(self, key, output_path):
+        await self._run(self._link, key, output_path)
+
+    async def close(self):
+        await self._run(self.connection.close)
+        self.executor.shutdown()
@@ -0,0 +1,67 @@
+import math
+from collections import defaultdict
+
+# Static maps are rendered like MapLibre GL maps: at zoom z the world is 512 * 2^z pixels wide
+TILE_SIZE = 512
+# Pixels kept free at the image edges, so a marker icon drawn above its point is not cut off
+MARKER_MARGIN = 48
+DEFAULT_MAX_MARKERS = 50
+# Web Mercator is undefined at the poles
+MAX_LATITUDE = 85.0511
+
+
+class MapGroup:
+    """Points shown on one static map, centred on `lat`, `lon`.
+
+    `markers` lists `(index, lat, lon, x, y)` of every point, `x` and `y` being its pixel position in the image.
+    """
+
+    def __init__(self, name, lat, lon, markers):
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.markers = markers
+
+
+def world_pixels(lat, lon, zoom):
+    # Web Mercator pixel coordinates of a point, from the top left corner of the world
+    world = TILE_SIZE * 2 ** zoom
+    sin_lat = math.sin(math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))))
+    x = (lon + 180) / 360 * world
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world
+    return x, y
+
+
+def world_lat_lon(x, y, zoom):
+    world = TILE_SIZE * 2 ** zoom
+    lon = x / world * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world))))
+    return lat, lon
+
+
+def group_points(points, zoom, width, height, max_markers=DEFAULT_MAX_MARKERS):
+    # Places (index, lat, lon) points in cells of a grid over the world, a cell being the part of an image
+    # that markers can use, and returns one MapGroup per cell, or several for cells with more than
+    # `max_markers` points. Every image is centred on its points, which all fit inside it.
+    cell_width, cell_height = width - 2 * MARKER_MARGIN, height - 2 * MARKER_MARGIN
+    if cell_width <= 0 or cell_height <= 0:
+        raise ValueError(f"Images must be larger than {2 * MARKER_MARGIN}x{2 * MARKER_MARGIN} pixels to group markers")
+
+    cells = defaultdict(list)
+    for index, lat, lon in points:
+        x, y = world_pixels(lat, lon, zoom)
+        cells[int(x // cell_width), int(y // cell_height)].append((index, lat, lon, x, y))
+
+    groups = []
+    for (column, row), cell in sorted(cells.items()):
+        for part in range(0, len(cell), max_markers):
+            members = cell[part:part + max_markers]
+            # The centre of the bounding box of the points, so their margins to the image edges are even
+            center_x = (min(m[3] for m in members) + max(m[3] for m in members)) / 2
+            center_y = (min(m[4] for m in members) + max(m[4] for m in members)) / 2
+            lat, lon = world_lat_lon(center_x, center_y, zoom)
+            markers = [(index, point_lat, point_lon, round(x - center_x + width / 2), round(y - center_y + height / 2))
+                       for index, point_lat, point_lon, x, y in members]
+            suffix = f"_{part // max_markers + 1}" if len(cell) > max_markers else ""
+            groups.append(MapGroup(f"group_{zoom}_{column}_{row}{suffix}.png", lat, lon, markers))
+    return groups
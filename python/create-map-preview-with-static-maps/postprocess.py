@@ -0,0 +1,116 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+IMAGE_FORMATS = ['webp', 'avif', 'png', 'jpeg']
+DEFAULT_IMAGE_FORMAT = 'webp'
+DEFAULT_QUALITY = 80
+COLLAGE_GAP = 4
+COLLAGE_BACKGROUND = (255, 255, 255)
+
+
+def encode(image, image_format, quality):
+    # Pillow names the formats in upper case, and JPEG has no alpha channel
+    output = io.BytesIO()
+    if image_format == 'jpeg' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(output, format=image_format.upper(), quality=quality)
+    return output.getvalue()
+
+
+def render_thumbnails(source, sizes, image_format, quality):
+    # Runs in a worker process: `source` is the PNG as bytes or the path of a PNG file. Returns the image in
+    # `image_format` for every size, a size being the longest edge in pixels
+    # Imported here, so the script does not need Pillow without post-processing
+    from PIL import Image
+
+    with Image.open(io.BytesIO(source) if isinstance(source, bytes) else source) as image:
+        image.load()
+        thumbnails = []
+        for size in sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), Image.Resampling.LANCZOS)
+            thumbnails.append((size, encode(thumbnail, image_format, quality)))
+        return thumbnails
+
+
+def render_collage(tiles, columns, tile_size, image_format, quality):
+    # Runs in a worker process: places the encoded `tiles` in a grid of `columns`, each in a cell of
+    # `tile_size` pixels, with a gap between the cells
+    from PIL import Image
+
+    rows = (len(tiles) + columns - 1) // columns
+    cell = tile_size + COLLAGE_GAP
+    sheet = Image.new('RGB', (columns * cell + COLLAGE_GAP, rows * cell + COLLAGE_GAP), COLLAGE_BACKGROUND)
+    for i, tile in enumerate(tiles):
+        with Image.open(io.BytesIO(tile)) as image:
+            x = COLLAGE_GAP + i % columns * cell + (tile_size - image.width) // 2
+            y = COLLAGE_GAP + i // columns * cell + (tile_size - image.height) // 2
+            sheet.paste(image.convert('RGB'), (x, y))
+    return encode(sheet, image_format, quality)
+
+
+class PostProcessor:
+    """Resizes and re-encodes map previews in a process pool, while the event loop goes on fetching maps.
+
+    For every map, one thumbnail per size in `sizes` is written as `{name}_{size}.{image_format}`. With
+    `collage_columns` and `collage_rows`, the smallest thumbnails are also placed on collage sheets
+    `collage_00001.{image_format}`, ... in the order the maps are finished. `save` is a coroutine function
+    `save(name, content)` that stores a result, as a file or in an archive.
+    """
+
+    def __init__(self, save, sizes, image_format=DEFAULT_IMAGE_FORMAT, quality=DEFAULT_QUALITY,
+                 collage_columns=0, collage_rows=0, workers=None):
+        self.save = save
+        self.sizes = sorted(set(sizes), reverse=True)
+        self.image_format = image_format
+        self.quality = quality
+        self.collage_columns = collage_columns
+        self.collage_size = collage_columns * collage_rows
+        self.tiles = []
+        self.collages = 0
+        self.thumbnails = 0
+        # Workers are spawned, as forking a process that runs threads (metrics, archive writer) can deadlock
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def process(self, name, source):
+        # `source` is the PNG as bytes or the path of a PNG file, e.g. of the image cache
+        loop = asyncio.get_running_loop()
+        thumbnails = await loop.run_in_executor(self.executor, render_thumbnails, source, self.sizes,
+                                                self.image_format, self.quality)
+        stem = os.path.splitext(name)[0]
+        for size, content in thumbnails:
+            await self.save(f"{stem}_{size}.{self.image_format}", content)
+        self.thumbnails += len(thumbnails)
+        if self.collage_size:
+            self.tiles.append(thumbnails[-1][1])
+            if len(self.tiles) == self.collage_size:
+                await self.write_collage()
+
+    async def write_collage(self):
+        tiles, self.tiles = self.tiles, []
+        self.collages += 1
+        name = f"collage_{self.collages:05d}.{self.image_format}"
+        content = await asyncio.get_running_loop().run_in_executor(
+            self.executor, render_collage, tiles, self.collage_columns, self.sizes[-1], self.image_format,
+            self.quality)
+        await self.save(name, content)
+
+    async def close(self):
+        # The last collage sheet takes the remaining thumbnails
+        if self.tiles:
+            await self.write_collage()
+        self.executor.shutdown()
+
+
+def check_image_format(image_format):
+    # Fail before the first request when Pillow is missing or can't write the format, e.g. AVIF before 11.3
+    try:
+        from PIL import features
+    except ImportError:
+        return "Post-processing requires Pillow: pip install pillow"
+    if image_format in ('webp', 'avif') and not features.check(image_format):
+        return f"Pillow {features.version('pil')} can't write {image_format.upper()}"
+    return None
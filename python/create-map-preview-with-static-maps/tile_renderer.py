@@ -0,0 +1,180 @@
+import asyncio
+import io
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from time import monotonic
+
+from aiohttp.client_exceptions import ClientError
+
+from map_groups import world_pixels
+from rate_limiter import parse_retry_after
+
+GEOAPIFY_TILE_URL = "https://maps.geoapify.com/v1/tile/{style}/{z}/{x}/{y}.png"
+# Raster tiles are 256 pixels wide, so the tiles one zoom level up have the pixels of a static map at `zoom`
+TILE_SIZE = 256
+RETRY_ATTEMPTS = 3
+# Decoded tiles kept in memory, about 200 KB each; neighbouring previews mostly share their tiles
+DECODED_TILES = 256
+BACKGROUND = (232, 228, 216)
+MARKER_COLOR = (255, 64, 64)
+MARKER_OUTLINE = (255, 255, 255)
+# Radius of the marker head and height of its tip below the head centre, in pixels
+MARKER_RADIUS = 10
+MARKER_TIP = 24
+
+
+class TileFetchError(Exception):
+    pass
+
+
+class TileCache:
+    """Raster tiles on disk, stored once in `directory/{style}/{z}/{x}/{y}.png` for all previews and runs.
+
+    Previews of nearby points need the same tiles, so a tile is downloaded only the first time any preview
+    needs it. A tile that is being downloaded is awaited by every other preview that needs it, instead of
+    being requested again. Files are checked and written on a thread of the cache, not on the event loop.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.downloads = 0
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tile-cache')
+
+    def path(self, style, z, x, y):
+        return os.path.join(self.directory, style, str(z), str(x), f"{y}.png")
+
+    async def get(self, style, z, x, y, download):
+        # Return the path of the tile; `download(z, x, y)` is a coroutine function returning its content
+        path = self.path(style, z, x, y)
+        pending = self.pending.get(path)
+        if pending is None:
+            pending = self.pending[path] = asyncio.ensure_future(self._fetch(path, z, x, y, download))
+            pending.add_done_callback(lambda _: self.pending.pop(path, None))
+        else:
+            self.hits += 1
+        # A cancelled preview doesn't cancel the download for the others
+        return await asyncio.shield(pending)
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def _fetch(self, path, z, x, y, download):
+        # Registered as pending before the file check, so the tile is checked and downloaded once
+        if await self._run(os.path.exists, path):
+            self.hits += 1
+            return path
+        content = await download(z, x, y)
+        await self._run(self._write, path, content)
+        self.downloads += 1
+        return path
+
+    @staticmethod
+    def _write(path, content):
+        # Write to a temporary file first, so an interrupted run never leaves a truncated tile behind
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            f.write(content)
+        os.replace(temporary, path)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+@lru_cache(maxsize=DECODED_TILES)
+def load_tile(path):
+    from PIL import Image
+
+    with Image.open(path) as tile:
+        return tile.convert('RGB')
+
+
+def draw_marker(draw, x, y):
+    # A pin with its tip on the point, like the `awesome` markers of static maps
+    head_y = y - MARKER_TIP
+    # The sides of the tip touch the head where its tangents through the tip point do
+    angle = math.asin(MARKER_RADIUS / MARKER_TIP)
+    dx, dy = MARKER_RADIUS * math.cos(angle), MARKER_RADIUS * math.sin(angle)
+    draw.polygon([(x - dx, head_y + dy), (x + dx, head_y + dy), (x, y)], fill=MARKER_COLOR, outline=MARKER_OUTLINE)
+    draw.ellipse([x - MARKER_RADIUS, head_y - MARKER_RADIUS, x + MARKER_RADIUS, head_y + MARKER_RADIUS],
+                 fill=MARKER_COLOR, outline=MARKER_OUTLINE, width=2)
+    draw.ellipse([x - 3, head_y - 3, x + 3, head_y + 3], fill=MARKER_OUTLINE)
+
+
+def stitch(tiles, left, top, width, height, markers):
+    # Runs in a thread: pastes the tiles, given as (pixel x, pixel y, path) of their top left corner in the
+    # world, into an image whose top left corner is at `left`, `top`, and draws the markers
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (width, height), BACKGROUND)
+    for x, y, path in tiles:
+        image.paste(load_tile(path), (x - left, y - top))
+    draw = ImageDraw.Draw(image)
+    for x, y in markers:
+        draw_marker(draw, x, y)
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+class TileRenderer:
+    """Renders map previews locally from raster tiles instead of requesting a static map per preview.
+
+    A preview of `width` x `height` pixels centred on a point at `zoom` is cut from the 256 pixel tiles of
+    `zoom + 1`, which cover the same area as a static map of that size and zoom, and gets a marker for each
+    point. Tiles come from the shared `TileCache`; every download waits for a token of `rate_limiter`.
+    """
+
+    def __init__(self, session, api_key, style, zoom, width, height, tile_cache, rate_limiter):
+        self.session = session
+        self.api_key = api_key
+        self.style = style
+        self.zoom = zoom
+        self.tile_zoom = zoom + 1
+        self.width = width
+        self.height = height
+        self.tile_cache = tile_cache
+        self.rate_limiter = rate_limiter
+
+    async def download(self, z, x, y):
+        url = GEOAPIFY_TILE_URL.format(style=self.style, z=z, x=x, y=y)
+        for attempt in range(RETRY_ATTEMPTS):
+            await self.rate_limiter.acquire_async()
+            started = monotonic()
+            try:
+                async with self.session.get(url, params={"apiKey": self.api_key}) as response:
+                    if response.status == 200:
+                        self.rate_limiter.record_success(monotonic() - started)
+                        return await response.read()
+                    error = f"status: {response.status}"
+                    if response.status == 429:
+                        # The limiter pauses all requests for Retry-After seconds and delays the retry
+                        self.rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                        continue
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+            await asyncio.sleep(1)  # Wait before retrying
+        raise TileFetchError(f"Failed to fetch tile {z}/{x}/{y} after {RETRY_ATTEMPTS} attempts ({error})")
+
+    async def render(self, lat, lon, points):
+        # PNG of the preview centred on `lat`, `lon` with a marker for each (lat, lon) in `points`
+        center_x, center_y = world_pixels(lat, lon, self.zoom)
+        left, top = round(center_x - self.width / 2), round(center_y - self.height / 2)
+        count = 2 ** self.tile_zoom
+        tiles = []
+        for tile_y in range(max(top // TILE_SIZE, 0), min((top + self.height - 1) // TILE_SIZE + 1, count)):
+            for tile_x in range(left // TILE_SIZE, (left + self.width - 1) // TILE_SIZE + 1):
+                # Previews across the antimeridian use the tiles of the other side of the world
+                tiles.append((tile_x, tile_y, self.tile_cache.get(self.style, self.tile_zoom, tile_x % count,
+                                                                  tile_y, self.download)))
+        paths = await asyncio.gather(*(path for _, _, path in tiles))
+        placed = [(tile_x * TILE_SIZE, tile_y * TILE_SIZE, path) for (tile_x, tile_y, _), path in zip(tiles, paths)]
+        markers = []
+        for point_lat, point_lon in points:
+            x, y = world_pixels(point_lat, point_lon, self.zoom)
+            markers.append((round(x) - left, round(y) - top))
+        return await asyncio.to_thread(stitch, placed, left, top, self.width, self.height, markers)
@@ -0,0 +1,69 @@
+import csv
+import json
+from string import Formatter
+
+
+class GeocodeResult(dict):
+    def __missing__(self, key):
+        return ''
+
+
+def compile_template(address_format):
+    # Turn a --format template into a function that renders one geocoding result.
+    # Templates with plain {field} placeholders become a %-format string and a tuple of field names,
+    # so a row costs one dict lookup per field instead of format_map() over a copy of the result
+    parts = list(Formatter().parse(address_format))
+    if any(field is not None and (not field.isidentifier() or spec or conversion)
+           for _, field, spec, conversion in parts):
+        # Placeholders with indices, attributes, conversions or format specs keep the format_map() path
+        return lambda result: address_format.format_map(GeocodeResult(result))
+
+    template = ''.join(literal.replace('%', '%%') + ('%s' if field is not None else '')
+                       for literal, field, _, _ in parts)
+    fields = [field for _, field, _, _ in parts if field is not None]
+
+    def render(result):
+        return template % tuple(result.get(field, '') for field in fields)
+
+    return render
+
+
+def standardize(result, renderer):
+    # For empty geocoding result set empty string
+    if not result or result.get('error'):
+        return ''
+    return renderer(result)
+
+
+def read_addresses(input_file):
+    # Same rule as read_addresses of the batch geocoding sample: one address per non-blank line, stripped,
+    # so its NDJSON results line up with the addresses
+    with open(input_file, 'r') as f:
+        for line in f:
+            address = line.strip()
+            if address:
+                yield address
+
+
+def read_results(results_file):
+    with open(results_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def render_addresses(addresses, geocode_results, outputs):
+    # Write one CSV per (output file, template) pair in a single pass over the results;
+    # only the current row is kept in memory
+    renderers = [compile_template(address_format) for _, address_format in outputs]
+    files = [open(output, 'w', newline='') for output, _ in outputs]
+    try:
+        writers = [csv.writer(f) for f in files]
+        for writer in writers:
+            writer.writerow(["Original Address", "Standardized Address"])
+        for address, result in zip(addresses, geocode_results, strict=True):
+            for writer, renderer in zip(writers, renderers):
+                writer.writerow([address, standardize(result, renderer)])
+    finally:
+        for f in files:
+            f.close()
@@ -1,10 +1,24 @@
-import requests
-import itertools as it
-import json
-from time import sleep
+import random
+from time import monotonic, sleep
 import argparse
+import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import batched, islice
+
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
+
+from geocode_cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL_DAYS, GeocodeCache, normalize_address
+from http_client import BACKOFF_FACTOR, CONNECT_TIMEOUT, READ_TIMEOUT, SERVER_ERROR_STATUSES, HttpClient
+from job_journal import JobJournal, dead_letter_path, read_failures, replace_results, write_failure
+from key_pool import KEY_ERROR_STATUSES, KeyPoolExhausted, read_key_pool
+from rate_limiter import RateLimiter, parse_retry_after
+from request_hedging import RequestHedger, add_hedging_arguments
+from result_output import FieldProjection, add_output_arguments, loads, open_output
+from result_stages import StandardizationStage, ValidationStage, write_stages
+from run_metrics import RunMetrics, add_metrics_arguments
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -12,9 +26,41 @@ logger = logging.getLogger(__name__)
 
 # Constants
 REQUESTS_PER_SECOND = 5
+BURST = 1
+MAX_WORKERS = 10
+CONCURRENCY = 50
+MAX_RETRIES = 3
+MAX_IN_FLIGHT = 100
+# Every remembered address keeps its result, about 5-10 KB for a full Geoapify result
+DEDUP_WINDOW = 10_000
 GEOAPIFY_API_URL = "https://api.geoapify.com/v1/geocode/search"
+BATCH_API_URL = "https://api.geoapify.com/v1/batch/geocode/search"
+BATCH_SIZE = 1000
+BATCH_JOBS = 4
+POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 30
+MAX_POLL_TIME = 3600
+# Result fields written as typed columns of Parquet and Arrow output
+COLUMNS = [
+    ('lat', 'float'), ('lon', 'float'), ('formatted', 'string'), ('address_line1', 'string'),
+    ('address_line2', 'string'), ('housenumber', 'string'), ('street', 'string'), ('postcode', 'string'),
+    ('city', 'string'), ('county', 'string'), ('state', 'string'), ('country', 'string'),
+    ('country_code', 'string'), ('result_type', 'string'), ('place_id', 'string'), ('rank.importance', 'float'),
+    ('rank.popularity', 'float'), ('rank.confidence', 'float'), ('rank.confidence_city_level', 'float'),
+    ('rank.confidence_street_level', 'float'), ('rank.confidence_building_level', 'float'),
+    ('rank.match_type', 'string'), ('timezone.name', 'string'), ('datasource.sourcename', 'string'),
+    ('error', 'string'),
+]
+
+class GeocodingError(Exception):
+    """Geocoding request that failed after all retries, with the HTTP status if there was a response."""
+
+    def __init__(self, error, status=None):
+        super().__init__(error)
+        self.status = status
 
-def geocode_address(address, api_key, country_code):
+def geocode_address(address, api_key, country_code, rate_limiter=None, cache=None, client=None, key_pool=None,
+                    projection=None, hedger=None):
     params = {
             'format': 'json',
             'text': address,
@@ -24,56 +70,598 @@ def geocode_address(address, api_key, country_code):
     if country_code:
         params['filter'] = 'countrycode:' + country_code
 
-    try:
-        response = requests.get(GEOAPIFY_API_URL, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if len(data['results']) > 0:
-                return data['results'][0]
+    if cache:
+        result = cache.get(address, country_code, params['limit'])
+        if result is not None:
+            return projection.project(result) if projection else result
+
+    # Server errors and connection failures are retried by the client, rate limiting by the loop below
+    client = client or HttpClient(retry_statuses=SERVER_ERROR_STATUSES)
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if key_pool:
+                # Send every attempt with the key that has a token first
+                key = key_pool.acquire()
+                params['apiKey'], rate_limiter = key.key, key.rate_limiter
+            elif rate_limiter:
+                rate_limiter.acquire()
+            started = monotonic()
+            request = partial(client.get, GEOAPIFY_API_URL, params=dict(params))
+            # A request slower than most recent ones gets a duplicate, the first answer is used
+            # Duplicates of a key pool request take their token through the pool, within the daily limit of the key
+            hedge_limiter = key_pool.limiter(key) if key_pool else rate_limiter
+            response = hedger.call(request, hedge_limiter) if hedger else request()
+            if response.status_code == 200:
+                if rate_limiter:
+                    rate_limiter.record_success(monotonic() - started)
+                data = loads(response.content)
+                if len(data['results']) > 0:
+                    result = data['results'][0]
+                else:
+                    result = { "error":  "Not found"}
+                # Failed requests are not cached, so they are retried on the next run
+                if cache:
+                    cache.put(address, country_code, result, params['limit'])
+                # Only the requested fields are kept in memory until the result is written
+                return projection.project(result) if projection else result
+            if response.status_code == 429 and rate_limiter:
+                # Slow down and retry when the rate limit is exceeded
+                rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"Rate limit exceeded for address '{address}', retrying ({attempt}/{MAX_RETRIES})")
+                    continue
+            if response.status_code in KEY_ERROR_STATUSES and key_pool:
+                # Stop using a rejected key and retry with the others
+                key_pool.disable(key, f"{response.status_code} {response.text}")
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"API key {key.name()} rejected, retrying address '{address}' with another key")
+                    continue
+        except KeyPoolExhausted:
+            # Not a failure of this address: the run stops instead of failing every remaining one
+            raise
+        except Exception as e:
+            raise GeocodingError(e) from e
+        raise GeocodingError(response.text, response.status_code)
+
+async def geocode_address_async(session, address, api_key, country_code, rate_limiter, cache=None, key_pool=None,
+                                projection=None, hedger=None):
+    params = {
+            'format': 'json',
+            'text': address,
+            'limit': 1,
+            'apiKey': api_key
+        }
+    if country_code:
+        params['filter'] = 'countrycode:' + country_code
+
+    if cache:
+        result = await cache.get_async(address, country_code, params['limit'])
+        if result is not None:
+            return projection.project(result) if projection else result
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if key_pool:
+                key = await key_pool.acquire_async()
+                params['apiKey'], rate_limiter = key.key, key.rate_limiter
             else:
-                return { "error":  "Not found"}
-        else:
-            logger.warning(f"Failed to geocode address '{address}': {response_data}")
-            return {}
-    except Exception as e:
-        logger.error(f"Error while geocoding address '{address}': {e}")
-        return {}
+                await rate_limiter.acquire_async()
+            started = monotonic()
+            request = partial(session.get, GEOAPIFY_API_URL, params=dict(params))
+            hedge_limiter = key_pool.limiter(key) if key_pool else rate_limiter
+            response = await (hedger.call_async(request, hedge_limiter, ClientResponse.release) if hedger
+                              else request())
+            async with response:
+                if response.status == 200:
+                    rate_limiter.record_success(monotonic() - started)
+                    data = await response.json(loads=loads)
+                    if len(data['results']) > 0:
+                        result = data['results'][0]
+                    else:
+                        result = { "error":  "Not found"}
+                    if cache:
+                        await cache.put_async(address, country_code, result, params['limit'])
+                    return projection.project(result) if projection else result
+                error, status = await response.text(), response.status
+                if response.status == 429:
+                    # Slow down and retry when the rate limit is exceeded
+                    rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                elif response.status in KEY_ERROR_STATUSES and key_pool:
+                    key_pool.disable(key, f"{status} {error}")
+                elif response.status not in SERVER_ERROR_STATUSES:
+                    break
+        except (asyncio.TimeoutError, ClientError) as e:
+            error, status = e, None
+        except KeyPoolExhausted:
+            raise
+        except Exception as e:
+            raise GeocodingError(e) from e
+        if attempt < MAX_RETRIES:
+            logger.warning(f"Request for address '{address}' failed: {status or ''} {error}, "
+                           f"retrying ({attempt}/{MAX_RETRIES})")
+            await asyncio.sleep(random.uniform(0, BACKOFF_FACTOR * 2 ** attempt))
 
-def geocode_addresses(api_key, input_file, output_file, country_code):
-    addresses = []
+    raise GeocodingError(error, status)
 
+def read_addresses(input_file):
+    # Read addresses lazily, so the input file is never loaded into memory at once
     with open(input_file, 'r') as f:
-        addresses = f.read().strip().splitlines()
-    # Split addresses into batches
-    addresses = list(it.batched(addresses, REQUESTS_PER_SECOND))
-
-    # Request results asynchronously for each address batch
-    tasks = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for batch in addresses:
-            logger.info(batch)
-            tasks.extend([executor.submit(geocode_address, address, api_key, country_code) for address in batch])
-            sleep(1)
-    # Wait for results
-    wait(tasks, return_when=ALL_COMPLETED)
-    results = [task.result() for task in tasks]
-
-    # Write results to NDJSON file
-    with open(output_file, 'w') as f:
-        for result in results:
-            f.write(json.dumps(result) + '\n')
+        for line in f:
+            address = line.strip()
+            if address:
+                yield address
+
+def record_failure(journal, index, address, error):
+    # Failed addresses get an empty result and are listed in the dead-letter file for --retry_failed
+    logger.warning(f"Failed to geocode address '{address}': {error.status or ''} {error}")
+    journal.record_failure(index, address, error, error.status)
+    return {}
+
+def write_completed(f, pending, max_in_flight, journal, stages=()):
+    # Write finished results in input order; block on the oldest request while too many are in flight.
+    # Every result also goes through the extra output stages, so all outputs are written in one pass.
+    # Returns the number of results written
+    written = 0
+    while pending and (pending[0][2].done() or len(pending) > max_in_flight):
+        index, address, request = pending.popleft()
+        try:
+            result = request.result()
+        except GeocodingError as e:
+            result = record_failure(journal, index, address, e)
+        f.write(result)
+        write_stages(stages, address, result)
+        journal.record_done(f)
+        written += 1
+    return written
+
+async def write_completed_async(f, pending, max_in_flight, journal, stages=()):
+    # Same as write_completed for asyncio tasks
+    written = 0
+    while pending and (pending[0][2].done() or len(pending) > max_in_flight):
+        index, address, request = pending.popleft()
+        try:
+            result = await request
+        except GeocodingError as e:
+            result = record_failure(journal, index, address, e)
+        f.write(result)
+        write_stages(stages, address, result)
+        journal.record_done(f)
+        written += 1
+    return written
+
+class RecentRequests:
+    """Requests of the most recent unique addresses by normalized text.
+
+    Repeated addresses share the request of their first occurrence instead of sending their own.
+    Only the last `window` unique addresses are remembered; a window of 0 disables deduplication.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.requests = OrderedDict()
+        self.duplicates = 0
+
+    def get_or_submit(self, address, submit):
+        if not self.window:
+            return submit(address)
+        key = normalize_address(address)
+        request = self.requests.get(key)
+        if request is not None:
+            self.duplicates += 1
+            self.requests.move_to_end(key)
+            return request
+        request = self.requests[key] = submit(address)
+        if len(self.requests) > self.window:
+            self.requests.popitem(last=False)
+        return request
+
+def geocode_addresses(api_key, input_file, output_file, country_code, max_in_flight=MAX_IN_FLIGHT,
+                      requests_per_second=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS, cache=None,
+                      dedup_window=0, resume=False, stages=(), key_pool=None, metrics=None, file_format='ndjson',
+                      raw_json=False, projection=None, hedger=None):
+    # Every worker takes a token before each request, so requests are paced evenly
+    # and the rate adapts to throttling and latency reported by the API.
+    # With a key pool, every key has its own rate limiter instead
+    rate_limiter = None if key_pool else RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('geocode_addresses')
+    metrics.watch_rate(key_pool or rate_limiter)
+    # One pooled connection per worker, kept alive for the whole run, and one more for its hedged request
+    client = HttpClient(pool_size=max_workers * 2 if hedger else max_workers, retry_statuses=SERVER_ERROR_STATUSES,
+                        metrics=metrics)
+
+    # Repeated addresses share one request instead of sending their own
+    recent_requests = RecentRequests(dedup_window)
+
+    def submit(address):
+        logger.info(address)
+        return executor.submit(geocode_address, address, api_key, country_code, rate_limiter, cache, client,
+                               key_pool, projection, hedger)
+
+    # Completed addresses are checkpointed, so an interrupted run can be resumed
+    journal = JobJournal(output_file, resume)
+    if journal.done:
+        logger.info(f"Resuming after {journal.done} completed addresses")
+
+    # Futures are queued in input order and act as a reorder buffer:
+    # memory use is bounded by max_in_flight, not by the size of the input file
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            open_output(journal.open_output, output_file, file_format, COLUMNS, raw_json, projection) as f:
+        try:
+            for index, address in islice(enumerate(read_addresses(input_file)), journal.done, None):
+                pending.append((index, address, recent_requests.get_or_submit(address, submit)))
+                # Write results that are already done
+                metrics.record_items(write_completed(f, pending, max_in_flight, journal, stages))
+            # Wait for the remaining results
+            metrics.record_items(write_completed(f, pending, 0, journal, stages))
+        except KeyPoolExhausted:
+            # Checkpoint the results written so far, so --resume continues from the first address without one
+            executor.shutdown(cancel_futures=True)
+            journal.close(f)
+            raise
+        journal.close(f)
+
+    log_rate(key_pool or rate_limiter)
+    logger.info(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    if dedup_window:
+        logger.info(f"Deduplication saved {recent_requests.duplicates} requests")
+    if journal.failed:
+        logger.warning(f"{journal.failed} addresses failed, see {journal.dead_letter_file}")
+
+async def geocode_addresses_async(api_key, input_file, output_file, country_code, max_in_flight=MAX_IN_FLIGHT,
+                                  requests_per_second=REQUESTS_PER_SECOND, burst=BURST, concurrency=CONCURRENCY,
+                                  cache=None, dedup_window=0, resume=False, stages=(), key_pool=None,
+                                  metrics=None, file_format='ndjson', raw_json=False, projection=None, hedger=None):
+    # Same pipeline as geocode_addresses, but requests are coroutines sharing one ClientSession:
+    # up to `concurrency` requests are in flight without a thread per request
+    rate_limiter = None if key_pool else RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('geocode_addresses')
+    metrics.watch_rate(key_pool or rate_limiter)
+    semaphore = asyncio.Semaphore(concurrency)
+    recent_requests = RecentRequests(dedup_window)
+
+    async def geocode(address):
+        async with semaphore:
+            return await geocode_address_async(session, address, api_key, country_code, rate_limiter, cache,
+                                               key_pool, projection, hedger)
+
+    def submit(address):
+        logger.info(address)
+        return asyncio.create_task(geocode(address))
+
+    journal = JobJournal(output_file, resume)
+    if journal.done:
+        logger.info(f"Resuming after {journal.done} completed addresses")
+
+    pending = deque()
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    # Hedged requests need connections of their own next to the `concurrency` ones
+    connector = TCPConnector(limit=concurrency * 2 if hedger else concurrency)
+    async with ClientSession(timeout=timeout, connector=connector,
+                             trace_configs=[metrics.trace_config()]) as session:
+        with open_output(journal.open_output, output_file, file_format, COLUMNS, raw_json, projection) as f:
+            try:
+                for index, address in islice(enumerate(read_addresses(input_file)), journal.done, None):
+                    pending.append((index, address, recent_requests.get_or_submit(address, submit)))
+                    # Let started requests run and write results that are already done
+                    await asyncio.sleep(0)
+                    metrics.record_items(await write_completed_async(f, pending, max_in_flight, journal, stages))
+                # Wait for the remaining results
+                metrics.record_items(await write_completed_async(f, pending, 0, journal, stages))
+            except KeyPoolExhausted:
+                # Same as geocode_addresses: checkpoint and stop the requests that are still running
+                for _, _, request in pending:
+                    request.cancel()
+                journal.close(f)
+                raise
+            journal.close(f)
+
+    log_rate(key_pool or rate_limiter)
+    if dedup_window:
+        logger.info(f"Deduplication saved {recent_requests.duplicates} requests")
+    if journal.failed:
+        logger.warning(f"{journal.failed} addresses failed, see {journal.dead_letter_file}")
+
+def log_rate(rate_limiter):
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+
+def log_hedging(hedger):
+    if not hedger:
+        return
+    stats = hedger.stats()
+    logger.info(f"Hedged {stats['hedged']} of {stats['requests']} requests ({stats['hedge_rate']:.1%}), "
+                f"{stats['hedge_wins']} duplicates answered first")
+    hedger.close()
+
+def log_key_pool(key_pool):
+    if not key_pool:
+        return
+    for stats in key_pool.stats():
+        logger.info(f"API key {stats['key']}: {stats['requests']} requests, {stats['throttled']} throttled"
+                    + (f", disabled: {stats['disabled']}" if stats['disabled'] else ''))
+
+def run_batch_job(addresses, api_key, country_code, rate_limiter, client, batch_api_url=BATCH_API_URL):
+    # Submit a job to the Batch Geocoding API, then poll it until the results are ready
+    params = {'apiKey': api_key}
+    if country_code:
+        params['filter'] = 'countrycode:' + country_code
+    rate_limiter.acquire()
+    response = client.post(batch_api_url, params=params, json=addresses)
+    if response.status_code not in (200, 202):
+        raise GeocodingError(response.text, response.status_code)
+
+    # The submission answers with the job id, or with the results right away
+    results = loads(response.content)
+    job_id = None
+    if not isinstance(results, list):
+        job_id = results.get('id') if isinstance(results, dict) else None
+        if not job_id:
+            raise GeocodingError(f"Batch job submission returned no job id: {response.text}", response.status_code)
+        started = monotonic()
+        poll_interval = POLL_INTERVAL
+        # The job answers 202 while it is pending and 200 with the results when it is done
+        while True:
+            if monotonic() - started > MAX_POLL_TIME:
+                raise GeocodingError(f"Batch job {job_id} is not finished after {MAX_POLL_TIME} seconds")
+            sleep(random.uniform(poll_interval / 2, poll_interval))
+            poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+            rate_limiter.acquire()
+            response = client.get(batch_api_url, params={'id': job_id, 'apiKey': api_key})
+            if response.status_code not in (200, 202):
+                raise GeocodingError(response.text, response.status_code)
+            if response.status_code == 200:
+                break
+        results = loads(response.content)
+        if not isinstance(results, list):
+            raise GeocodingError(f"Batch job {job_id} returned no results: {response.text}", response.status_code)
+
+    if len(results) != len(addresses):
+        raise GeocodingError(f"Batch job returned {len(results)} results for {len(addresses)} addresses")
+    # Addresses that were not found have no location, use the same marker as single requests
+    return [result if 'lat' in result else {"error": "Not found"} for result in results]
+
+def geocode_batch(addresses, api_key, country_code, rate_limiter, client, cache=None, batch_api_url=BATCH_API_URL,
+                  projection=None):
+    # Only addresses missing from the cache are sent with the job
+    results = [cache.get(address, country_code, 1) if cache else None for address in addresses]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return [projection.project(result) for result in results] if projection else results
+    try:
+        found = run_batch_job([addresses[i] for i in missing], api_key, country_code, rate_limiter, client,
+                              batch_api_url)
+    except (OSError, ValueError) as e:
+        # Connection errors and malformed responses fail the whole job
+        raise GeocodingError(e) from e
+    for i, result in zip(missing, found):
+        results[i] = result
+        if cache:
+            cache.put(addresses[i], country_code, result, 1)
+    return [projection.project(result) for result in results] if projection else results
+
+def write_completed_batches(f, pending, max_jobs, journal, stages=()):
+    # Same as write_completed, for jobs of many addresses
+    written = 0
+    while pending and (pending[0][2].done() or len(pending) > max_jobs):
+        indices, addresses, job = pending.popleft()
+        try:
+            results = job.result()
+        except GeocodingError as e:
+            results = [record_failure(journal, index, address, e) for index, address in zip(indices, addresses)]
+        for address, result in zip(addresses, results):
+            f.write(result)
+            write_stages(stages, address, result)
+            journal.record_done(f)
+        written += len(addresses)
+    return written
+
+def geocode_addresses_batch(api_key, input_file, output_file, country_code, requests_per_second=REQUESTS_PER_SECOND,
+                            batch_size=BATCH_SIZE, batch_jobs=BATCH_JOBS, cache=None, resume=False,
+                            batch_api_url=BATCH_API_URL, stages=(), metrics=None, file_format='ndjson',
+                            raw_json=False, projection=None):
+    # Submit and poll up to `batch_jobs` jobs at once; submit and poll requests share the rate limit
+    rate_limiter = RateLimiter(requests_per_second)
+    metrics = metrics or RunMetrics('geocode_addresses')
+    metrics.watch_rate(rate_limiter)
+    client = HttpClient(pool_size=batch_jobs, metrics=metrics)
+    journal = JobJournal(output_file, resume)
+    if journal.done:
+        logger.info(f"Resuming after {journal.done} completed addresses")
+
+    # Jobs are queued in input order, at most batch_jobs + 1 jobs of addresses are kept in memory
+    pending = deque()
+    addresses = islice(enumerate(read_addresses(input_file)), journal.done, None)
+    with ThreadPoolExecutor(max_workers=batch_jobs) as executor, \
+            open_output(journal.open_output, output_file, file_format, COLUMNS, raw_json, projection) as f:
+        for batch in batched(addresses, batch_size):
+            indices, job_addresses = zip(*batch)
+            logger.info(f"Submitting addresses {indices[0] + 1}-{indices[-1] + 1}")
+            job = executor.submit(geocode_batch, list(job_addresses), api_key, country_code, rate_limiter, client,
+                                  cache, batch_api_url, projection)
+            pending.append((indices, job_addresses, job))
+            metrics.record_items(write_completed_batches(f, pending, batch_jobs, journal, stages))
+        metrics.record_items(write_completed_batches(f, pending, 0, journal, stages))
+        journal.close(f)
+
+    logger.info(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    if journal.failed:
+        logger.warning(f"{journal.failed} addresses failed, see {journal.dead_letter_file}")
+
+def retry_failed(api_key, output_file, country_code, requests_per_second=REQUESTS_PER_SECOND, burst=BURST,
+                 max_workers=MAX_WORKERS, cache=None, key_pool=None, metrics=None, projection=None):
+    # Geocode only the addresses listed in the dead-letter file and replace their results in the output
+    failures = read_failures(dead_letter_path(output_file))
+    logger.info(f"Retrying {len(failures)} failed addresses")
+    rate_limiter = None if key_pool else RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('geocode_addresses')
+    metrics.watch_rate(key_pool or rate_limiter)
+    client = HttpClient(pool_size=max_workers, retry_statuses=SERVER_ERROR_STATUSES, metrics=metrics)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        requests = [(failure, executor.submit(geocode_address, failure['item'], api_key, country_code,
+                                              rate_limiter, cache, client, key_pool))
+                    for failure in failures]
+
+        # Addresses that fail again stay in the dead-letter file
+        results = {}
+        with open(dead_letter_path(output_file), 'w') as dead_letter:
+            for failure, request in requests:
+                try:
+                    results[failure['index']] = request.result()
+                    metrics.record_items()
+                except GeocodingError as e:
+                    logger.warning(f"Failed to geocode address '{failure['item']}': {e.status or ''} {e}")
+                    write_failure(dead_letter, failure['index'], failure['item'], e, e.status)
+                except KeyPoolExhausted as e:
+                    # Kept for the next --retry_failed, after the daily limits are reset
+                    write_failure(dead_letter, failure['index'], failure['item'], e)
+
+    replace_results(output_file, results, projection)
+    client.close()
+    logger.info(f"{len(results)} addresses geocoded, {len(failures) - len(results)} still failing")
 
 def main():
     # Argument parsing
     parser = argparse.ArgumentParser(description='Geocode addresses using Geoapify API.')
     parser.add_argument('--api_key', type=str, help='API Key for Geoapify')
     parser.add_argument('--input', type=str, help='Input file containing addresses')
-    parser.add_argument('--output', type=str, help='Output file for NDJSON results')
+    parser.add_argument('--output', type=str, help='Output file for the results, NDJSON unless --file_format is set')
+    parser.add_argument('--api_keys', type=str,
+                        help='Optional file with several API keys, one per line: KEY[,REQUESTS_PER_SECOND[,DAILY_LIMIT]]')
     parser.add_argument('--country_code', type=str, help='Optional country code to improve accuracy')
+    parser.add_argument('--max_in_flight', type=int, default=MAX_IN_FLIGHT,
+                        help=f'Maximum number of requests and unwritten results kept in memory (default: {MAX_IN_FLIGHT})')
+    parser.add_argument('--requests_per_second', type=float, default=REQUESTS_PER_SECOND,
+                        help=f'Maximum requests per second allowed by your plan (default: {REQUESTS_PER_SECOND})')
+    parser.add_argument('--burst', type=int, default=BURST,
+                        help=f'Maximum number of requests sent at once (default: {BURST})')
+    parser.add_argument('--max_workers', type=int, default=MAX_WORKERS,
+                        help=f'Number of worker threads sending requests (default: {MAX_WORKERS})')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Send requests from a thread pool or from asyncio coroutines (default: threads)')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help=f'Maximum number of concurrent requests with the asyncio engine (default: {CONCURRENCY})')
+    parser.add_argument('--cache', type=str, help='Optional SQLite file for caching geocoding results between runs')
+    parser.add_argument('--cache_ttl_days', type=float, default=DEFAULT_TTL_DAYS,
+                        help=f'Days before a cached result expires (default: {DEFAULT_TTL_DAYS})')
+    parser.add_argument('--cache_max_entries', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help=f'Maximum number of cached results, least recently used are evicted '
+                             f'(default: {DEFAULT_MAX_ENTRIES})')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='Send one request for addresses that differ only in case, whitespace or punctuation')
+    parser.add_argument('--dedup_window', type=int, default=DEDUP_WINDOW,
+                        help=f'Number of recent unique addresses remembered for deduplication (default: {DEDUP_WINDOW})')
+    parser.add_argument('--batch_api', action='store_true',
+                        help='Geocode addresses in jobs of the asynchronous Batch Geocoding API instead of one request each')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE,
+                        help=f'Number of addresses per batch job (default: {BATCH_SIZE})')
+    parser.add_argument('--batch_jobs', type=int, default=BATCH_JOBS,
+                        help=f'Number of batch jobs running at once (default: {BATCH_JOBS})')
+    parser.add_argument('--batch_api_url', type=str, default=BATCH_API_URL,
+                        help='Batch Geocoding API endpoint, e.g. a local stand-in server for testing')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run from its last checkpoint instead of starting over')
+    parser.add_argument('--retry_failed', action='store_true',
+                        help='Geocode again only the addresses listed in the dead-letter file of a previous run')
+
+    parser.add_argument('--validation_output', type=str,
+                        help='Optional CSV file for address validation results, written in the same pass')
+    parser.add_argument('--min_confirmed', type=float, default=0.9,
+                        help='Minimum confidence for CONFIRMED in the validation output (default: 0.9)')
+    parser.add_argument('--max_not_confirmed', type=float, default=0.5,
+                        help='Maximum confidence for NOT_CONFIRMED in the validation output (default: 0.5)')
+    parser.add_argument('--standardized_output', type=str, action='append', default=[],
+                        help='Optional CSV file for standardized addresses, written in the same pass; '
+                             'repeat together with --format for several formats')
+    parser.add_argument('--format', type=str, action='append', default=[],
+                        help='Address format string using placeholders, one per --standardized_output')
+    add_hedging_arguments(parser)
+    add_output_arguments(parser)
+    parser.add_argument('--fields', type=str,
+                        help='Comma-separated result fields to keep, e.g. lat,lon,formatted,rank.confidence '
+                             '(default: all fields)')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    if len(args.standardized_output) != len(args.format):
+        parser.error('every --standardized_output needs its own --format')
+    if (args.validation_output or args.standardized_output) and (args.resume or args.retry_failed):
+        # The extra outputs are not checkpointed, so they can only be written by a complete run
+        parser.error('--validation_output and --standardized_output cannot be combined with --resume or --retry_failed')
+    if args.file_format != 'ndjson' and (args.resume or args.retry_failed):
+        # Parquet and Arrow files cannot be truncated to a checkpoint or rewritten line by line
+        parser.error('--file_format parquet and arrow cannot be combined with --resume or --retry_failed')
+    if args.api_keys and args.batch_api:
+        parser.error('--api_keys cannot be combined with --batch_api')
+    if args.hedge_percentile and args.batch_api:
+        parser.error('--hedge_percentile cannot be combined with --batch_api')
 
-    geocode_addresses(args.api_key, args.input, args.output, args.country_code)
+    # Every result is also written to the validation and standardized address outputs
+    stages = []
+    if args.validation_output:
+        stages.append(ValidationStage(args.validation_output, args.min_confirmed, args.max_not_confirmed))
+    for output, address_format in zip(args.standardized_output, args.format):
+        stages.append(StandardizationStage(output, address_format))
+
+    # Keep only the requested fields, and the fields the validation and standardized outputs read
+    projection = None
+    if args.fields:
+        fields = [field.strip() for field in args.fields.split(',') if field.strip()]
+        projection = FieldProjection(fields + [field for stage in stages for field in stage.fields])
+
+    # Spread requests over several API keys, each with its own rate and daily limit
+    key_pool = read_key_pool(args.api_keys, args.requests_per_second, args.burst) if args.api_keys else None
+
+    # Request latency, status codes, retries and throughput of the run
+    metrics = RunMetrics('geocode_addresses', args.metrics_output, args.metrics_interval)
+    metrics.start_snapshots()
+
+    # Duplicate requests slower than a percentile of recent latencies, within a share of the traffic
+    hedger = None
+    if args.hedge_percentile:
+        hedger = RequestHedger(args.hedge_percentile, args.hedge_max_percent, args.max_workers * 2)
+        hedger.watch(metrics)
+
+    # Reuse results of previous runs when a cache file is given
+    cache = GeocodeCache(args.cache, args.cache_ttl_days, args.cache_max_entries) if args.cache else None
+    dedup_window = args.dedup_window if args.deduplicate else 0
+    exhausted = None
+    try:
+        if args.retry_failed:
+            retry_failed(args.api_key, args.output, args.country_code, args.requests_per_second, args.burst,
+                         args.max_workers, cache, key_pool, metrics, projection)
+        elif args.batch_api:
+            geocode_addresses_batch(args.api_key, args.input, args.output, args.country_code,
+                                    args.requests_per_second, args.batch_size, args.batch_jobs, cache, args.resume,
+                                    args.batch_api_url, stages, metrics, args.file_format, args.raw_json, projection)
+        elif args.engine == 'asyncio':
+            asyncio.run(geocode_addresses_async(args.api_key, args.input, args.output, args.country_code,
+                                                args.max_in_flight, args.requests_per_second, args.burst,
+                                                args.concurrency, cache, dedup_window, args.resume, stages, key_pool,
+                                                metrics, args.file_format, args.raw_json, projection, hedger))
+        else:
+            geocode_addresses(args.api_key, args.input, args.output, args.country_code, args.max_in_flight,
+                              args.requests_per_second, args.burst, args.max_workers, cache, dedup_window,
+                              args.resume, stages, key_pool, metrics, args.file_format, args.raw_json, projection,
+                              hedger)
+    except KeyPoolExhausted as e:
+        # The results written so far are checkpointed
+        exhausted = e
+    log_key_pool(key_pool)
+    log_hedging(hedger)
+    metrics.close()
+    if args.metrics_output:
+        logger.info(f"Metrics written to {args.metrics_output}.prom and {args.metrics_output}.json")
+    for stage in stages:
+        stage.close()
+    if cache:
+        logger.info(f"Cache hits: {cache.hits}, misses: {cache.misses}")
+        cache.close()
+    if exhausted:
+        raise SystemExit(f"Stopped: {exhausted}. Run again with --resume once the daily limits are reset.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
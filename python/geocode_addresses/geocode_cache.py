@@ -0,0 +1,107 @@
+import asyncio
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TTL_DAYS = 30
+DEFAULT_MAX_ENTRIES = 1_000_000
+# Share of entries removed at once when the cache is full, so eviction doesn't run on every insert
+EVICTION_BATCH = 0.05
+
+PUNCTUATION = re.compile(r'[^\w\s]')
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_address(address):
+    # Ignore case, whitespace and punctuation differences between otherwise equal addresses
+    address = unicodedata.normalize('NFKC', address).casefold()
+    address = PUNCTUATION.sub(' ', address)
+    return WHITESPACE.sub(' ', address).strip()
+
+
+class GeocodeCache:
+    """Persistent SQLite cache of geocoding results with per-entry TTL and LRU eviction.
+
+    Entries are keyed by the normalized address text, the country code filter and the result limit.
+    A single connection is shared by all worker threads and guarded by a lock. Coroutines use `get_async` and
+    `put_async`, which run the queries on a thread of their own instead of blocking the event loop.
+    """
+
+    def __init__(self, path, ttl_days=DEFAULT_TTL_DAYS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl_days * 24 * 60 * 60
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS geocode_cache (
+                                       key TEXT PRIMARY KEY,
+                                       result TEXT NOT NULL,
+                                       created_at REAL NOT NULL,
+                                       accessed_at REAL NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS geocode_cache_accessed_at '
+                                'ON geocode_cache (accessed_at)')
+        self.connection.commit()
+        self.size = self.connection.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0]
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='geocode-cache')
+
+    @staticmethod
+    def make_key(address, country_code, limit):
+        return f"{normalize_address(address)}|{(country_code or '').lower()}|{limit}"
+
+    def get(self, address, country_code, limit=1):
+        key = self.make_key(address, country_code, limit)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT result, created_at FROM geocode_cache WHERE key = ?',
+                                          (key,)).fetchone()
+            if row and now - row[1] <= self.ttl:
+                self.hits += 1
+                self.connection.execute('UPDATE geocode_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                self.connection.commit()
+                return json.loads(row[0])
+
+            self.misses += 1
+            if row:
+                # Drop expired entry
+                self.connection.execute('DELETE FROM geocode_cache WHERE key = ?', (key,))
+                self.connection.commit()
+                self.size -= 1
+            return None
+
+    def put(self, address, country_code, result, limit=1):
+        key = self.make_key(address, country_code, limit)
+        now = time.time()
+        with self.lock:
+            exists = self.connection.execute('SELECT 1 FROM geocode_cache WHERE key = ?', (key,)).fetchone()
+            self.connection.execute('INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?)',
+                                    (key, json.dumps(result), now, now))
+            if not exists:
+                self.size += 1
+            if self.size > self.max_entries:
+                self._evict()
+            self.connection.commit()
+
+    async def get_async(self, address, country_code, limit=1):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.get, address, country_code, limit)
+
+    async def put_async(self, address, country_code, result, limit=1):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.put, address, country_code, result, limit)
+
+    def _evict(self):
+        # Remove least recently used entries
+        count = self.size - self.max_entries + max(int(self.max_entries * EVICTION_BATCH), 1)
+        self.connection.execute('''DELETE FROM geocode_cache WHERE key IN (
+                                       SELECT key FROM geocode_cache ORDER BY accessed_at LIMIT ?)''', (count,))
+        self.size = self.connection.execute('SELECT COUNT(*) FROM geocode_cache').fetchone()[0]
+
+    def close(self):
+        self.executor.shutdown()
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,215 @@
+import json
+
+try:
+    # orjson encodes and decodes JSON several times faster than the json module, it is used when installed
+    import orjson
+except ImportError:
+    orjson = None
+
+FILE_FORMATS = ['ndjson', 'parquet', 'arrow']
+ROW_GROUP_SIZE = 10_000
+COMPRESSION = 'zstd'
+RAW_JSON_COLUMN = 'raw_json'
+# Column with the `error` of a result; items that failed after all retries are written as empty results,
+# their column says FAILED_ERROR, so they can be told apart from results that were not found
+ERROR_COLUMN = 'error'
+FAILED_ERROR = 'Failed'
+
+
+class NdjsonOutput:
+    """Writes every result as one JSON line to an open text file."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, result):
+        self.file.write(dumps(result) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ColumnarOutput:
+    """Writes results as typed columns of a compressed Parquet or Arrow IPC file.
+
+    `columns` lists `(path, type)` pairs: a dotted path into the result, e.g. `rank.confidence`, becomes the
+    column `rank_confidence`, and the type is one of 'float', 'int', 'bool', 'string' or 'strings' (a list of
+    strings). Values that are missing or of another type are null. GeoJSON features are read from their
+    properties. An empty result gets FAILED_ERROR in the `error` column, when there is one. Rows are buffered and
+    written as one record batch every `row_group_size` results, so memory use does not grow with the output.
+    With `raw_json`, the complete result is also kept as JSON text.
+    """
+
+    def __init__(self, output_file, columns, file_format='parquet', raw_json=False,
+                 row_group_size=ROW_GROUP_SIZE, compression=COMPRESSION):
+        # Imported here, so NDJSON output does not need pyarrow
+        import pyarrow as pa
+
+        self.pa = pa
+        self.paths = [path.split('.') for path, _ in columns]
+        self.converters = [CONVERTERS[column_type] for _, column_type in columns]
+        self.error_column = self.paths.index([ERROR_COLUMN]) if [ERROR_COLUMN] in self.paths else None
+        fields = [pa.field(path.replace('.', '_'), arrow_type(pa, column_type)) for path, column_type in columns]
+        if raw_json:
+            fields.append(pa.field(RAW_JSON_COLUMN, pa.string()))
+        self.schema = pa.schema(fields)
+        self.raw_json = raw_json
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self.columns = [[] for _ in fields]
+
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(output_file, self.schema, compression=compression)
+        else:
+            import pyarrow.ipc
+            options = pa.ipc.IpcWriteOptions(compression=compression)
+            self.writer = pa.ipc.new_file(output_file, self.schema, options=options)
+
+    def write(self, result):
+        record = result.get('properties', result) if result.get('type') == 'Feature' else result
+        for path, convert, values in zip(self.paths, self.converters, self.columns):
+            values.append(convert(field_value(record, path)))
+        if not result and self.error_column is not None:
+            self.columns[self.error_column][-1] = FAILED_ERROR
+        if self.raw_json:
+            self.columns[-1].append(dumps(result))
+        if len(self.columns[0]) >= self.row_group_size:
+            self.write_batch()
+
+    def write_batch(self):
+        if not self.columns[0]:
+            return
+        self.writer.write_batch(self.pa.record_batch(self.columns, schema=self.schema))
+        self.rows += len(self.columns[0])
+        self.columns = [[] for _ in self.columns]
+
+    def flush(self):
+        # Rows are written in full record batches only, so a checkpoint does not split row groups
+        pass
+
+    def tell(self):
+        return self.rows
+
+    def close(self):
+        self.write_batch()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FieldProjection:
+    """Keeps only the given fields of a result.
+
+    Fields are dotted paths: `rank.confidence` keeps only this value of `rank`, `rank` keeps all of it.
+    Fields missing from a result are left out. Results with an `error` are kept as they are, so failures
+    stay recognizable. The projection is a new small dict, so the full result can be freed right away.
+    """
+
+    def __init__(self, fields):
+        self.fields = list(dict.fromkeys(fields))
+        self.paths = [field.split('.') for field in self.fields]
+
+    def project(self, result):
+        if 'error' in result:
+            return result
+        projected = {}
+        for path in self.paths:
+            value = field_value(result, path, missing=self)
+            if value is self:
+                continue
+            target = projected
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+        return projected
+
+    def columns(self, columns):
+        # Typed columns of the projected fields, fields without a known type are stored as strings
+        column_types = dict(columns)
+        projected = [(field, column_types.get(field, 'string')) for field in self.fields]
+        if ERROR_COLUMN in column_types and ERROR_COLUMN not in self.fields:
+            # Failures and results that were not found stay recognizable
+            projected.append((ERROR_COLUMN, column_types[ERROR_COLUMN]))
+        return projected
+
+
+def field_value(record, path, missing=None):
+    for key in path:
+        if not isinstance(record, dict) or key not in record:
+            return missing
+        record = record[key]
+    return record
+
+
+def to_float(value):
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def to_int(value):
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+def to_bool(value):
+    return value if isinstance(value, bool) else None
+
+
+def to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+
+def to_strings(value):
+    return [to_string(item) for item in value] if isinstance(value, list) else None
+
+
+CONVERTERS = {'float': to_float, 'int': to_int, 'bool': to_bool, 'string': to_string, 'strings': to_strings}
+
+
+def arrow_type(pa, column_type):
+    return {'float': pa.float64(), 'int': pa.int64(), 'bool': pa.bool_(), 'string': pa.string(),
+            'strings': pa.list_(pa.string())}[column_type]
+
+
+def dumps(value):
+    # orjson writes UTF-8 without spaces after separators, the json module escapes non-ASCII characters
+    return orjson.dumps(value).decode() if orjson else json.dumps(value)
+
+
+def loads(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+
+def open_output(ndjson_file, output_file, file_format, columns, raw_json=False, projection=None):
+    # `ndjson_file` opens the NDJSON output, e.g. JobJournal.open_output; it is not called for the columnar formats
+    if file_format == 'ndjson':
+        return NdjsonOutput(ndjson_file())
+    if projection:
+        columns = projection.columns(columns)
+    return ColumnarOutput(output_file, columns, file_format, raw_json)
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--file_format', choices=FILE_FORMATS, default='ndjson',
+                        help='Format of the output file: NDJSON, or typed columns in a compressed Parquet or '
+                             'Arrow IPC file, which require pyarrow (default: ndjson)')
+    parser.add_argument('--raw_json', action='store_true',
+                        help=f'Keep every complete result as JSON text in the {RAW_JSON_COLUMN} column '
+                             f'of Parquet and Arrow output')
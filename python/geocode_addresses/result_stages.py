@@ -0,0 +1,84 @@
+import csv
+import string
+
+from address_renderer import compile_template, standardize
+
+
+class ValidationStage:
+    """Writes the validation CSV of address-validation/address_verification.py for every result."""
+
+    # Result fields the stage reads, kept by a --fields projection
+    fields = ['rank']
+
+    def __init__(self, output_file, min_confirmed=0.9, max_not_confirmed=0.5):
+        self.min_confirmed = min_confirmed
+        self.max_not_confirmed = max_not_confirmed
+        self.file = open(output_file, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['Original Address', 'Validation Result', 'Reason'])
+
+    def write(self, address, result):
+        self.writer.writerow([address, *validate_address_geocoding(result, self.min_confirmed,
+                                                                   self.max_not_confirmed)])
+
+    def close(self):
+        self.file.close()
+
+
+class StandardizationStage:
+    """Writes the standardized address CSV of address-standardization/address_standardization.py."""
+
+    def __init__(self, output_file, address_format):
+        self.renderer = compile_template(address_format)
+        # Top-level fields of the placeholders, e.g. `rank` for {rank[confidence]}
+        self.fields = [name.split('.')[0].split('[')[0]
+                       for _, name, _, _ in string.Formatter().parse(address_format) if name]
+        self.file = open(output_file, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(['Original Address', 'Standardized Address'])
+
+    def write(self, address, result):
+        self.writer.writerow([address, standardize(result, self.renderer)])
+
+    def close(self):
+        self.file.close()
+
+
+# Copy of validate_address_geocoding of address-validation/address_verification.py, keep both in sync
+def validate_address_geocoding(geocode_result, min_confirmed, max_not_confirmed):
+    # Set Not confirmed for result with errors
+    if not geocode_result or geocode_result.get('error') == 'Not found':
+        return 'NOT_CONFIRMED', 'No geocoding result'
+
+    rank = geocode_result.get('rank', {})
+
+    # Retrieve ranks and fallback to 0 if not exists
+    confidence = rank.get('confidence', 0)
+    confidence_city = rank.get('confidence_city_level', 0)
+    confidence_street = rank.get('confidence_street_level', 0)
+    confidence_building = rank.get('confidence_building_level', 0)
+
+    if confidence >= min_confirmed:
+        return 'CONFIRMED', ''
+    elif confidence <= max_not_confirmed:
+        return 'NOT_CONFIRMED', ''
+
+    # Define reason for Partially Confirmed rank
+    for level, l_confidence in zip(['CITY', 'STREET', 'BUILDING'],
+                                   [confidence_city, confidence_street, confidence_building]):
+        if l_confidence == 0:
+            reason = f'{level}_NOT_CONFIRMED'
+        elif l_confidence <= max_not_confirmed:
+            reason = f'LOW_{level}_LEVEL_CONFIDENCE'
+        elif l_confidence <= min_confirmed:
+            reason = f'{level}_LEVEL_DOUBTS'
+        else:
+            continue
+        return 'PARTIALLY_CONFIRMED', reason
+
+    return 'PARTIALLY_CONFIRMED', 'Unknown'
+
+
+def write_stages(stages, address, result):
+    for stage in stages:
+        stage.write(address, result)
@@ -0,0 +1,68 @@
+import random
+import unittest
+from unittest import mock
+
+import rate_limiter
+from rate_limiter import RateLimiter
+
+
+class RateLimiterTest(unittest.TestCase):
+    """Reservations of the token bucket, with the clock stopped so delays are exact."""
+
+    def setUp(self):
+        patcher = mock.patch.object(rate_limiter.time, 'monotonic', return_value=100.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reservations_are_spaced_at_the_rate(self):
+        limiter = RateLimiter(2, burst=1)
+        self.assertEqual([limiter.reserve() for _ in range(4)], [0.0, 0.5, 1.0, 1.5])
+
+    def test_reservations_after_retry_after_are_spaced_at_the_rate(self):
+        limiter = RateLimiter(2, burst=1)
+        limiter.record_throttled(5)
+        delays = [limiter.reserve() for _ in range(8)]
+        # No request starts during the pause, and the ones queued behind it don't all start when it ends
+        self.assertGreaterEqual(delays[0], 5.0)
+        spacing = [later - earlier for earlier, later in zip(delays, delays[1:])]
+        for gap in spacing:
+            self.assertAlmostEqual(gap, 1 / limiter.rate)
+
+    def test_wait_time_includes_the_pause(self):
+        limiter = RateLimiter(2, burst=1)
+        limiter.record_throttled(5)
+        self.assertGreaterEqual(limiter.wait_time(), 5.0)
+        self.assertEqual(limiter.wait_time(), limiter.reserve())
+
+
+class LatencyBackoffTest(unittest.TestCase):
+    """Latency backoff of a limiter answered one request at a time at its rate, on a simulated clock."""
+
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch.object(rate_limiter.time, 'monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_requests(self, limiter, latencies):
+        for latency in latencies:
+            self.now += 1 / limiter.rate
+            limiter.record_success(latency)
+
+    def test_noisy_stationary_latency_keeps_the_rate(self):
+        generator = random.Random(1)
+        for sigma in (0.5, 0.8, 1.0):
+            limiter = RateLimiter(50, burst=10)
+            self.run_requests(limiter, (0.2 * generator.lognormvariate(0, sigma) for _ in range(20_000)))
+            self.assertGreaterEqual(limiter.rate, 0.9 * limiter.max_rate, f'sigma {sigma}')
+
+    def test_sustained_latency_rise_reduces_the_rate(self):
+        generator = random.Random(1)
+        limiter = RateLimiter(50, burst=10)
+        self.run_requests(limiter, (0.2 * generator.lognormvariate(0, 0.5) for _ in range(1_000)))
+        self.run_requests(limiter, (2.0 * generator.lognormvariate(0, 0.5) for _ in range(500)))
+        self.assertLess(limiter.rate, 0.5 * limiter.max_rate)
+
+
+if __name__ == '__main__':
+    unittest.main()
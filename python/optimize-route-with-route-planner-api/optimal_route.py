@@ -1,10 +1,14 @@
 import argparse
 
 import folium
-import requests
+
+from http_client import HttpClient
+from run_metrics import RunMetrics, add_metrics_arguments
 
 ROUTE_PLANNER_URL = 'https://api.geoapify.com/v1/routeplanner'
 ROUTING_URL = 'https://api.geoapify.com/v1/routing'
+# Route optimization may take longer than a regular API call
+ROUTE_PLANNER_READ_TIMEOUT = 120
 BASE_MAP_TILE_URL = "https://maps.geoapify.com/v1/tile/{map_style}/{{z}}/{{x}}/{{y}}@2x.png?apiKey={api_key}"
 
 
@@ -21,6 +25,7 @@ def parse_arguments():
     parser.add_argument('--route_traffic', default='free_flow', choices=['free_flow', 'approximated'], help='Traffic model.')
     parser.add_argument('--start_location', help='Starting location (lat,lon or lon,lat).')
     parser.add_argument('--end_location', help='Ending location (lat,lon or lon,lat).')
+    add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -41,7 +46,7 @@ def extract_coordinates(coords: str, order: str = 'latlon') -> list[float]:
     return [y, x] if order == 'latlon' else [x, y]
 
 
-def optimize_route(api_key, coordinates, start_location, end_location, route_mode):
+def optimize_route(api_key, coordinates, start_location, end_location, route_mode, client=None):
     url = ROUTE_PLANNER_URL.format(api_key=api_key)
     agents = [{key: value for key, value in zip(['start_location', 'end_location'],
                                                 [start_location, end_location]) if value}]
@@ -51,7 +56,8 @@ def optimize_route(api_key, coordinates, start_location, end_location, route_mod
         "agents": agents,
         "jobs": jobs
     }
-    response = requests.post(url, json=payload, params={'apiKey': api_key})
+    client = client or HttpClient(pool_size=1, read_timeout=ROUTE_PLANNER_READ_TIMEOUT)
+    response = client.post(url, json=payload, params={'apiKey': api_key})
     if response.status_code == 200:
         data = response.json()
         waypoints = data['features'][0]['properties']['waypoints']
@@ -61,13 +67,14 @@ def optimize_route(api_key, coordinates, start_location, end_location, route_mod
         raise Exception(f"Failed to optimize route: {response.text}")
 
 
-def get_route(api_key, waypoints, route_mode, route_type, route_traffic):
+def get_route(api_key, waypoints, route_mode, route_type, route_traffic, client=None):
     waypoints_str = '|'.join([f"lonlat:{lon},{lat}" for lon, lat in waypoints])
     url = ROUTING_URL.format(waypoints_str=waypoints_str,
                              route_mode=route_mode,
                              route_type=route_type,
                              route_traffic=route_traffic)
-    response = requests.get(url, params={
+    client = client or HttpClient(pool_size=1)
+    response = client.get(url, params={
         'waypoints': waypoints_str,
         'mode': route_mode,
         'type': route_type,
@@ -138,10 +145,18 @@ def main():
     start_location = extract_coordinates(args.start_location, args.coord_order) if args.start_location else None
     end_location = extract_coordinates(args.end_location, args.coord_order) if args.end_location else None
 
+    # Request latency, status codes and retries of the run
+    metrics = RunMetrics('optimal_route', args.metrics_output, args.metrics_interval)
+    metrics.start_snapshots()
+
+    # Both API calls share one kept-alive connection
+    client = HttpClient(pool_size=1, read_timeout=ROUTE_PLANNER_READ_TIMEOUT, metrics=metrics)
+
     if not args.skip_optimization:
         try:
             # Optimize coordinates order based on route planner API
-            coordinates = optimize_route(args.api_key, coordinates, start_location, end_location, args.route_mode)
+            coordinates = optimize_route(args.api_key, coordinates, start_location, end_location, args.route_mode,
+                                         client)
         except Exception as e:
             print(f'Cannot optimize route ({str(e)}), fallback to original order..')
     # Write file with original or optimized coordinates
@@ -151,7 +166,11 @@ def main():
             record = f'{x},{y}\n' if args.coord_order == 'lonlat' else f'{y},{x}\n'
             file.write(record)
     # Obtain Geojson polyline from routing API based on set of coordinates and route options
-    route_data = get_route(args.api_key, coordinates, args.route_mode, args.route_type, args.route_traffic)
+    route_data = get_route(args.api_key, coordinates, args.route_mode, args.route_type, args.route_traffic, client)
+    metrics.record_items()
+    print(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    metrics.close()
     # Create html file with folium map
     generate_map(route_data, args.map, coordinates, start_location, end_location, args.api_key)
 
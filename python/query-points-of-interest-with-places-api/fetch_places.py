@@ -1,13 +1,15 @@
 import argparse
 import asyncio
 import itertools
-import json
 import logging
 import math
 import random
 
 from aiohttp import ClientError, ClientSession, ClientTimeout
 
+from result_output import add_output_arguments, open_output
+from run_metrics import RunMetrics, add_metrics_arguments
+
 # Configure logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s-%(name)s | %(levelname)s  %(message)s')
@@ -20,6 +22,15 @@ REQUESTS_PER_SECOND = 5  # requests per second
 REQUEST_TIMEOUT_SECONDS = 30
 MAX_RETRIES = 3
 OUTPUT_FILE = 'output.ndjson'
+# Place properties written as typed columns of Parquet and Arrow output
+COLUMNS = [
+    ('place_id', 'string'), ('name', 'string'), ('categories', 'strings'), ('lat', 'float'), ('lon', 'float'),
+    ('formatted', 'string'), ('address_line1', 'string'), ('address_line2', 'string'), ('housenumber', 'string'),
+    ('street', 'string'), ('postcode', 'string'), ('city', 'string'), ('county', 'string'), ('state', 'string'),
+    ('country', 'string'), ('country_code', 'string'), ('datasource.sourcename', 'string'),
+    ('datasource.raw.website', 'string'), ('datasource.raw.phone', 'string'),
+    ('datasource.raw.opening_hours', 'string'),
+]
 
 
 def parse_arguments():
@@ -28,8 +39,11 @@ def parse_arguments():
     parser.add_argument('--bbox', nargs=4, required=True, help='Bounding box as min_lon,min_lat,max_lon,max_lat')
     parser.add_argument('--categories', required=True, help='Comma-separated list of place categories')
     parser.add_argument('--grid_size', type=float, default=5.0, help='Maximum size of each grid cell in kilometers')
-    parser.add_argument('--output', default=OUTPUT_FILE, help=f'Output NDJSON file path (default: {OUTPUT_FILE})')
+    parser.add_argument('--output', default=OUTPUT_FILE,
+                        help=f'Output file path, NDJSON unless --file_format is set (default: {OUTPUT_FILE})')
     parser.add_argument('--rain', action='store_true', help='Draw ASCII rain as grid cells are processed')
+    add_output_arguments(parser)
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
@@ -159,7 +173,7 @@ def write_places(output_file, places, seen_place_ids):
                 continue
             seen_place_ids.add(place_id)
 
-        output_file.write(json.dumps(properties) + "\n")
+        output_file.write(properties)
         written += 1
 
     return written
@@ -226,9 +240,14 @@ async def main():
     else:
         logger.info('Grids calculated')
 
+    # Request latency, status codes, retries and throughput of the run
+    metrics = RunMetrics('fetch_places', args.metrics_output, args.metrics_interval)
+    metrics.start_snapshots()
+
     timeout = ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
-    with open(args.output, "w") as f:
-        async with ClientSession(timeout=timeout) as session:
+    with open_output(lambda: open(args.output, "w", encoding="utf-8"), args.output, args.file_format, COLUMNS,
+                     args.raw_json) as f:
+        async with ClientSession(timeout=timeout, trace_configs=[metrics.trace_config()]) as session:
             coros = itertools.batched((process_grid_cell(session, args.api_key, args.categories, bbox)
                                        for bbox in grid_cells), REQUESTS_PER_SECOND)
             for batch in coros:
@@ -241,15 +260,20 @@ async def main():
                             rain_progress.mark(saved_count, failed=True)
                         logger.error(f"Grid processing failed: {exc}")
                         continue
-                    saved_count += write_places(f, places, seen_place_ids)
+                    written = write_places(f, places, seen_place_ids)
+                    saved_count += written
+                    metrics.record_items(written)
                     if rain_progress:
                         rain_progress.mark(saved_count)
                 await asyncio.sleep(1)
 
+    metrics.close()
     if rain_progress:
         rain_progress.finish(saved_count, args.output)
     else:
         logger.info(f"Saved {saved_count} places to {args.output}")
+        if args.metrics_output:
+            logger.info(f"Metrics written to {args.metrics_output}.prom and {args.metrics_output}.json")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+
+from result_output import dumps
+
+CHECKPOINT_EVERY = 1000
+JOURNAL_SUFFIX = '.journal'
+DEAD_LETTER_SUFFIX = '.failed.ndjson'
+
+logger = logging.getLogger(__name__)
+
+
+class JobJournal:
+    """Checkpoints and failed items of a batch job writing one output line per input item.
+
+    Results are written in input order, so the completed input indices are always `0 .. done - 1`.
+    Every `checkpoint_every` items the journal (`<output>.journal`) records the number of completed
+    items and the output file size. A resumed run truncates the output to the last checkpoint and
+    skips the completed items. Failed items are listed in `<output>.failed.ndjson` with their error.
+    """
+
+    def __init__(self, output_file, resume=False, checkpoint_every=CHECKPOINT_EVERY):
+        self.output_file = output_file
+        self.journal_file = output_file + JOURNAL_SUFFIX
+        self.dead_letter_file = dead_letter_path(output_file)
+        self.checkpoint_every = checkpoint_every
+        self.done = 0
+        self.offset = 0
+        self.failed = 0
+
+        if resume:
+            self.done, self.offset = read_last_checkpoint(self.journal_file)
+            if self.done and not os.path.exists(output_file):
+                # The completed results are gone, so every item is processed again
+                logger.warning(f"{output_file} does not exist, starting over instead of resuming after "
+                               f"{self.done} items")
+                self.done, self.offset = 0, 0
+            if self.done and os.path.getsize(output_file) < self.offset:
+                raise ValueError(f"{output_file} is shorter than recorded in {self.journal_file}, cannot resume")
+            # Items after the last checkpoint are processed again, so their failures are dropped
+            failures = [failure for failure in read_failures(self.dead_letter_file) if failure['index'] < self.done]
+            with open(self.dead_letter_file, 'w') as f:
+                for failure in failures:
+                    f.write(json.dumps(failure) + '\n')
+            self.failed = len(failures)
+
+        self.journal = open(self.journal_file, 'a' if self.done else 'w')
+        self.dead_letter = open(self.dead_letter_file, 'a' if self.done else 'w')
+
+    def open_output(self):
+        # Drop results written after the last checkpoint. Results are UTF-8, orjson does not escape non-ASCII
+        f = open(self.output_file, 'a' if self.done else 'w', encoding='utf-8')
+        f.truncate(self.offset)
+        return f
+
+    def record_failure(self, index, item, error, status=None):
+        self.failed += 1
+        write_failure(self.dead_letter, index, item, error, status)
+
+    def record_done(self, output):
+        self.done += 1
+        if self.done % self.checkpoint_every == 0:
+            self.checkpoint(output)
+
+    def checkpoint(self, output):
+        # Output and failures must be on disk before the checkpoint that refers to them
+        output.flush()
+        self.dead_letter.flush()
+        self.offset = output.tell()
+        self.journal.write(json.dumps({'done': self.done, 'offset': self.offset}) + '\n')
+        self.journal.flush()
+
+    def close(self, output):
+        self.checkpoint(output)
+        self.journal.close()
+        self.dead_letter.close()
+
+
+def dead_letter_path(output_file):
+    return output_file + DEAD_LETTER_SUFFIX
+
+
+def write_failure(f, index, item, error, status=None):
+    f.write(json.dumps({'index': index, 'item': item, 'error': str(error), 'status': status}) + '\n')
+
+
+def read_last_checkpoint(journal_file):
+    done, offset = 0, 0
+    if not os.path.exists(journal_file):
+        return done, offset
+    with open(journal_file, 'r') as f:
+        for line in f:
+            try:
+                checkpoint = json.loads(line)
+            except ValueError:
+                # Incomplete line written when the job was killed
+                continue
+            done, offset = checkpoint['done'], checkpoint['offset']
+    return done, offset
+
+
+def read_failures(dead_letter_file):
+    if not os.path.exists(dead_letter_file):
+        return []
+    failures = {}
+    with open(dead_letter_file, 'r') as f:
+        for line in f:
+            try:
+                failure = json.loads(line)
+            except ValueError:
+                continue
+            failures[failure['index']] = failure
+    return [failures[index] for index in sorted(failures)]
+
+
+def replace_results(output_file, results_by_index, projection=None):
+    # Rewrite the output with new results for the given line indices, serialized and projected (a FieldProjection)
+    # like the other lines
+    temp_file = output_file + '.tmp'
+    with open(output_file, 'r', encoding='utf-8') as src, open(temp_file, 'w', encoding='utf-8') as dst:
+        for index, line in enumerate(src):
+            if index in results_by_index:
+                result = results_by_index[index]
+                line = dumps(projection.project(result) if projection else result) + '\n'
+            dst.write(line)
+    os.replace(temp_file, output_file)
@@ -0,0 +1,141 @@
+import asyncio
+import math
+import threading
+import time
+
+from rate_limiter import RateLimiter
+
+# Statuses returned for an invalid, blocked or expired API key
+KEY_ERROR_STATUSES = (401, 403)
+
+
+class KeyPoolExhausted(Exception):
+    """No API key of the pool can send more requests."""
+
+
+class ApiKey:
+    """One API key of a KeyPool with its own rate limiter and daily request budget."""
+
+    def __init__(self, key, requests_per_second, burst=1, daily_limit=None):
+        self.key = key
+        self.rate_limiter = RateLimiter(requests_per_second, burst)
+        self.daily_limit = daily_limit
+        self.used = 0
+        self.disabled = None
+
+    def available(self):
+        return not self.disabled and (self.daily_limit is None or self.used < self.daily_limit)
+
+    def name(self):
+        # Never log full API keys
+        return self.key[:6] + '...'
+
+
+class KeyPool:
+    """Several API keys shared by all workers, each paced by its own rate limiter.
+
+    Every request takes a token from the available key that has one first, so the combined rate
+    is the sum of the key rates. A key that answers HTTP 429 is paused by its rate limiter and the
+    other keys take over; a key that answers 401/403 or used up its daily limit is not used again.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return sum(key.rate_limiter.rate for key in self.keys if key.available())
+
+    @property
+    def throttled_count(self):
+        return sum(key.rate_limiter.throttled_count for key in self.keys)
+
+    def reserve(self):
+        # Take a token from the key with the shortest wait and return the key and the wait
+        with self.lock:
+            keys = [key for key in self.keys if key.available()]
+            if not keys:
+                raise KeyPoolExhausted('All API keys are disabled or out of their daily limit')
+            key = min(keys, key=lambda key: key.rate_limiter.wait_time())
+            key.used += 1
+            return key, key.rate_limiter.reserve()
+
+    def reserve_key(self, key):
+        # Take a token of `key` for another request with it and return the wait, None if it can't send more
+        with self.lock:
+            if not key.available():
+                return None
+            key.used += 1
+            return key.rate_limiter.reserve()
+
+    def limiter(self, key):
+        return KeyLimiter(self, key)
+
+    def acquire(self):
+        key, delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return key
+
+    async def acquire_async(self):
+        key, delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return key
+
+    def disable(self, key, reason):
+        with self.lock:
+            key.disabled = key.disabled or reason
+
+    def stats(self):
+        return [{'key': key.name(), 'requests': key.used, 'throttled': key.rate_limiter.throttled_count,
+                 'disabled': key.disabled} for key in self.keys]
+
+
+class KeyLimiter:
+    """Paces further requests with one key of a KeyPool, e.g. hedged duplicates, in place of its RateLimiter.
+
+    Every token is taken through the pool, so it counts towards the daily limit of the key. `acquire` returns
+    False without a token when the key was disabled or used up its daily limit in the meantime.
+    """
+
+    def __init__(self, key_pool, key):
+        self.key_pool = key_pool
+        self.key = key
+
+    def wait_time(self):
+        return self.key.rate_limiter.wait_time() if self.key.available() else math.inf
+
+    def acquire(self):
+        delay = self.key_pool.reserve_key(self.key)
+        if delay is None:
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    async def acquire_async(self):
+        delay = self.key_pool.reserve_key(self.key)
+        if delay is None:
+            return False
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return True
+
+
+def read_key_pool(keys_file, requests_per_second, burst=1):
+    # One key per line: KEY[,REQUESTS_PER_SECOND[,DAILY_LIMIT]]; empty lines and # comments are skipped
+    keys = []
+    with open(keys_file, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            key, *limits = [value.strip() for value in line.split(',')]
+            key_rate = float(limits[0]) if limits and limits[0] else requests_per_second
+            daily_limit = int(limits[1]) if len(limits) > 1 and limits[1] else None
+            keys.append(ApiKey(key, key_rate, burst, daily_limit))
+    if not keys:
+        raise ValueError(f'No API keys in {keys_file}')
+    return KeyPool(keys)
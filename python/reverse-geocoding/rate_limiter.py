@@ -0,0 +1,140 @@
+import asyncio
+import email.utils
+import threading
+import time
+
+# Multiplicative decrease applied on HTTP 429 and on rising latency
+THROTTLED_DECREASE = 0.5
+LATENCY_DECREASE = 0.8
+# Requests per second regained over one second of successful requests
+ADDITIVE_INCREASE = 1.0
+# Latency is considered rising when its moving average exceeds the baseline by this factor for ELEVATED_SAMPLES
+# successes in a row. Both are geometric moving averages, so single slow responses of a heavy-tailed latency
+# distribution barely move them; the baseline follows the latency slowly, so it settles on a new normal
+LATENCY_FACTOR = 3.0
+LATENCY_SMOOTHING = 0.2
+BASELINE_SMOOTHING = 0.002
+MIN_LATENCY_SAMPLES = 10
+ELEVATED_SAMPLES = 10
+# Latencies are clamped to this many seconds, a zero latency has no logarithm
+MIN_LATENCY = 1e-4
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+class RateLimiter:
+    """Thread-safe token bucket with AIMD rate adaptation, usable from threads and coroutines.
+
+    Tokens are refilled at the current rate up to `burst`. The rate is halved when the API answers
+    with HTTP 429 (and requests are paused for `Retry-After` seconds), reduced when latency stays
+    well above its baseline, and grows back additively towards `requests_per_second` on success.
+    """
+
+    def __init__(self, requests_per_second, burst=1, min_requests_per_second=0.5):
+        if requests_per_second <= 0:
+            raise ValueError('requests_per_second must be greater than 0')
+        if burst < 1:
+            raise ValueError('burst must be at least 1')
+
+        self.max_rate = float(requests_per_second)
+        self.min_rate = min(float(min_requests_per_second), self.max_rate)
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.latency = None
+        self.latency_baseline = None
+        self.latency_samples = 0
+        self.elevated_samples = 0
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        # Take one token and return how long the caller has to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            # During a Retry-After pause the bucket refills from the end of the pause, not from now
+            start = max(now, self.updated_at)
+            self.tokens = min(self.burst, self.tokens + (start - self.updated_at) * self.rate)
+            self.updated_at = start
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return start - now + delay
+
+    def wait_time(self):
+        # How long a caller would have to wait for the next token, without taking it
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.updated_at)
+            tokens = min(self.burst, self.tokens + (start - self.updated_at) * self.rate)
+            delay = (1 - tokens) / self.rate if tokens < 1 else 0.0
+            return start - now + delay
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _decrease(self, factor):
+        # Back off at most once per second, so a burst of concurrent failures counts as one signal
+        now = time.monotonic()
+        if now - self.decreased_at < 1:
+            return
+        self.decreased_at = now
+        self.rate = max(self.min_rate, self.rate * factor)
+
+    def record_success(self, latency):
+        with self.lock:
+            latency = max(latency, MIN_LATENCY)
+            if self.latency is None:
+                self.latency = self.latency_baseline = latency
+            else:
+                # Exponential moving averages of the logarithm of the latency
+                self.latency *= (latency / self.latency) ** LATENCY_SMOOTHING
+                self.latency_baseline *= (latency / self.latency_baseline) ** BASELINE_SMOOTHING
+            self.latency_samples += 1
+            if self.latency > self.latency_baseline * LATENCY_FACTOR:
+                self.elevated_samples += 1
+            else:
+                self.elevated_samples = 0
+
+            if self.latency_samples >= MIN_LATENCY_SAMPLES and self.elevated_samples >= ELEVATED_SAMPLES:
+                self._decrease(LATENCY_DECREASE)
+            else:
+                self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE / self.rate)
+
+    def record_throttled(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            # Settle the tokens refilled so far at the old rate, then drop saved-up ones, so requests resume
+            # at the reduced rate
+            start = max(now, self.updated_at)
+            self.tokens = min(self.tokens + (start - self.updated_at) * self.rate, 0.0)
+            self.updated_at = start
+            self.throttled_count += 1
+            self._decrease(THROTTLED_DECREASE)
+            if retry_after:
+                # Move the bucket, debt included, to the end of the pause, so requests queued behind it are
+                # spaced at the rate instead of all starting when it ends
+                self.paused_until = max(self.paused_until, now + retry_after)
+                self.updated_at = max(self.updated_at, self.paused_until)
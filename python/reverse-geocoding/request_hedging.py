@@ -0,0 +1,148 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic
+
+DEFAULT_PERCENTILE = 95
+DEFAULT_MAX_PERCENT = 5
+LATENCY_WINDOW = 1000
+MIN_SAMPLES = 100
+# Recompute the hedging delay every UPDATE_EVERY latencies instead of sorting the window for every request
+UPDATE_EVERY = 50
+
+
+class RequestHedger:
+    """Sends a duplicate of a request that is slower than a percentile of recent latencies.
+
+    The delay is the `percentile` of the last `LATENCY_WINDOW` request latencies; no request is hedged
+    before `MIN_SAMPLES` latencies are known. The first answer is used: a losing thread request finishes
+    in the background, a losing asyncio request is cancelled. If the first answer is an exception, the
+    other request is awaited instead. At most `max_percent` percent of the requests are duplicated, and
+    only when the rate limiter of the request has a token right away, which the duplicate takes. With a
+    KeyPool, pass the KeyLimiter of the key of the request, so duplicates count towards its daily limit.
+    """
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, max_percent=DEFAULT_MAX_PERCENT, max_workers=10):
+        self.percentile = percentile
+        self.max_ratio = max_percent / 100
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.samples = 0
+        self.delay = None
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+        # Requests of the thread engine run here, so the worker can wait for the first of two
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.samples += 1
+            if len(self.latencies) >= MIN_SAMPLES and self.samples % UPDATE_EVERY == 0:
+                ordered = sorted(self.latencies)
+                self.delay = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def start(self):
+        # Count a request and return the hedging delay, None while too few latencies are known
+        with self.lock:
+            self.requests += 1
+            return self.delay
+
+    def may_hedge(self, rate_limiter):
+        # Duplicates only use spare rate: a token must be available now, and the cap must not be reached
+        if rate_limiter and rate_limiter.wait_time() > 0:
+            return False
+        with self.lock:
+            if self.hedged >= self.max_ratio * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def won(self):
+        with self.lock:
+            self.hedge_wins += 1
+
+    def timed(self, send):
+        started = monotonic()
+        result = send()
+        self.record(monotonic() - started)
+        return result
+
+    async def timed_async(self, send):
+        started = monotonic()
+        result = await send()
+        self.record(monotonic() - started)
+        return result
+
+    def call(self, send, rate_limiter=None):
+        # `send` performs the request and returns its response
+        delay = self.start()
+        if delay is None:
+            return self.timed(send)
+        primary = self.executor.submit(self.timed, send)
+        if wait([primary], timeout=delay).done or not self.may_hedge(rate_limiter):
+            return primary.result()
+        if rate_limiter and rate_limiter.acquire() is False:
+            # The key of the request can't send more requests
+            return primary.result()
+        hedge = self.executor.submit(self.timed, send)
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        first, second = (primary, hedge) if primary in done else (hedge, primary)
+        if first.exception() is not None and second.exception() is None:
+            first = second
+        if first is hedge:
+            self.won()
+        return first.result()
+
+    async def call_async(self, send, rate_limiter=None, discard=None):
+        # Same as call for a coroutine function; `discard` releases a response that is not used
+        delay = self.start()
+        if delay is None:
+            return await self.timed_async(send)
+        primary = asyncio.ensure_future(self.timed_async(send))
+        done, _ = await asyncio.wait([primary], timeout=delay)
+        if done or not self.may_hedge(rate_limiter):
+            return await primary
+        if rate_limiter and await rate_limiter.acquire_async() is False:
+            return await primary
+        hedge = asyncio.ensure_future(self.timed_async(send))
+        done, _ = await asyncio.wait([primary, hedge], return_when=asyncio.FIRST_COMPLETED)
+        first, second = (primary, hedge) if primary in done else (hedge, primary)
+        if first.exception() is not None:
+            # The other request may still answer
+            await asyncio.wait([second])
+            if second.exception() is None:
+                first, second = second, first
+        elif second.done():
+            if second.exception() is None and discard:
+                discard(second.result())
+        else:
+            second.cancel()
+        if first is hedge:
+            self.won()
+        return first.result()
+
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'hedged': self.hedged, 'hedge_wins': self.hedge_wins,
+                    'hedge_rate': self.hedged / self.requests if self.requests else 0.0, 'delay': self.delay}
+
+    def watch(self, metrics):
+        metrics.add_gauge('hedged_requests', 'Duplicate requests sent for slow requests', lambda: self.hedged)
+        metrics.add_gauge('hedge_wins', 'Duplicate requests that answered first', lambda: self.hedge_wins)
+        metrics.add_gauge('hedge_delay_seconds', 'Latency after which a request is duplicated',
+                          lambda: self.delay or 0)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def add_hedging_arguments(parser):
+    parser.add_argument('--hedge_percentile', type=float,
+                        help='Send a duplicate of a request that is still running after this percentile of recent '
+                             'latencies, e.g. 95 (default: no hedging)')
+    parser.add_argument('--hedge_max_percent', type=float, default=DEFAULT_MAX_PERCENT,
+                        help=f'Maximum share of requests in percent that are duplicated '
+                             f'(default: {DEFAULT_MAX_PERCENT})')
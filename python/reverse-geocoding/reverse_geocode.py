@@ -1,10 +1,24 @@
-import requests
-import itertools as it
-import json
 import logging
 import argparse
-from time import sleep
-from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
+import asyncio
+import random
+from collections import deque
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+from aiohttp import ClientError, ClientResponse, ClientSession, ClientTimeout, TCPConnector
+
+from http_client import BACKOFF_FACTOR, CONNECT_TIMEOUT, READ_TIMEOUT, SERVER_ERROR_STATUSES, HttpClient
+from job_journal import JobJournal, dead_letter_path, read_failures, replace_results, write_failure
+from key_pool import KEY_ERROR_STATUSES, KeyPoolExhausted, read_key_pool
+from rate_limiter import RateLimiter, parse_retry_after
+from request_hedging import DEFAULT_MAX_PERCENT, RequestHedger, add_hedging_arguments
+from result_output import add_output_arguments, open_output
+from reverse_index import DEFAULT_RADIUS, ReverseGeocodeIndex
+from run_metrics import RunMetrics, add_metrics_arguments
+from track_simplification import DEFAULT_ANGLE, DEFAULT_DISTANCE, simplify_track
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -12,9 +26,40 @@ logger = logging.getLogger(__name__)
 
 # Constants
 REQUESTS_PER_SECOND = 5
+BURST = 1
+MAX_WORKERS = 10
+CONCURRENCY = 50
+MAX_RETRIES = 3
+MAX_IN_FLIGHT = 100
 GEOAPIFY_API_URL = 'https://api.geoapify.com/v1/geocode/reverse'
+# Result fields written as typed columns of Parquet and Arrow output
+COLUMNS = [
+    ('lat', 'float'), ('lon', 'float'), ('distance', 'float'), ('formatted', 'string'), ('address_line1', 'string'),
+    ('address_line2', 'string'), ('housenumber', 'string'), ('street', 'string'), ('postcode', 'string'),
+    ('city', 'string'), ('county', 'string'), ('state', 'string'), ('country', 'string'),
+    ('country_code', 'string'), ('result_type', 'string'), ('place_id', 'string'), ('rank.importance', 'float'),
+    ('rank.popularity', 'float'), ('timezone.name', 'string'), ('datasource.sourcename', 'string'),
+    ('error', 'string'),
+]
+
+class GeocodingError(Exception):
+    """Reverse geocoding request that failed after all retries, with the HTTP status if there was a response."""
+
+    def __init__(self, error, status=None):
+        super().__init__(error)
+        self.status = status
 
-def reverse_geocode(api_key, lat, lon, country_filter, result_type, output_format):
+def first_result(data):
+    if data.get('results'):
+        return data['results'][0]
+    elif data.get('features'):
+        return data['features'][0]
+    else:
+        # Like the geocoding sample, so these points can be told apart from failed ones, which get {}
+        return {"error": "Not found"}
+
+def reverse_geocode(api_key, lat, lon, country_filter, result_type, output_format, rate_limiter=None, client=None,
+                    point_index=None, key_pool=None, hedger=None):
     params = {
         'lat': lat,
         'lon': lon,
@@ -25,61 +70,391 @@ def reverse_geocode(api_key, lat, lon, country_filter, result_type, output_forma
         params['filter'] = 'countrycode:' + country_filter
     if result_type:
         params['type'] = result_type
-    try:
-        response = requests.get(GEOAPIFY_API_URL, params=params)
-        if response.status_code == 200:
-            data = response.json()
-            if 'results' in data:
-                return data['results'][0]
-            elif 'features' in data:
-                return data['features'][0]
+
+    # Answer points close to an already resolved point from the index
+    if point_index:
+        kind = point_index.make_kind(result_type, country_filter, output_format)
+        result = point_index.lookup(lat, lon, kind)
+        if result is not None:
+            return result
+
+    # Server errors and connection failures are retried by the client, rate limiting by the loop below
+    client = client or HttpClient(retry_statuses=SERVER_ERROR_STATUSES)
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if key_pool:
+                # Send every attempt with the key that has a token first
+                key = key_pool.acquire()
+                params['apiKey'], rate_limiter = key.key, key.rate_limiter
+            elif rate_limiter:
+                rate_limiter.acquire()
+            started = monotonic()
+            request = partial(client.get, GEOAPIFY_API_URL, params=dict(params))
+            # A request slower than most recent ones gets a duplicate, the first answer is used
+            # Duplicates of a key pool request take their token through the pool, within the daily limit of the key
+            hedge_limiter = key_pool.limiter(key) if key_pool else rate_limiter
+            response = hedger.call(request, hedge_limiter) if hedger else request()
+            if response.status_code == 200:
+                if rate_limiter:
+                    rate_limiter.record_success(monotonic() - started)
+                result = first_result(response.json())
+                if point_index:
+                    point_index.add(lat, lon, kind, result)
+                return result
+            elif response.status_code == 429 and rate_limiter:
+                # Slow down and retry when the rate limit is exceeded
+                rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"Rate limit exceeded for coordinates: ({lat}, {lon}), "
+                                   f"retrying ({attempt}/{MAX_RETRIES})")
+                    continue
+            elif response.status_code in KEY_ERROR_STATUSES and key_pool:
+                # Stop using a rejected key and retry with the others
+                key_pool.disable(key, f"{response.status_code} {response.text}")
+                if attempt < MAX_RETRIES:
+                    logger.warning(f"API key {key.name()} rejected, retrying coordinates: ({lat}, {lon}) "
+                                   f"with another key")
+                    continue
+        except KeyPoolExhausted:
+            # Not a failure of these coordinates: the run stops instead of failing every remaining point
+            raise
+        except Exception as e:
+            raise GeocodingError(e) from e
+        raise GeocodingError(response.text, response.status_code)
+
+async def reverse_geocode_async(session, api_key, lat, lon, country_filter, result_type, output_format,
+                                rate_limiter, point_index=None, key_pool=None, hedger=None):
+    params = {
+        'lat': lat,
+        'lon': lon,
+        'apiKey': api_key,
+        'format': output_format
+    }
+    if country_filter:
+        params['filter'] = 'countrycode:' + country_filter
+    if result_type:
+        params['type'] = result_type
+
+    if point_index:
+        kind = point_index.make_kind(result_type, country_filter, output_format)
+        result = await point_index.lookup_async(lat, lon, kind)
+        if result is not None:
+            return result
+
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            if key_pool:
+                key = await key_pool.acquire_async()
+                params['apiKey'], rate_limiter = key.key, key.rate_limiter
             else:
-                return {}
-        elif response.status == 429:
-            logger.warning("Rate limit exceeded. Too many requests.")
-            return {}
-        else:
-            logger.error(f"Error: {response.status} for coordinates: ({lat}, {lon})")
-            return {}
-    except Exception as e:
-        logger.error(f"Exception occurred: {e} for coordinates: ({lat}, {lon})")
-        return {}
-
-def main(input_file, output_file, api_key, order, country_filter, result_type, output_format):
-    coordinates = []
+                await rate_limiter.acquire_async()
+            started = monotonic()
+            request = partial(session.get, GEOAPIFY_API_URL, params=dict(params))
+            hedge_limiter = key_pool.limiter(key) if key_pool else rate_limiter
+            response = await (hedger.call_async(request, hedge_limiter, ClientResponse.release) if hedger
+                              else request())
+            async with response:
+                if response.status == 200:
+                    rate_limiter.record_success(monotonic() - started)
+                    result = first_result(await response.json())
+                    if point_index:
+                        await point_index.add_async(lat, lon, kind, result)
+                    return result
+                error, status = await response.text(), response.status
+                if response.status == 429:
+                    # Slow down and retry when the rate limit is exceeded
+                    rate_limiter.record_throttled(parse_retry_after(response.headers.get('Retry-After')))
+                elif response.status in KEY_ERROR_STATUSES and key_pool:
+                    key_pool.disable(key, f"{status} {error}")
+                elif response.status not in SERVER_ERROR_STATUSES:
+                    break
+        except (asyncio.TimeoutError, ClientError) as e:
+            error, status = e, None
+        except KeyPoolExhausted:
+            raise
+        except Exception as e:
+            raise GeocodingError(e) from e
+        if attempt < MAX_RETRIES:
+            logger.warning(f"Request for coordinates: ({lat}, {lon}) failed: {status or ''} {error}, "
+                           f"retrying ({attempt}/{MAX_RETRIES})")
+            await asyncio.sleep(random.uniform(0, BACKOFF_FACTOR * 2 ** attempt))
+
+    raise GeocodingError(error, status)
+
+def read_coordinates(input_file, order):
+    # Read coordinates lazily, so the input file is never loaded into memory at once
     with open(input_file, 'r') as infile:
-        coordinates = [line.strip() for line in infile.readlines()]
-    # Split coordinates into batches
-    coordinates = list(it.batched(coordinates, REQUESTS_PER_SECOND))
-
-    # Request results asynchronously for each batch
-    tasks = []
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        for batch in coordinates:
-            logger.info(batch)
-            for coord in batch:
-                if order == 'latlon':
-                    lat, lon = map(float, coord.split(','))
-                elif order == 'lonlat':
-                    lon, lat = map(float, coord.split(','))
-                tasks.append(
-                    executor.submit(reverse_geocode, api_key, lat, lon, country_filter, result_type, output_format))
-            sleep(1)
-    # Wait for results
-    wait(tasks, return_when=ALL_COMPLETED)
-    results = [task.result() for task in tasks]
-
-    # Writing results to file
-    with open(output_file, 'w') as outfile:
-        for result in results:
-            json.dump(result, outfile)
-            outfile.write('\n')
+        for line in infile:
+            if not line.strip():
+                continue
+            if order == 'latlon':
+                lat, lon = map(float, line.split(','))
+            elif order == 'lonlat':
+                lon, lat = map(float, line.split(','))
+            yield lat, lon
+
+def record_failure(journal, index, lat, lon, error):
+    # Failed coordinates get an empty result and are listed in the dead-letter file for --retry_failed
+    logger.error(f"Error: {error.status or ''} {error} for coordinates: ({lat}, {lon})")
+    journal.record_failure(index, [lat, lon], error, error.status)
+    return {}
+
+def write_completed(outfile, pending, max_in_flight, journal):
+    # Write finished results in input order; block on the oldest request while too many are in flight.
+    # Returns the number of results written
+    written = 0
+    while pending and (pending[0][2].done() or len(pending) > max_in_flight):
+        index, (lat, lon), request = pending.popleft()
+        try:
+            result = request.result()
+        except GeocodingError as e:
+            result = record_failure(journal, index, lat, lon, e)
+        outfile.write(result)
+        journal.record_done(outfile)
+        written += 1
+    return written
+
+async def write_completed_async(outfile, pending, max_in_flight, journal):
+    # Same as write_completed for asyncio tasks
+    written = 0
+    while pending and (pending[0][2].done() or len(pending) > max_in_flight):
+        index, (lat, lon), request = pending.popleft()
+        try:
+            result = await request
+        except GeocodingError as e:
+            result = record_failure(journal, index, lat, lon, e)
+        outfile.write(result)
+        journal.record_done(outfile)
+        written += 1
+    return written
+
+def reverse_geocode_all(api_key, coordinates, output_file, country_filter, result_type, output_format,
+                        requests_per_second=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS,
+                        max_in_flight=MAX_IN_FLIGHT, resume=False, point_index=None, nearest_key=None,
+                        key_pool=None, metrics=None, file_format='ndjson', raw_json=False, hedger=None):
+    # Every worker takes a token before each request, so requests are paced evenly
+    # and the rate adapts to throttling and latency reported by the API.
+    # With a key pool, every key has its own rate limiter instead
+    rate_limiter = None if key_pool else RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('reverse_geocode')
+    metrics.watch_rate(key_pool or rate_limiter)
+    # One pooled connection per worker, kept alive for the whole run, and one more for its hedged request
+    client = HttpClient(pool_size=max_workers * 2 if hedger else max_workers, retry_statuses=SERVER_ERROR_STATUSES,
+                        metrics=metrics)
+    # Completed coordinates are checkpointed, so an interrupted run can be resumed
+    journal = JobJournal(output_file, resume)
+    if journal.done:
+        logger.info(f"Resuming after {journal.done} completed coordinates")
+
+    # Results are written in input order as soon as they are ready, at most max_in_flight are kept in memory
+    pending = deque()
+    key = None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            open_output(journal.open_output, output_file, file_format, COLUMNS, raw_json) as outfile:
+        try:
+            for index, (lat, lon) in islice(enumerate(coordinates), journal.done, None):
+                if nearest_key is None:
+                    request = executor.submit(reverse_geocode, api_key, lat, lon, country_filter, result_type,
+                                              output_format, rate_limiter, client, point_index, key_pool, hedger)
+                elif nearest_key[index] != key:
+                    # Points of a simplified track share the request of their nearest key point
+                    key = nearest_key[index]
+                    request = executor.submit(reverse_geocode, api_key, *coordinates[key], country_filter,
+                                              result_type, output_format, rate_limiter, client, point_index,
+                                              key_pool, hedger)
+                pending.append((index, (lat, lon), request))
+                metrics.record_items(write_completed(outfile, pending, max_in_flight, journal))
+            metrics.record_items(write_completed(outfile, pending, 0, journal))
+        except KeyPoolExhausted:
+            # Checkpoint the results written so far, so --resume continues from the first point without one
+            executor.shutdown(cancel_futures=True)
+            journal.close(outfile)
+            raise
+        journal.close(outfile)
+
+    log_rate(key_pool or rate_limiter)
+    logger.info(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    if journal.failed:
+        logger.warning(f"{journal.failed} coordinates failed, see {journal.dead_letter_file}")
+
+async def reverse_geocode_all_async(api_key, coordinates, output_file, country_filter, result_type, output_format,
+                                    requests_per_second=REQUESTS_PER_SECOND, burst=BURST, concurrency=CONCURRENCY,
+                                    max_in_flight=MAX_IN_FLIGHT, resume=False, point_index=None, nearest_key=None,
+                                    key_pool=None, metrics=None, file_format='ndjson', raw_json=False,
+                                    hedger=None):
+    # Same as reverse_geocode_all, but requests are coroutines sharing one ClientSession:
+    # up to `concurrency` requests are in flight without a thread per request
+    rate_limiter = None if key_pool else RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('reverse_geocode')
+    metrics.watch_rate(key_pool or rate_limiter)
+    semaphore = asyncio.Semaphore(concurrency)
+    journal = JobJournal(output_file, resume)
+    if journal.done:
+        logger.info(f"Resuming after {journal.done} completed coordinates")
+
+    async def geocode(lat, lon):
+        async with semaphore:
+            return await reverse_geocode_async(session, api_key, lat, lon, country_filter, result_type,
+                                               output_format, rate_limiter, point_index, key_pool, hedger)
+
+    pending = deque()
+    key = None
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    # Hedged requests need connections of their own next to the `concurrency` ones
+    connector = TCPConnector(limit=concurrency * 2 if hedger else concurrency)
+    async with ClientSession(timeout=timeout, connector=connector,
+                             trace_configs=[metrics.trace_config()]) as session:
+        with open_output(journal.open_output, output_file, file_format, COLUMNS, raw_json) as outfile:
+            try:
+                for index, (lat, lon) in islice(enumerate(coordinates), journal.done, None):
+                    if nearest_key is None:
+                        request = asyncio.create_task(geocode(lat, lon))
+                    elif nearest_key[index] != key:
+                        key = nearest_key[index]
+                        request = asyncio.create_task(geocode(*coordinates[key]))
+                    pending.append((index, (lat, lon), request))
+                    await asyncio.sleep(0)
+                    metrics.record_items(await write_completed_async(outfile, pending, max_in_flight, journal))
+                metrics.record_items(await write_completed_async(outfile, pending, 0, journal))
+            except KeyPoolExhausted:
+                # Same as reverse_geocode_all: checkpoint and stop the requests that are still running
+                for _, _, request in pending:
+                    request.cancel()
+                journal.close(outfile)
+                raise
+            journal.close(outfile)
+
+    log_rate(key_pool or rate_limiter)
+    if journal.failed:
+        logger.warning(f"{journal.failed} coordinates failed, see {journal.dead_letter_file}")
+
+def log_rate(rate_limiter):
+    logger.info(f"Finished at {rate_limiter.rate:.1f} requests per second, "
+                f"{rate_limiter.throttled_count} requests throttled")
+
+def retry_failed(api_key, output_file, country_filter, result_type, output_format,
+                 requests_per_second=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS, key_pool=None,
+                 metrics=None):
+    # Reverse geocode only the coordinates listed in the dead-letter file and replace their results in the output
+    failures = read_failures(dead_letter_path(output_file))
+    logger.info(f"Retrying {len(failures)} failed coordinates")
+    rate_limiter = None if key_pool else RateLimiter(requests_per_second, burst)
+    metrics = metrics or RunMetrics('reverse_geocode')
+    metrics.watch_rate(key_pool or rate_limiter)
+    client = HttpClient(pool_size=max_workers, retry_statuses=SERVER_ERROR_STATUSES, metrics=metrics)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        requests = [(failure, executor.submit(reverse_geocode, api_key, *failure['item'], country_filter,
+                                              result_type, output_format, rate_limiter, client, None, key_pool))
+                    for failure in failures]
+
+        # Coordinates that fail again stay in the dead-letter file
+        results = {}
+        with open(dead_letter_path(output_file), 'w') as dead_letter:
+            for failure, request in requests:
+                try:
+                    results[failure['index']] = request.result()
+                    metrics.record_items()
+                except GeocodingError as e:
+                    lat, lon = failure['item']
+                    logger.error(f"Error: {e.status or ''} {e} for coordinates: ({lat}, {lon})")
+                    write_failure(dead_letter, failure['index'], failure['item'], e, e.status)
+                except KeyPoolExhausted as e:
+                    # Kept for the next --retry_failed, after the daily limits are reset
+                    write_failure(dead_letter, failure['index'], failure['item'], e)
+
+    replace_results(output_file, results)
+    client.close()
+    logger.info(f"{len(results)} coordinates geocoded, {len(failures) - len(results)} still failing")
+
+def main(input_file, output_file, api_key, order, country_filter, result_type, output_format,
+         requests_per_second=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS,
+         engine='threads', concurrency=CONCURRENCY, max_in_flight=MAX_IN_FLIGHT, resume=False, retry=False,
+         index_file=None, index_radius=DEFAULT_RADIUS, simplify=None, simplify_distance=DEFAULT_DISTANCE,
+         simplify_angle=DEFAULT_ANGLE, api_keys_file=None, metrics_output=None, metrics_interval=0,
+         file_format='ndjson', raw_json=False, hedge_percentile=None, hedge_max_percent=DEFAULT_MAX_PERCENT):
+    # Spread requests over several API keys, each with its own rate and daily limit
+    key_pool = read_key_pool(api_keys_file, requests_per_second, burst) if api_keys_file else None
+    # Request latency, status codes, retries and throughput of the run
+    metrics = RunMetrics('reverse_geocode', metrics_output, metrics_interval)
+    metrics.start_snapshots()
+    if retry:
+        retry_failed(api_key, output_file, country_filter, result_type, output_format,
+                     requests_per_second, burst, max_workers, key_pool, metrics)
+        log_key_pool(key_pool)
+        close_metrics(metrics)
+        return
+
+    # Duplicate requests slower than a percentile of recent latencies, within a share of the traffic
+    hedger = None
+    if hedge_percentile:
+        hedger = RequestHedger(hedge_percentile, hedge_max_percent, max_workers * 2)
+        hedger.watch(metrics)
+
+    # Reuse results of nearby points resolved in this or previous runs when an index file is given
+    point_index = ReverseGeocodeIndex(index_file, index_radius) if index_file else None
+    coordinates = read_coordinates(input_file, order)
+
+    # Treat the input as an ordered track and reverse geocode only its key points
+    nearest_key = None
+    if simplify:
+        coordinates = list(coordinates)
+        nearest_key = simplify_track(coordinates, simplify, simplify_distance, simplify_angle)
+        logger.info(f"Track simplified to {len(set(nearest_key))} key points out of {len(coordinates)} points")
+
+    exhausted = None
+    try:
+        if engine == 'asyncio':
+            asyncio.run(reverse_geocode_all_async(api_key, coordinates, output_file, country_filter, result_type,
+                                                  output_format, requests_per_second, burst, concurrency,
+                                                  max_in_flight, resume, point_index, nearest_key, key_pool,
+                                                  metrics, file_format, raw_json, hedger))
+        else:
+            reverse_geocode_all(api_key, coordinates, output_file, country_filter, result_type, output_format,
+                                requests_per_second, burst, max_workers, max_in_flight, resume, point_index,
+                                nearest_key, key_pool, metrics, file_format, raw_json, hedger)
+    except KeyPoolExhausted as e:
+        # The results written so far are checkpointed
+        exhausted = e
+    log_key_pool(key_pool)
+    log_hedging(hedger)
+    close_metrics(metrics)
+    if point_index:
+        stats = point_index.stats()
+        logger.info(f"Index hits: {stats['hits']}, misses: {stats['misses']} ({stats['hit_rate']:.1%} hit rate), "
+                    f"distance to indexed point: mean {stats['mean_distance']:.1f} m, max {stats['max_distance']:.1f} m")
+        point_index.close()
+    if exhausted:
+        raise SystemExit(f"Stopped: {exhausted}. Run again with --resume once the daily limits are reset.")
+
+def close_metrics(metrics):
+    metrics.close()
+    if metrics.output:
+        logger.info(f"Metrics written to {metrics.output}.prom and {metrics.output}.json")
+
+def log_hedging(hedger):
+    if not hedger:
+        return
+    stats = hedger.stats()
+    logger.info(f"Hedged {stats['hedged']} of {stats['requests']} requests ({stats['hedge_rate']:.1%}), "
+                f"{stats['hedge_wins']} duplicates answered first")
+    hedger.close()
+
+def log_key_pool(key_pool):
+    if not key_pool:
+        return
+    for stats in key_pool.stats():
+        logger.info(f"API key {stats['key']}: {stats['requests']} requests, {stats['throttled']} throttled"
+                    + (f", disabled: {stats['disabled']}" if stats['disabled'] else ''))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Reverse Geocode Coordinates using Geoapify API")
     parser.add_argument("--input", type=str, help="Input file with coordinates.")
-    parser.add_argument("--output", type=str, help="Output file for NDJSON results.")
+    parser.add_argument("--output", type=str, help="Output file for the results, NDJSON unless --file_format is set.")
     parser.add_argument("--api_key", type=str, help="Geoapify API key.")
+    parser.add_argument("--api_keys", type=str,
+                        help="Optional file with several API keys, one per line: KEY[,REQUESTS_PER_SECOND[,DAILY_LIMIT]].")
     parser.add_argument("--order", type=str, choices=['latlon', 'lonlat'], default='latlon',
                         help="Order of coordinates: latlon or lonlat (default: latlon).")
     parser.add_argument("--country_code", type=str, default=None, help="Country filter for results.")
@@ -87,6 +462,42 @@ if __name__ == "__main__":
                         default='address', help="Type of result to retrieve (default: address).")
     parser.add_argument("--output_format", type=str, choices=['geojson', 'json'],
                         default='json', help="Format of result to retrieve (default: json).")
+    parser.add_argument("--requests_per_second", type=float, default=REQUESTS_PER_SECOND,
+                        help=f"Maximum requests per second allowed by your plan (default: {REQUESTS_PER_SECOND}).")
+    parser.add_argument("--burst", type=int, default=BURST,
+                        help=f"Maximum number of requests sent at once (default: {BURST}).")
+    parser.add_argument("--max_workers", type=int, default=MAX_WORKERS,
+                        help=f"Number of worker threads sending requests (default: {MAX_WORKERS}).")
+    parser.add_argument("--engine", type=str, choices=['threads', 'asyncio'], default='threads',
+                        help="Send requests from a thread pool or from asyncio coroutines (default: threads).")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                        help=f"Maximum number of concurrent requests with the asyncio engine (default: {CONCURRENCY}).")
+    parser.add_argument("--max_in_flight", type=int, default=MAX_IN_FLIGHT,
+                        help=f"Maximum number of requests and unwritten results kept in memory (default: {MAX_IN_FLIGHT}).")
+    parser.add_argument("--index", type=str,
+                        help="Optional SQLite file indexing results by location, reused for nearby points.")
+    parser.add_argument("--index_radius", type=float, default=DEFAULT_RADIUS,
+                        help=f"Maximum distance in metres to an indexed point for reusing its result (default: {DEFAULT_RADIUS}).")
+    parser.add_argument("--simplify", type=str, choices=['distance', 'douglas_peucker'], default=None,
+                        help="Treat the input as an ordered track and reverse geocode only its key points.")
+    parser.add_argument("--simplify_distance", type=float, default=DEFAULT_DISTANCE,
+                        help=f"Distance in metres between key points, or Douglas-Peucker tolerance (default: {DEFAULT_DISTANCE}).")
+    parser.add_argument("--simplify_angle", type=float, default=DEFAULT_ANGLE,
+                        help=f"Direction change in degrees that starts a new key point (default: {DEFAULT_ANGLE}).")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue an interrupted run from its last checkpoint instead of starting over.")
+    parser.add_argument("--retry_failed", action="store_true",
+                        help="Reverse geocode again only the coordinates listed in the dead-letter file of a previous run.")
+    add_hedging_arguments(parser)
+    add_output_arguments(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
-    main(args.input, args.output, args.api_key, args.order, args.country_code, args.type, args.output_format)
\ No newline at end of file
+    if args.file_format != 'ndjson' and (args.resume or args.retry_failed):
+        # Parquet and Arrow files cannot be truncated to a checkpoint or rewritten line by line
+        parser.error("--file_format parquet and arrow cannot be combined with --resume or --retry_failed")
+    main(args.input, args.output, args.api_key, args.order, args.country_code, args.type, args.output_format,
+         args.requests_per_second, args.burst, args.max_workers, args.engine, args.concurrency,
+         args.max_in_flight, args.resume, args.retry_failed, args.index, args.index_radius,
+         args.simplify, args.simplify_distance, args.simplify_angle, args.api_keys, args.metrics_output,
+         args.metrics_interval, args.file_format, args.raw_json, args.hedge_percentile, args.hedge_max_percent)
\ No newline at end of file
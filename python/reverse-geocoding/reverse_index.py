@@ -0,0 +1,137 @@
+import asyncio
+import json
+import math
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_RADIUS = 25
+EARTH_RADIUS = 6_371_000
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+# Geohash cells of 7 characters are about 150 x 150 metres at the equator
+GEOHASH_PRECISION = 7
+LAT_BITS = GEOHASH_PRECISION * 5 // 2
+LON_BITS = GEOHASH_PRECISION * 5 - LAT_BITS
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def distance(lat1, lon1, lat2, lon2):
+    # Haversine distance in metres
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def geohash_cell(lat, lon):
+    # Row and column of the geohash cell containing the point
+    row = min(int((lat + 90) / 180 * 2 ** LAT_BITS), 2 ** LAT_BITS - 1)
+    column = int((lon + 180) / 360 * 2 ** LON_BITS) % 2 ** LON_BITS
+    return row, column
+
+
+def geohash(row, column):
+    # Interleave longitude and latitude bits, starting with longitude, and encode them 5 bits per character
+    bits = 0
+    for i in range(LON_BITS):
+        bits = bits << 1 | (column >> (LON_BITS - 1 - i)) & 1
+        if i < LAT_BITS:
+            bits = bits << 1 | (row >> (LAT_BITS - 1 - i)) & 1
+    return ''.join(GEOHASH_BASE32[(bits >> shift) & 31] for shift in range(GEOHASH_PRECISION * 5 - 5, -1, -5))
+
+
+def covering_geohashes(lat, lon, radius):
+    # Geohash cells overlapping the bounding box of the circle around the point
+    lat_delta = radius / METERS_PER_DEGREE
+    lon_delta = lat_delta / max(math.cos(math.radians(lat)), 0.01)
+    min_row, min_column = geohash_cell(max(lat - lat_delta, -90), lon - lon_delta)
+    max_row, max_column = geohash_cell(min(lat + lat_delta, 90), lon + lon_delta)
+    if max_column < min_column:
+        # The box crosses the antimeridian
+        max_column += 2 ** LON_BITS
+    return [geohash(row, column % 2 ** LON_BITS)
+            for row in range(min_row, max_row + 1)
+            for column in range(min_column, max_column + 1)]
+
+
+class ReverseGeocodeIndex:
+    """Persistent SQLite index of reverse geocoding results, bucketed by geohash.
+
+    A query is answered with the result of the nearest indexed point within `radius` metres that was
+    requested with the same result type, country filter and output format. Hits, misses and the distance
+    between the query and the indexed point are counted. A single connection is shared by all worker threads
+    and guarded by a lock. Coroutines use `lookup_async` and `add_async`, which run the queries on a thread of
+    their own instead of blocking the event loop.
+    """
+
+    def __init__(self, path, radius=DEFAULT_RADIUS):
+        self.radius = radius
+        self.hits = 0
+        self.misses = 0
+        self.total_distance = 0.0
+        self.max_distance = 0.0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS reverse_index (
+                                       kind TEXT NOT NULL,
+                                       geohash TEXT NOT NULL,
+                                       lat REAL NOT NULL,
+                                       lon REAL NOT NULL,
+                                       result TEXT NOT NULL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS reverse_index_geohash ON reverse_index (kind, geohash)')
+        self.connection.commit()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reverse-index')
+
+    @staticmethod
+    def make_kind(result_type, country_filter, output_format):
+        return f"{result_type or ''}|{(country_filter or '').lower()}|{output_format}"
+
+    def lookup(self, lat, lon, kind):
+        geohashes = covering_geohashes(lat, lon, self.radius)
+        with self.lock:
+            rows = self.connection.execute(
+                f'SELECT lat, lon, result FROM reverse_index '
+                f'WHERE kind = ? AND geohash IN ({", ".join("?" * len(geohashes))})',
+                (kind, *geohashes)).fetchall()
+
+            nearest, nearest_distance = None, self.radius
+            for row_lat, row_lon, result in rows:
+                row_distance = distance(lat, lon, row_lat, row_lon)
+                if row_distance <= nearest_distance:
+                    nearest, nearest_distance = result, row_distance
+
+            if nearest is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.total_distance += nearest_distance
+            self.max_distance = max(self.max_distance, nearest_distance)
+            return json.loads(nearest)
+
+    def add(self, lat, lon, kind, result):
+        with self.lock:
+            self.connection.execute('INSERT INTO reverse_index VALUES (?, ?, ?, ?, ?)',
+                                    (kind, geohash(*geohash_cell(lat, lon)), lat, lon, json.dumps(result)))
+            self.connection.commit()
+
+    async def lookup_async(self, lat, lon, kind):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.lookup, lat, lon, kind)
+
+    async def add_async(self, lat, lon, kind, result):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.add, lat, lon, kind, result)
+
+    def stats(self):
+        queries = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / queries if queries else 0.0,
+                'mean_distance': self.total_distance / self.hits if self.hits else 0.0,
+                'max_distance': self.max_distance}
+
+    def close(self):
+        self.executor.shutdown()
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,98 @@
+import math
+
+from reverse_index import METERS_PER_DEGREE, distance
+
+DEFAULT_DISTANCE = 50
+DEFAULT_ANGLE = 30
+# Direction changes are ignored closer than this to the last key point, where GPS noise dominates
+MIN_TURN_DISTANCE = 10
+
+
+def bearing(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    delta = math.radians(lon2 - lon1)
+    y = math.sin(delta) * math.cos(phi2)
+    x = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(delta)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+def simplify_by_distance(points, max_distance=DEFAULT_DISTANCE, max_angle=DEFAULT_ANGLE):
+    # Keep a point when it is max_distance away from the last key point or the track turned by max_angle
+    if not points:
+        return []
+    keys = [0]
+    heading = None
+    for i in range(1, len(points)):
+        key_lat, key_lon = points[keys[-1]]
+        lat, lon = points[i]
+        point_distance = distance(key_lat, key_lon, lat, lon)
+        if point_distance < MIN_TURN_DISTANCE:
+            continue
+        direction = bearing(key_lat, key_lon, lat, lon)
+        if heading is None:
+            heading = direction
+        turn = abs((direction - heading + 180) % 360 - 180)
+        if point_distance >= max_distance or turn >= max_angle:
+            keys.append(i)
+            heading = None
+    if keys[-1] != len(points) - 1:
+        keys.append(len(points) - 1)
+    return keys
+
+
+def segment_deviation(point, start, end):
+    # Distance in metres from the point to the segment, in a local flat projection around the segment start
+    scale = math.cos(math.radians(start[0]))
+    x = (point[1] - start[1]) * scale * METERS_PER_DEGREE
+    y = (point[0] - start[0]) * METERS_PER_DEGREE
+    dx = (end[1] - start[1]) * scale * METERS_PER_DEGREE
+    dy = (end[0] - start[0]) * METERS_PER_DEGREE
+    length = dx * dx + dy * dy
+    t = max(0.0, min(1.0, (x * dx + y * dy) / length)) if length else 0.0
+    return math.hypot(x - t * dx, y - t * dy)
+
+
+def douglas_peucker(points, tolerance=DEFAULT_DISTANCE):
+    # Keep the points that deviate more than tolerance metres from the simplified track.
+    # Segments longer than twice the tolerance are split as well, so no point is far from a key point
+    if len(points) < 3:
+        return list(range(len(points)))
+    keep = {0, len(points) - 1}
+    # Iterative, so long tracks don't hit the recursion limit
+    segments = [(0, len(points) - 1)]
+    while segments:
+        first, last = segments.pop()
+        farthest, max_deviation = None, tolerance
+        for i in range(first + 1, last):
+            deviation = segment_deviation(points[i], points[first], points[last])
+            if deviation > max_deviation:
+                farthest, max_deviation = i, deviation
+        if farthest is None and last - first > 1 and distance(*points[first], *points[last]) > 2 * tolerance:
+            farthest = (first + last) // 2
+        if farthest is not None:
+            keep.add(farthest)
+            segments.append((first, farthest))
+            segments.append((farthest, last))
+    return sorted(keep)
+
+
+def nearest_key_points(points, keys):
+    # For every point, the index of the closer of the key points before and after it
+    nearest = []
+    for key, next_key in zip(keys, keys[1:] + [None]):
+        nearest.append(key)
+        if next_key is None:
+            break
+        for i in range(key + 1, next_key):
+            to_key = distance(*points[i], *points[key])
+            to_next_key = distance(*points[i], *points[next_key])
+            nearest.append(key if to_key <= to_next_key else next_key)
+    return nearest
+
+
+def simplify_track(points, method, max_distance=DEFAULT_DISTANCE, max_angle=DEFAULT_ANGLE):
+    if method == 'douglas_peucker':
+        keys = douglas_peucker(points, max_distance)
+    else:
+        keys = simplify_by_distance(points, max_distance, max_angle)
+    return nearest_key_points(points, keys)
@@ -5,8 +5,13 @@ import os
 import folium
 import requests
 
+from http_client import HttpClient
+from run_metrics import RunMetrics, add_metrics_arguments
+
 ROUTE_PLANNER_URL = "https://api.geoapify.com/v1/routeplanner"
 ROUTING_URL = "https://api.geoapify.com/v1/routing"
+# Route optimization may take longer than a regular API call
+ROUTE_PLANNER_READ_TIMEOUT = 120
 
 
 def parse_arguments():
@@ -14,6 +19,7 @@ def parse_arguments():
     parser.add_argument('--api_key', required=True, help='Geoapify API key')
     parser.add_argument('--input', required=True, help='Input JSON file containing the route request')
     parser.add_argument('--output', required=True, help='Output directory for agent folders and reports')
+    add_metrics_arguments(parser)
     
     return parser.parse_args()
 
@@ -28,16 +34,17 @@ def read_request_file(input_file):
     return request
 
 
-def extract_route_plans(api_key, request_data):
-    response = requests.post(ROUTE_PLANNER_URL,
-                             params={'apiKey': api_key},
-                             json=request_data)
+def extract_route_plans(api_key, request_data, client=None):
+    client = client or HttpClient(pool_size=1, read_timeout=ROUTE_PLANNER_READ_TIMEOUT)
+    response = client.post(ROUTE_PLANNER_URL,
+                           params={'apiKey': api_key},
+                           json=request_data)
     response.raise_for_status()
 
     return response.json()
 
 
-def save_agent_plan(api_key, agent_data, output_dir):
+def save_agent_plan(api_key, agent_data, output_dir, client=None):
     # Create dir that contains agent index in name
     agent_dir = os.path.join(output_dir, f'agent_{agent_data['agent_index']}')
     os.makedirs(agent_dir, exist_ok=True)
@@ -52,7 +59,7 @@ def save_agent_plan(api_key, agent_data, output_dir):
     coordinates = [wp['location'] for wp in agent_data['waypoints']]
     try:
         # Generate route by Routing API
-        route = get_route(api_key, coordinates)
+        route = get_route(api_key, coordinates, client)
     except requests.exceptions.RequestException as e:
         print(f'Cannot get route for agent {agent_data['agent_index']}: {e}')
         return
@@ -60,11 +67,12 @@ def save_agent_plan(api_key, agent_data, output_dir):
     generate_map(route, map_path, coordinates, api_key)
 
 
-def get_route(api_key, waypoints):
+def get_route(api_key, waypoints, client=None):
     waypoints_str = '|'.join([f"lonlat:{lon},{lat}" for lon, lat in waypoints])
     url = ROUTING_URL.format(waypoints_str=waypoints_str)
 
-    response = requests.get(url, params={
+    client = client or HttpClient(pool_size=1)
+    response = client.get(url, params={
         'waypoints': waypoints_str,
         'mode': 'drive',
         'apiKey': api_key
@@ -112,11 +120,19 @@ def main():
     # Read and validate input JSON
     request_data = read_request_file(args.input)
 
+    # Request latency, status codes and retries of the run
+    metrics = RunMetrics('route_planner', args.metrics_output, args.metrics_interval)
+    metrics.start_snapshots()
+
+    # All API calls of the run share one kept-alive connection
+    client = HttpClient(pool_size=1, read_timeout=ROUTE_PLANNER_READ_TIMEOUT, metrics=metrics)
+
     # Call Geoapify Route Planner API to extract route plans
     try:
-        response_data = extract_route_plans(args.api_key, request_data)
+        response_data = extract_route_plans(args.api_key, request_data, client)
     except requests.exceptions.RequestException as e:
         print(f"API request failed: {e}")
+        metrics.close()
         return
 
     # Extract geojson properties as agents plans
@@ -126,9 +142,13 @@ def main():
 
     # For every agent plan save data and generate map with optimized route
     for agent_data in agents:
-        save_agent_plan(args.api_key, agent_data['properties'], args.output)
+        save_agent_plan(args.api_key, agent_data['properties'], args.output, client)
+        metrics.record_items()
 
     save_issues_report(issues, args.output)
+    print(f"HTTP connections: {client.connection_stats()}")
+    client.close()
+    metrics.close()
 
 
 if __name__ == '__main__':